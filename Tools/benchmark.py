@@ -0,0 +1,194 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Load test for Chatly. Starts a fake Ollama (see fake_ollama.py) and a Chatly
+# server on free local ports, in a scratch directory so the real Data/ and Key/
+# are not touched, then drives the register -> new_chat -> send_message ->
+# get_chats flow with N concurrent simulated users and reports throughput,
+# latency percentiles per route and how much the Data/ directory grew.
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.abspath(os.path.join(script_dir, '..'))
+sys.path.insert(0, base_dir)
+sys.path.insert(0, script_dir)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+
+class Recorder:
+    """Collects (route, seconds, ok) samples from the simulated users"""
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def call(self, route, function, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = function(*args, **kwargs)
+            ok = response.status_code < 400
+        except Exception:
+            response, ok = None, False
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.samples.setdefault(route, []).append(elapsed)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return response if ok else None
+
+
+def simulate_user(base_url, recorder, messages, stream):
+    import requests
+
+    client = requests.Session()
+    username = f"bench_{uuid.uuid4().hex[:10]}"
+    if not recorder.call("/api/register", client.post, f"{base_url}/api/register",
+                         json={"username": username, "password": "benchmark"}):
+        return 0
+
+    response = recorder.call("/api/new_chat", client.post, f"{base_url}/api/new_chat")
+    if not response:
+        return 0
+    chat_id = response.json()["chat_id"]
+
+    sent = 0
+    route = "/api/send_message_stream" if stream else "/api/send_message"
+    for number in range(messages):
+        payload = {"chat_id": chat_id, "message": f"Benchmark message {number} from {username}"}
+        if stream:
+            # Timed until the last event, like the UI waits for "done"
+            response = recorder.call(route, lambda: consume(client.post(f"{base_url}{route}", json=payload, stream=True)))
+        else:
+            response = recorder.call(route, client.post, f"{base_url}{route}", json=payload)
+        if response:
+            sent += 1
+        recorder.call("/api/get_chats", client.get, f"{base_url}/api/get_chats")
+    return sent
+
+
+def consume(response):
+    for _ in response.iter_lines():
+        pass
+    return response
+
+
+def start_chatly(ollama_port):
+    """Import Chatly from a scratch directory and serve it on a free port"""
+    from werkzeug.serving import make_server
+
+    os.chdir(tempfile.mkdtemp(prefix='chatly-benchmark-'))
+    os.makedirs('Key')
+    os.environ["CHATLY_OLLAMA_URL"] = f"http://127.0.0.1:{ollama_port}"
+    # One log line per reply would drown the report
+    os.environ.setdefault("CHATLY_LOG_LEVEL", "WARNING")
+    import chatly
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, chatly.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, chatly
+
+
+def run_benchmark(users, messages, stream=False, first_token_latency=0.05, tokens_per_second=200.0,
+                  reply_tokens=50):
+    from fake_ollama import serve_fake_ollama
+
+    ollama = serve_fake_ollama(0, ("gemma3:1b",), first_token_latency, tokens_per_second, reply_tokens)
+    server, chatly = start_chatly(ollama.server_address[1])
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    data_dir = os.path.dirname(chatly.users_dir)
+
+    recorder = Recorder()
+    size_before = directory_size(data_dir)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        sent = sum(executor.map(lambda _: simulate_user(base_url, recorder, messages, stream), range(users)))
+    elapsed = time.perf_counter() - started
+    size_after = directory_size(data_dir)
+
+    server.shutdown()
+    ollama.shutdown()
+
+    routes = {}
+    for route, samples in sorted(recorder.samples.items()):
+        routes[route] = {
+            "requests": len(samples),
+            "errors": recorder.errors.get(route, 0),
+            "mean": sum(samples) / len(samples),
+            "p50": percentile(samples, 0.50),
+            "p95": percentile(samples, 0.95),
+            "p99": percentile(samples, 0.99),
+            "max": max(samples)
+        }
+    total_requests = sum(route["requests"] for route in routes.values())
+    return {
+        "users": users,
+        "messages_per_user": messages,
+        "stream": stream,
+        "seconds": elapsed,
+        "requests": total_requests,
+        "requests_per_second": total_requests / elapsed,
+        "messages_sent": sent,
+        "messages_per_second": sent / elapsed,
+        "routes": routes,
+        "storage_bytes": size_after - size_before,
+        "storage_bytes_per_message": (size_after - size_before) / sent if sent else 0
+    }
+
+
+def print_report(result):
+    print(f"\n{result['users']} users x {result['messages_per_user']} messages"
+          f"{' (streaming)' if result['stream'] else ''} in {result['seconds']:.2f}s")
+    print(f"Throughput: {result['requests_per_second']:.1f} requests/s, {result['messages_per_second']:.2f} messages/s")
+    print(f"\n{'route':<28}{'requests':>9}{'errors':>8}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, route in result["routes"].items():
+        print(f"{name:<28}{route['requests']:>9}{route['errors']:>8}"
+              + "".join(f"{route[key] * 1000:>7.1f}ms" for key in ("mean", "p50", "p95", "p99", "max")))
+    print(f"\nStorage growth: {result['storage_bytes'] / 1024:.1f} KiB "
+          f"({result['storage_bytes_per_message']:.0f} bytes per message)")
+
+
+if __name__ == "__main__":
+    # CLI argument parsing
+    parser = argparse.ArgumentParser(description='Load test Chatly against a fake Ollama server.')
+    parser.add_argument('-users', type=int, default=10, help='Concurrent simulated users (default: 10)')
+    parser.add_argument('-messages', type=int, default=5, help='Messages sent by each user (default: 5)')
+    parser.add_argument('-stream', action='store_true', help='Use /api/send_message_stream instead of /api/send_message')
+    parser.add_argument('-latency', type=float, default=0.05, help='Fake Ollama seconds before the first token (default: 0.05)')
+    parser.add_argument('-rate', type=float, default=200.0, help='Fake Ollama tokens per second (default: 200)')
+    parser.add_argument('-tokens', type=int, default=50, help='Tokens per reply (default: 50)')
+    parser.add_argument('-json', metavar='FILE', help='Also write the results to FILE as JSON, e.g. to compare runs')
+
+    args = parser.parse_args()
+
+    # Resolved before Chatly is started from its scratch directory
+    output_file = os.path.abspath(args.json) if args.json else None
+
+    result = run_benchmark(args.users, args.messages, args.stream, args.latency, args.rate, args.tokens)
+    print_report(result)
+    if output_file:
+        with open(output_file, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {output_file}")
@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+import tempfile
+
+# CLI argument parsing
+parser = argparse.ArgumentParser(description='Measure load time, time to first token, tokens/sec and memory of '
+                                             'the installed Ollama models.')
+parser.add_argument('-models', help='Comma separated list of models to benchmark (default: all installed models)')
+parser.add_argument('-fake', action='store_true', help='Run against a local fake Ollama (Tools/fake_ollama.py) '
+                                                      'serving -models, without saving the results')
+parser.add_argument('-no-save', action='store_true', help='Print the results without storing them for the UI')
+
+args = parser.parse_args()
+
+# Calculate base path (parent of script directory) and load Chatly from there,
+# so the results land in the same Data/ directory the server reads
+script_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.abspath(os.path.join(script_dir, '..'))
+sys.path.insert(0, base_dir)
+sys.path.insert(0, script_dir)
+
+models = args.models.split(',') if args.models else None
+
+if args.fake:
+    from fake_ollama import serve_fake_ollama
+
+    server = serve_fake_ollama(0, models or ['gemma3:1b'], load_time=0.5)
+    os.environ['CHATLY_OLLAMA_URL'] = f"http://127.0.0.1:{server.server_address[1]}"
+    # Keep fake results out of the real Data/ directory
+    os.chdir(tempfile.mkdtemp(prefix='chatly-benchmark-models-'))
+    os.makedirs('Key')
+else:
+    os.chdir(base_dir)
+
+import chatly
+
+if args.no_save:
+    chatly.save_benchmark_result = lambda result: None
+
+
+def print_result(result):
+    if "error" in result:
+        print(f"{result['model']:<36} error: {result['error']}")
+        return
+    memory = f"{result['memory_bytes'] / 2**30:.2f} GiB" if result['memory_bytes'] else "-"
+    ttft = f"{result['ttft_seconds']:.3f}s" if result['ttft_seconds'] is not None else "-"
+    rate = f"{result['tokens_per_second']:.1f}" if result['tokens_per_second'] is not None else "-"
+    print(f"{result['model']:<36}{result['load_seconds']:>9.2f}s{ttft:>10}{rate:>10}{memory:>12}")
+
+
+print(f"{'model':<36}{'load':>10}{'ttft':>10}{'tok/s':>10}{'memory':>12}")
+try:
+    results = chatly.run_model_benchmarks(models, on_result=print_result)
+except chatly.requests.exceptions.RequestException as e:
+    print(f"Could not reach Ollama at {chatly.OLLAMA_URL}: {e}")
+    sys.exit(1)
+
+if results and not args.no_save and not args.fake:
+    print(f"Results saved to {os.path.join(base_dir, chatly.BENCHMARK_FILE)}")
@@ -1,12 +1,17 @@
 import json
 import argparse
 import os
-from cryptography.fernet import Fernet
+import sqlite3
+from cryptography.fernet import Fernet, MultiFernet
 
 # CLI argument parsing
 parser = argparse.ArgumentParser(description='Decrypt a user file and output it as plaintext JSON.')
 parser.add_argument('-username', required=True, help='The username (to find ../users/<username>.json)')
 parser.add_argument('-key', help='Path to the encryption key (default: ../Key/encryption.key)')
+parser.add_argument('-retired', help='Earlier keys still to try, one per line, as left by Tools/rotate_key.py '
+                                     '(default: ../Key/retired.keys if it exists)')
+parser.add_argument('-db', help='Read the user from this SQLite database instead (CHATLY_STORAGE=sqlite, '
+                               'default location: ../Data/chatly.db)')
 
 args = parser.parse_args()
 
@@ -17,6 +22,7 @@ base_dir = os.path.abspath(os.path.join(script_dir, '..'))
 # Key path (default: ../Key/encryption.key)
 default_key_path = os.path.join(base_dir, 'Key', 'encryption.key')
 key_path = os.path.abspath(args.key) if args.key else default_key_path
+retired_path = os.path.abspath(args.retired) if args.retired else os.path.join(base_dir, 'Key', 'retired.keys')
 
 # User file path: ../Data/users/<username>.json
 user_file = os.path.join(base_dir, 'Data/users', f'{args.username}.json')
@@ -27,25 +33,42 @@ if not os.path.exists(key_path):
     exit(1)
 
 with open(key_path, 'rb') as key_file:
-    key = key_file.read()
+    keys = [key_file.read().strip()]
 
-cipher = Fernet(key)
+# Records not re-encrypted since a key rotation still use a retired key
+if os.path.exists(retired_path):
+    with open(retired_path, 'rb') as retired_file:
+        keys.extend(retired_file.read().split())
 
-# Load and decrypt user file
-if not os.path.exists(user_file):
-    print(f"Error: Encrypted user file '{user_file}' not found.")
-    exit(1)
+cipher = MultiFernet([Fernet(key) for key in keys])
+
+# Load and decrypt the user record, from the user file or the SQLite database
+default_db_path = os.path.join(base_dir, 'Data', 'chatly.db')
+if args.db or (not os.path.exists(user_file) and os.path.exists(default_db_path)):
+    db_path = os.path.abspath(args.db) if args.db else default_db_path
+    with sqlite3.connect(db_path) as connection:
+        row = connection.execute("SELECT data FROM users WHERE username = ?", (args.username,)).fetchone()
+    if row is None:
+        print(f"Error: User '{args.username}' not found in '{db_path}'.")
+        exit(1)
+    encrypted_data = row[0].encode()
+else:
+    if not os.path.exists(user_file):
+        print(f"Error: Encrypted user file '{user_file}' not found.")
+        exit(1)
 
-with open(user_file, 'rb') as encrypted_file:
-    encrypted_data = encrypted_file.read()
+    with open(user_file, 'rb') as encrypted_file:
+        encrypted_data = encrypted_file.read()
 
 decrypted_data = cipher.decrypt(encrypted_data)
 data = json.loads(decrypted_data)
 
-# Decrypt password field
-encrypted_password = data['password'].encode()
-decrypted_password = cipher.decrypt(encrypted_password).decode()
-data['password'] = decrypted_password
+# Decrypt the password field, left only in records that have not logged in since
+# passwords became hashes (those are kept in the credential index and can't be decrypted)
+if 'password' in data:
+    encrypted_password = data['password'].encode()
+    decrypted_password = cipher.decrypt(encrypted_password).decode()
+    data['password'] = decrypted_password
 
 # Output result to a local file (e.g., ./AlexutzuSoft.txt)
 output_file = f"{args.username}.txt"
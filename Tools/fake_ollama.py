@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the parts of the Ollama API that Chatly uses, with a
+# configurable load time, time to first token and token rate. Useful to develop
+# and measure Chatly without a GPU or any model installed.
+
+WORDS = ("the model is thinking about your question and writing a plausible answer "
+         "one token at a time so that streaming latency can be measured").split()
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open, like the real server
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.count("connections")
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        self.server.count("requests")
+        if self.path == "/api/version":
+            self.send_json({"version": "0.0.0-fake"})
+        elif self.path == "/api/tags":
+            self.send_json({"models": [{"name": model, "model": model, "size": 0} for model in self.server.models]})
+        elif self.path == "/api/ps":
+            with self.server.lock:
+                loaded = list(self.server.loaded)
+            self.send_json({"models": [{"name": model, "model": model, "size": 0, "size_vram": 0} for model in loaded]})
+        elif self.path == "/fake/stats":
+            with self.server.lock:
+                self.send_json(dict(self.server.stats))
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        self.server.count("requests")
+        payload = self.read_json()
+        model = payload.get("model", "")
+        if self.path not in ("/api/chat", "/api/generate"):
+            self.send_json({"error": "not found"}, 404)
+            return
+        if model not in self.server.models:
+            self.send_json({"error": f"model '{model}' not found"}, 404)
+            return
+
+        load_duration = self.server.load_model(model, payload.get("keep_alive"))
+        if self.path == "/api/generate" and not payload.get("prompt"):
+            # An empty prompt only loads (or with keep_alive 0, unloads) the model
+            self.send_json({"model": model, "response": "", "done": True, "load_duration": load_duration})
+            return
+
+        tokens = [random.choice(WORDS) + " " for _ in range(self.server.reply_tokens)]
+        started = time.perf_counter()
+        time.sleep(self.server.first_token_latency)
+        if payload.get("stream", True):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for token in tokens:
+                    self.write_chunk(self.chunk_for(model, token))
+                    self.server.count("tokens")
+                    time.sleep(1 / self.server.tokens_per_second)
+                self.write_chunk(self.final_chunk(model, tokens, started, load_duration))
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client closed the stream, e.g. a cancelled generation: stop generating like Ollama
+                self.server.count("aborted")
+                self.close_connection = True
+        else:
+            time.sleep(len(tokens) / self.server.tokens_per_second)
+            final = self.final_chunk(model, tokens, started, load_duration)
+            final.update(self.chunk_for(model, "".join(tokens)))
+            self.send_json(final)
+
+    def chunk_for(self, model, text):
+        if self.path == "/api/generate":
+            return {"model": model, "response": text, "done": False}
+        return {"model": model, "message": {"role": "assistant", "content": text}, "done": False}
+
+    def final_chunk(self, model, tokens, started, load_duration):
+        total = int((time.perf_counter() - started) * 1e9) + load_duration
+        return {
+            "model": model,
+            "done": True,
+            "total_duration": total,
+            "load_duration": load_duration,
+            "prompt_eval_count": 10,
+            "prompt_eval_duration": int(self.server.first_token_latency * 1e9),
+            "eval_count": len(tokens),
+            "eval_duration": int(len(tokens) / self.server.tokens_per_second * 1e9)
+        }
+
+    def write_chunk(self, data):
+        line = (json.dumps(data) + "\n").encode()
+        self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, models, first_token_latency, tokens_per_second, reply_tokens, load_time, verbose=False):
+        super().__init__(address, FakeOllamaHandler)
+        self.models = models
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.load_time = load_time
+        self.verbose = verbose
+        self.loaded = set()
+        self.stats = {"connections": 0, "requests": 0, "loads": 0, "tokens": 0, "aborted": 0}
+        self.lock = threading.Lock()
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def load_model(self, model, keep_alive=None):
+        """Simulate a cold load the first time a model is used, returns the load time in ns"""
+        with self.lock:
+            if keep_alive in (0, "0", "0s"):
+                self.loaded.discard(model)
+                return 0
+            if model in self.loaded:
+                return 0
+            self.loaded.add(model)
+            self.stats["loads"] += 1
+        time.sleep(self.load_time)
+        return int(self.load_time * 1e9)
+
+
+def serve_fake_ollama(port=11434, models=("gemma3:1b",), first_token_latency=0.05, tokens_per_second=200.0,
+                      reply_tokens=50, load_time=0.0, verbose=False):
+    """Start a fake Ollama server in a background thread and return it (call .shutdown() to stop)"""
+    server = FakeOllamaServer(("127.0.0.1", port), list(models), first_token_latency, tokens_per_second,
+                              reply_tokens, load_time, verbose)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def measure_connection_reuse(server, requests_count, concurrency):
+    """Send the same chat requests with bare requests.post and with Chatly's pooled session"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+
+    # Load Chatly from a scratch directory so its Data/ and Key/ are not touched
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.abspath(os.path.join(script_dir, '..')))
+    os.chdir(tempfile.mkdtemp(prefix='chatly-fake-ollama-'))
+    os.makedirs('Key')
+    import chatly
+
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/chat"
+    payload = {"model": server.models[0], "messages": [{"role": "user", "content": "hi"}], "stream": True}
+
+    def run(label, post):
+        def one(_):
+            with post(url, json=payload, stream=True, timeout=30) as response:
+                for _ in response.iter_lines():
+                    pass
+
+        before = server.stats["connections"]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(one, range(requests_count)))
+        elapsed = time.perf_counter() - started
+        print(f"{label:>16}: {elapsed:.2f}s, {server.stats['connections'] - before} TCP connection(s) "
+              f"for {requests_count} requests")
+
+    run("requests.post", requests.post)
+    run("pooled session", chatly.create_ollama_session(concurrency).post)
+
+
+if __name__ == "__main__":
+    # CLI argument parsing
+    parser = argparse.ArgumentParser(description='Run a fake Ollama server for development and benchmarks.')
+    parser.add_argument('-port', type=int, default=11434, help='Port to listen on (default: 11434)')
+    parser.add_argument('-models', default='gemma3:1b', help='Comma separated list of model names to serve')
+    parser.add_argument('-latency', type=float, default=0.05, help='Seconds before the first token (default: 0.05)')
+    parser.add_argument('-rate', type=float, default=200.0, help='Tokens per second (default: 200)')
+    parser.add_argument('-tokens', type=int, default=50, help='Tokens per reply (default: 50)')
+    parser.add_argument('-load-time', type=float, default=0.0, help='Seconds to "load" a model on first use')
+    parser.add_argument('-measure', type=int, metavar='N', help='Instead of serving, send N chat requests with and '
+                                                               'without connection pooling and compare')
+    parser.add_argument('-concurrency', type=int, default=8, help='Concurrent clients for -measure (default: 8)')
+    parser.add_argument('-verbose', action='store_true', help='Log every request')
+
+    args = parser.parse_args()
+
+    server = serve_fake_ollama(args.port, args.models.split(','), args.latency, args.rate, args.tokens,
+                               args.load_time, args.verbose)
+    if args.measure:
+        measure_connection_reuse(server, args.measure, args.concurrency)
+        server.shutdown()
+    else:
+        print(f"Fake Ollama listening on http://127.0.0.1:{args.port} serving {', '.join(server.models)}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,43 @@
+import argparse
+import os
+import sys
+
+# CLI argument parsing
+parser = argparse.ArgumentParser(description='Convert legacy single-file chats to the append-only chat log format.')
+parser.add_argument('-username', help='Only migrate the chats of this user (default: all users)')
+parser.add_argument('-compact', action='store_true', help='Also rewrite existing chat logs to drop superseded records')
+
+args = parser.parse_args()
+
+# Calculate base path (parent of script directory) and load Chatly from there,
+# so it picks up the same Data/ and Key/ directories as the server
+script_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.abspath(os.path.join(script_dir, '..'))
+os.chdir(base_dir)
+sys.path.insert(0, base_dir)
+
+import chatly
+
+# Legacy chats only exist in the file layout, whichever backend the server uses
+store = chatly.FileStorage(chatly.users_dir, chatly.chats_dir)
+usernames = [args.username] if args.username else sorted(os.listdir(chatly.chats_dir))
+
+migrated = 0
+compacted = 0
+for username in usernames:
+    user_chats_dir = os.path.join(chatly.chats_dir, username)
+    if not os.path.isdir(user_chats_dir):
+        continue
+
+    for file in sorted(os.listdir(user_chats_dir)):
+        chat_id, extension = os.path.splitext(file)
+        if extension == '.json':
+            if store.migrate_chat(username, chat_id):
+                migrated += 1
+        elif extension == chatly.CHAT_LOG_EXTENSION and args.compact:
+            chat_data, _ = chatly.read_chat_log(os.path.join(user_chats_dir, file))
+            if chat_data is not None:
+                store.write_chat(username, chat_id, chat_data)
+                compacted += 1
+
+print(f"Migration complete. {migrated} chat(s) migrated, {compacted} chat log(s) compacted.")
@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+
+# CLI argument parsing
+parser = argparse.ArgumentParser(description='Copy all users and chats from one storage backend to another, '
+                                             'e.g. from the Data/ files to SQLite.')
+parser.add_argument('-from', dest='source', choices=('file', 'sqlite'), default='file',
+                    help='Backend to read from (default: file)')
+parser.add_argument('-to', dest='target', choices=('file', 'sqlite'), default='sqlite',
+                    help='Backend to write to (default: sqlite)')
+parser.add_argument('-db', help='SQLite database path (default: CHATLY_SQLITE_PATH or Data/chatly.db)')
+parser.add_argument('-username', help='Only copy this user (default: all users)')
+
+args = parser.parse_args()
+
+if args.source == args.target:
+    parser.error('-from and -to must be different backends')
+
+# Calculate base path (parent of script directory) and load Chatly from there,
+# so it picks up the same Data/ and Key/ directories as the server
+script_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.abspath(os.path.join(script_dir, '..'))
+if args.db:
+    os.environ['CHATLY_SQLITE_PATH'] = os.path.abspath(args.db)
+os.chdir(base_dir)
+sys.path.insert(0, base_dir)
+
+import chatly
+
+source = chatly.create_storage(args.source)
+target = chatly.create_storage(args.target)
+usernames = [args.username] if args.username else source.list_users()
+
+users = 0
+chats = 0
+for username in usernames:
+    user_data = source.load_user(username)
+    if user_data is None:
+        print(f"Skipping '{username}': user record missing or unreadable.")
+        continue
+
+    # Anything the target already had for this user is replaced
+    target.delete_user_chats(username)
+    target.save_user(username, user_data)
+    target.save_credential(username, source.load_credential(username))
+
+    index = source.load_chat_index(username)
+    copied = 0
+    for chat_id in source.list_chat_ids(username):
+        chat_data = source.load_chat(username, chat_id)
+        if chat_data is None:
+            print(f"  Skipping unreadable chat {username}/{chat_id}.")
+            continue
+        target.write_chat(username, chat_id, chat_data)
+        if chat_id in index:
+            # Keeps the created/updated times, which the chat itself does not record
+            target.update_chat_entry(username, chat_id, index[chat_id])
+        copied += 1
+
+    target.replace_search_records(username, chatly.build_search_records(target, username))
+    print(f"Copied '{username}': {copied} chat(s).")
+    users += 1
+    chats += copied
+
+print(f"Migration complete. {users} user(s) and {chats} chat(s) copied from {args.source} to {args.target}.")
+print(f"Start Chatly with CHATLY_STORAGE={args.target} to use them.")
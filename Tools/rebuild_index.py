@@ -0,0 +1,32 @@
+import argparse
+import os
+import sys
+
+# CLI argument parsing
+parser = argparse.ArgumentParser(description='Rebuild the per-user chat index used to list chats in the sidebar (and optionally the search index).')
+parser.add_argument('-username', help='Only rebuild the index of this user (default: all users)')
+parser.add_argument('-search', action='store_true', help='Also rebuild the full-text search index')
+
+args = parser.parse_args()
+
+# Calculate base path (parent of script directory) and load Chatly from there,
+# so it picks up the same Data/ and Key/ directories as the server
+script_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.abspath(os.path.join(script_dir, '..'))
+os.chdir(base_dir)
+sys.path.insert(0, base_dir)
+
+import chatly
+
+usernames = [args.username] if args.username else chatly.storage.list_users()
+
+for username in usernames:
+    if chatly.storage.load_user(username) is None:
+        print(f"Skipping '{username}': no such user.")
+        continue
+
+    index = chatly.rebuild_chat_index(username)
+    print(f"Rebuilt index for '{username}': {len(index)} chat(s).")
+    if args.search:
+        indexed = chatly.rebuild_search_index(username)
+        print(f"Rebuilt search index for '{username}': {indexed} chat(s).")
@@ -0,0 +1,212 @@
+import argparse
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Key rotation for a running Chatly. With -rotate a new encryption key is made
+# and the old one retired (see KeyRing in chatly.py): every Chatly process
+# switches to the new key for writing within a few seconds and keeps reading
+# the old one. Then all users and chats still encrypted with a retired key are
+# re-encrypted by a pool of worker processes, each chat and user under the same
+# locks Chatly itself takes. Finished items are saved to a progress file, so an
+# interrupted run picks up where it stopped. With -retire the retired keys are
+# deleted once nothing uses them any more.
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+base_dir = os.path.abspath(os.path.join(script_dir, '..'))
+PROGRESS_FILE = os.path.join('Data', 'rotation.progress')
+REPORT_INTERVAL = 1  # Seconds between progress lines (and progress file saves)
+
+# Calculate base path (parent of script directory) and load Chatly from there,
+# so it picks up the same Data/ and Key/ directories as the server
+os.chdir(base_dir)
+sys.path.insert(0, base_dir)
+# The re-encryption runs next to the server, so records are locked across processes
+os.environ['CHATLY_SHARED_STORAGE'] = '1'
+
+storages = {}  # Backend name -> storage, in each worker process
+
+
+def init_worker(backends):
+    # Ctrl+C is handled by the main process, which lets running items finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import chatly
+    for backend in backends:
+        storages[backend] = chatly.create_storage(backend)
+
+
+def reencrypt(item):
+    """Re-encrypt one chat (backend, username, chat_id) or a user's own records (backend, username, None)"""
+    backend, username, chat_id = item
+    if chat_id is None:
+        return storages[backend].reencrypt_user(username)
+    return storages[backend].reencrypt_chat(username, chat_id)
+
+
+def describe(item):
+    backend, username, chat_id = item
+    return f"{backend} user '{username}'" if chat_id is None else f"{backend} chat {username}/{chat_id}"
+
+
+def backends_in_use(chatly):
+    """Every backend holding data, not only the configured one: data left behind
+    by a migration must not become unreadable when the retired keys go"""
+    backends = []
+    if os.path.isdir(chatly.users_dir) and any(file.endswith('.json') for file in os.listdir(chatly.users_dir)):
+        backends.append('file')
+    if os.path.exists(chatly.SQLITE_PATH):
+        backends.append('sqlite')
+    return backends
+
+
+def lock_out_local_locking(chatly):
+    """Take Chatly's local locking file exclusively, so no Chatly process that locks
+    records only within itself runs alongside (see LOCAL_LOCKING_FILE in chatly.py).
+    Returns the open lock file, None if such a process is running"""
+    os.makedirs(chatly.LOCK_DIR, exist_ok=True)
+    lock_file = open(chatly.LOCAL_LOCKING_FILE, 'a')
+    if chatly.fcntl is not None:
+        try:
+            chatly.fcntl.flock(lock_file.fileno(), chatly.fcntl.LOCK_EX | chatly.fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+    return lock_file
+
+
+def load_progress(key, restart):
+    """Items already re-encrypted with this key by an earlier run"""
+    if restart or not os.path.exists(PROGRESS_FILE):
+        return set()
+    with open(PROGRESS_FILE, 'r') as f:
+        progress = json.load(f)
+    if progress.get('key') != key:
+        return set()
+    return {tuple(item) for item in progress.get('done', [])}
+
+
+def save_progress(chatly, key, done):
+    chatly.atomic_write(PROGRESS_FILE, json.dumps({'key': key, 'done': sorted(done, key=str)}))
+
+
+def format_seconds(seconds):
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    return f"{seconds // 60:.0f}m{seconds % 60:02.0f}s"
+
+
+if __name__ == "__main__":
+    # CLI argument parsing
+    parser = argparse.ArgumentParser(description='Rotate the encryption key and re-encrypt everything stored with '
+                                                 'a retired key, while Chatly keeps running.')
+    parser.add_argument('-rotate', action='store_true',
+                        help='Make a new encryption key first; the current one is retired, still read until '
+                             'everything is re-encrypted')
+    parser.add_argument('-retire', action='store_true',
+                        help='Delete the retired keys once everything is re-encrypted with the current one')
+    parser.add_argument('-processes', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes re-encrypting in parallel (default: number of CPUs)')
+    parser.add_argument('-storage', choices=('file', 'sqlite'),
+                        help='Only re-encrypt this storage backend (default: every backend holding data)')
+    parser.add_argument('-db', help='SQLite database path (default: CHATLY_SQLITE_PATH or Data/chatly.db)')
+    parser.add_argument('-restart', action='store_true',
+                        help='Check everything again instead of resuming an interrupted run')
+
+    args = parser.parse_args()
+
+    if args.db:
+        os.environ['CHATLY_SQLITE_PATH'] = os.path.abspath(args.db)
+
+    import chatly
+
+    # Held until the tool exits
+    local_locking = lock_out_local_locking(chatly)
+    if local_locking is None:
+        print("Chatly is running without cross-process locks, so chats it writes during the re-encryption "
+              "could be lost. Restart it with CHATLY_SHARED_STORAGE=1 (or CHATLY_WORKERS above 1), "
+              "or stop it, and run the tool again.")
+        sys.exit(1)
+
+    key_ring = chatly.key_ring
+    backends = [args.storage] if args.storage else backends_in_use(chatly)
+
+    if args.rotate:
+        key_ring.rotate()
+        print(f"New encryption key {chatly.key_id(key_ring.current_key)}, "
+              f"{len(key_ring.retired_keys)} retired key(s) still read.")
+        # Running Chatly processes check the key files this often, after that nothing is written with the old key
+        wait = 2 * chatly.KEY_CHECK_INTERVAL
+        print(f"Waiting {wait}s for running Chatly processes to switch to it...")
+        time.sleep(wait)
+    elif not key_ring.retired_keys:
+        print("There are no retired keys, everything is encrypted with the current one. "
+              "Use -rotate to make a new key.")
+        sys.exit(0)
+
+    key = chatly.key_id(key_ring.current_key)
+    done = load_progress(key, args.restart)
+    items = []
+    for backend in backends:
+        source = chatly.create_storage(backend)
+        for username in source.list_users():
+            items.extend((backend, username, chat_id) for chat_id in source.list_chat_ids(username))
+            items.append((backend, username, None))
+    pending = [item for item in items if item not in done]
+    if len(pending) < len(items):
+        print(f"Resuming: {len(items) - len(pending)} of {len(items)} chats and users were already re-encrypted.")
+
+    rewritten = 0
+    failed = 0
+    finished = 0
+    started = time.monotonic()
+    reported = started
+    interrupted = False
+    with ProcessPoolExecutor(max_workers=max(1, args.processes), initializer=init_worker,
+                             initargs=(backends,)) as pool:
+        futures = {pool.submit(reencrypt, item): item for item in pending}
+        try:
+            for future in as_completed(futures):
+                item = futures[future]
+                finished += 1
+                try:
+                    rewritten += future.result()
+                    done.add(item)
+                except Exception as e:
+                    failed += 1
+                    print(f"Failed to re-encrypt {describe(item)}: {e}")
+
+                now = time.monotonic()
+                if now - reported >= REPORT_INTERVAL or finished == len(pending):
+                    reported = now
+                    save_progress(chatly, key, done)
+                    rate = finished / max(now - started, 1e-9)
+                    print(f"  {len(items) - len(pending) + finished}/{len(items)} chats and users "
+                          f"({100 * finished / len(pending):.0f}%), {rewritten} records re-encrypted, "
+                          f"{rate:.0f}/s, about {format_seconds((len(pending) - finished) / rate)} left")
+        except KeyboardInterrupt:
+            interrupted = True
+            print("Interrupted, waiting for the chats being re-encrypted...")
+            pool.shutdown(cancel_futures=True)
+    save_progress(chatly, key, done)
+
+    if interrupted or failed:
+        if failed:
+            print(f"{failed} chat(s)/user(s) failed.")
+        print("Run the tool again (without -rotate) to resume.")
+        sys.exit(1)
+
+    print(f"Re-encryption complete: {rewritten} records re-encrypted with key {key} "
+          f"in {format_seconds(time.monotonic() - started)}.")
+    skipped = set(backends_in_use(chatly)) - set(backends)
+    if args.retire and skipped:
+        print(f"Not deleting the retired keys: the {', '.join(sorted(skipped))} storage still holds data "
+              f"that was not re-encrypted (leave out -storage).")
+    elif args.retire:
+        key_ring.retire()
+        os.remove(PROGRESS_FILE)
+        print("Retired keys deleted.")
+    else:
+        print("Run with -retire to delete the retired keys.")
@@ -6,6 +6,15 @@ let typingTimer = null;
 let isGenerating = false;
 let currentConfirmCallback = null; // For custom confirm dialog
 let isAuthenticated = false; // Flag to track if user is authenticated
+const CHAT_PAGE_SIZE = 50; // Messages loaded when opening a chat, and per "load older" step
+let olderMessagesCursor = null; // Index of the oldest loaded message while older ones remain
+let loadingOlderMessages = false;
+let activeGeneration = null; // { chatId, jobId } of the reply being streamed, for the stop button
+const STREAM_RESUME_ATTEMPTS = 5; // Reconnects to a reply whose stream dropped before it was done
+const SETTINGS_SAVE_DELAY = 400; // Settings changed within this many ms of each other are saved in one request
+let pendingSettings = {}; // Settings changes not sent yet
+let pendingSettingsTimer = null;
+let pendingSettingsCallbacks = [];
 
 // DOM Elements
 const authModal = document.getElementById('auth-modal');
@@ -906,23 +915,30 @@ function loadChat(chatId) {
     const allButtons = document.querySelectorAll('button');
     allButtons.forEach(btn => btn.disabled = true);
 
-    fetch(`/api/get_chat/${chatId}`, { credentials: 'include' })
+    olderMessagesCursor = null;
+    fetch(`/api/get_chat/${chatId}?limit=${CHAT_PAGE_SIZE}`, { credentials: 'include' })
     .then(response => response.json())
     .then(data => {
         if (data.success) {
             currentChatTitle.textContent = data.chat.title;
+            olderMessagesCursor = data.page && data.page.has_more ? data.page.start : null;
             
             // Check if the chat has any messages
             if (data.chat.messages && data.chat.messages.length > 0) {
                 // Has messages, hide welcome screen
                 welcomeScreen.style.display = 'none';
                 data.chat.messages.forEach(addMessageToUI);
+            } else if (data.generation) {
+                welcomeScreen.style.display = 'none';
             } else {
                 // Empty chat, show welcome screen inside the messages container
                 welcomeScreen.style.display = 'flex';
                 welcomeScreen.classList.add('in-conversation');
             }
             
+            // A reply still being generated, e.g. the page was reloaded mid-answer
+            if (data.generation) resumeGeneration(chatId, data.generation);
+            
             scrollToBottom();
             
             // Initialize input area after chat is loaded
@@ -1231,23 +1247,9 @@ function sendMessageToServer(message, fileContent = null, fileName = null) {
         payload.file_name = fileName;
     }
     
-    fetch('/api/send_message', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify(payload),
-        credentials: 'include'
-    })
-    .then(response => response.json())
+    streamChatResponse(payload)
     .then(data => {
-        // Remove typing indicator before adding AI response
-        removeTypingIndicator();
-        
         if (data.success) {
-            // Add the assistant's message to the UI
-            addMessageToUI(data.message);
-            
             // Update chat title if provided in the response
             if (data.title) {
                 // Update the title in the UI
@@ -1286,7 +1288,217 @@ function sendMessageToServer(message, fileContent = null, fileName = null) {
     });
 }
 
-function addMessageToUI(message) {
+// Post a message to /api/send_message_stream and render the reply token by token.
+// Resolves with the final "done" event ({ success, message, title }).
+async function streamChatResponse(payload, jobId = null) {
+    // Regenerating while a reply is still streaming: stop that one first
+    if (!jobId && activeGeneration && activeGeneration.chatId === payload.chat_id) {
+        cancelGeneration();
+    }
+    const generation = { chatId: payload.chat_id, jobId };
+    activeGeneration = generation;
+    try {
+        return await readChatStream(payload, generation);
+    } finally {
+        if (activeGeneration === generation) {
+            activeGeneration = null;
+            hideStopButton();
+        }
+    }
+}
+
+// Reattach to a reply that is still being generated (see /api/get_chat's "generation"),
+// e.g. after the page was reloaded mid-answer
+function resumeGeneration(chatId, generationInfo) {
+    addMessageToUI(generationInfo.message);
+    showTypingIndicator();
+    streamChatResponse({ chat_id: chatId }, generationInfo.job_id)
+    .then(data => {
+        if (data.success) scrollToBottom();
+    })
+    .catch(err => {
+        console.error('Error resuming response:', err);
+        removeTypingIndicator();
+    });
+}
+
+async function readChatStream(payload, generation) {
+    const stream = { content: '', tokens: 0, messageDiv: null, renderPending: false, result: null };
+    
+    // The reply is generated by a server-side job: when the connection drops before it is
+    // done (a flaky network, a proxy timeout), reattach and continue from the tokens we have
+    for (let attempt = 0; ; attempt++) {
+        const resuming = generation.jobId !== null;
+        let response = null;
+        try {
+            response = await fetch(resuming ? '/api/resume_generation' : '/api/send_message_stream', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify(resuming
+                    ? { chat_id: generation.chatId, job_id: generation.jobId, offset: stream.tokens }
+                    : payload),
+                credentials: 'include'
+            });
+        } catch (error) {
+            if (!resuming) throw error;
+        }
+        
+        if (response && resuming && response.status === 404) {
+            // The job is gone, its reply has been saved with the chat
+            removeTypingIndicator();
+            if (currentChatId === generation.chatId) loadChat(generation.chatId);
+            return { success: true };
+        }
+        // Errors (not logged in, missing fields) come back as a plain JSON body
+        if (response && (!response.ok || !response.body)) {
+            removeTypingIndicator();
+            const data = await response.json().catch(() => ({}));
+            return { success: false, message: data.message };
+        }
+        
+        if (response) {
+            try {
+                await readStreamEvents(response, generation, stream);
+            } catch (error) {
+                console.error('Reply stream interrupted:', error);
+            }
+        }
+        if (stream.result || !generation.jobId || attempt >= STREAM_RESUME_ATTEMPTS) break;
+        await new Promise(resolve => setTimeout(resolve, Math.min(1000 * 2 ** attempt, 8000)));
+    }
+    
+    if (!stream.result) {
+        removeTypingIndicator();
+        return { success: false };
+    }
+    return stream.result;
+}
+
+async function readStreamEvents(response, generation, stream) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    
+    const render = () => {
+        stream.renderPending = false;
+        updateStreamingMessage(stream.messageDiv, stream.content);
+    };
+    
+    const handleEvent = (event) => {
+        if (event.type === 'start') {
+            generation.jobId = event.job_id;
+            if (activeGeneration === generation) showStopButton();
+        } else if (event.type === 'queued') {
+            showQueuePosition(event.position);
+        } else if (event.type === 'token') {
+            stream.content += event.content;
+            stream.tokens++;
+            if (!stream.messageDiv) {
+                // First token: swap the typing indicator for the reply bubble
+                removeTypingIndicator();
+                stream.messageDiv = addMessageToUI({ role: 'assistant', content: '' });
+            }
+            // Re-render at most once per frame, markdown parsing is not free
+            if (!stream.renderPending) {
+                stream.renderPending = true;
+                requestAnimationFrame(render);
+            }
+        } else if (event.type === 'done') {
+            if (!stream.messageDiv) {
+                removeTypingIndicator();
+                stream.messageDiv = addMessageToUI({ role: 'assistant', content: '' });
+            }
+            stream.content = event.message.content;
+            render();
+            stream.messageDiv.classList.toggle('message-cancelled', !!event.message.cancelled);
+            stream.messageDiv.querySelectorAll('pre code').forEach(block => hljs.highlightElement(block));
+            stream.result = { success: true, message: event.message, title: event.title };
+        } else if (event.type === 'dropped') {
+            // Cancelled before anything was generated: the turn was not saved
+            removeTypingIndicator();
+            if (stream.messageDiv) stream.messageDiv.remove();
+            if (currentChatId === generation.chatId) loadChat(generation.chatId);
+            stream.result = { success: true };
+        }
+    };
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        let newlineIndex;
+        while ((newlineIndex = buffer.indexOf('\n')) !== -1) {
+            const line = buffer.slice(0, newlineIndex).trim();
+            buffer = buffer.slice(newlineIndex + 1);
+            if (line) handleEvent(JSON.parse(line));
+        }
+    }
+    if (buffer.trim()) handleEvent(JSON.parse(buffer));
+}
+
+// Stop the reply being streamed. The server closes its request to Ollama and ends the
+// stream with a "done" event carrying whatever was generated so far.
+function cancelGeneration() {
+    if (!activeGeneration) return;
+    const { chatId, jobId } = activeGeneration;
+    hideStopButton();
+    fetch('/api/cancel_generation', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        // Before the "start" event arrives the job id is not known yet
+        body: JSON.stringify(jobId ? { job_id: jobId } : { chat_id: chatId }),
+        credentials: 'include'
+    }).catch(error => console.error('Error cancelling generation:', error));
+}
+
+// "Stop generating" button shown above the input area while a reply streams
+function showStopButton() {
+    if (document.getElementById('stop-generation-btn')) return;
+    const inputContainer = document.querySelector('.input-container');
+    if (!inputContainer) return;
+    const stopBtn = document.createElement('button');
+    stopBtn.id = 'stop-generation-btn';
+    stopBtn.className = 'stop-generation-btn';
+    stopBtn.innerHTML = '<i class="fas fa-stop"></i> Stop generating';
+    stopBtn.addEventListener('click', cancelGeneration);
+    inputContainer.insertAdjacentElement('beforebegin', stopBtn);
+}
+
+function hideStopButton() {
+    const stopBtn = document.getElementById('stop-generation-btn');
+    if (stopBtn) stopBtn.remove();
+}
+
+// Show the queue position next to the typing indicator while waiting for a free model slot
+function showQueuePosition(position) {
+    const indicator = document.getElementById('typing-indicator');
+    if (!indicator) return;
+    
+    let label = indicator.querySelector('.queue-position');
+    if (!label) {
+        label = document.createElement('small');
+        label.className = 'queue-position';
+        indicator.appendChild(label);
+    }
+    label.textContent = position > 0 ? `Waiting in queue (position ${position})` : '';
+}
+
+// Replace the content of a message bubble that is still being streamed
+function updateStreamingMessage(messageDiv, content) {
+    if (!messageDiv) return;
+    messageDiv.dataset.rawContent = content;
+    const processedContent = content
+        .replace(/<think>(.*?)<\/think>/gs, '<div class="think-box">$1</div>');
+    messageDiv.querySelector('.message-content').innerHTML = marked.parse(processedContent);
+    scrollToBottom();
+}
+
+function addMessageToUI(message, prepend = false) {
     // If this is the first message, hide the welcome screen
     if (messagesDiv.children.length === 0 || messagesDiv.querySelector('.message') === null) {
         welcomeScreen.style.display = 'none';
@@ -1297,6 +1509,7 @@ function addMessageToUI(message) {
     
     const messageDiv = document.createElement('div');
     messageDiv.className = `message message-${message.role}`;
+    if (message.cancelled) messageDiv.classList.add('message-cancelled');
     
     // Always store the raw content for both user and AI messages
     messageDiv.dataset.rawContent = message.content;
@@ -1327,6 +1540,13 @@ function addMessageToUI(message) {
         </div>
     `;
     
+    if (prepend) {
+        // Older messages go above the ones already shown, without scrolling away
+        messagesDiv.insertBefore(messageDiv, messagesDiv.firstChild);
+        messageDiv.querySelectorAll('pre code').forEach(block => hljs.highlightElement(block));
+        return messageDiv;
+    }
+    
     messagesDiv.appendChild(messageDiv);
     messageDiv.querySelectorAll('pre code').forEach(block => hljs.highlightElement(block));
     
@@ -1338,6 +1558,32 @@ function addMessageToUI(message) {
     
     // Scroll to the latest message
     scrollToBottom();
+    
+    return messageDiv;
+}
+
+// Load the previous page of the open chat when scrolled to the top
+function loadOlderMessages() {
+    if (olderMessagesCursor === null || loadingOlderMessages || !currentChatId) return;
+    
+    const chatId = currentChatId;
+    loadingOlderMessages = true;
+    fetch(`/api/get_chat/${chatId}?limit=${CHAT_PAGE_SIZE}&before=${olderMessagesCursor}`, { credentials: 'include' })
+    .then(response => response.json())
+    .then(data => {
+        if (!data.success || chatId !== currentChatId) return;
+        
+        // Keep the messages on screen where they are while content is added above them
+        const previousHeight = messagesContainer.scrollHeight;
+        data.chat.messages.slice().reverse().forEach(message => addMessageToUI(message, true));
+        messagesContainer.scrollTop += messagesContainer.scrollHeight - previousHeight;
+        
+        olderMessagesCursor = data.page.has_more ? data.page.start : null;
+    })
+    .catch(error => console.error('Error loading older messages:', error))
+    .finally(() => {
+        loadingOlderMessages = false;
+    });
 }
 
 function showTypingIndicator() {
@@ -1558,11 +1804,13 @@ function deleteChat(chatId) {
                         });
                         
                         // Load selected chat
-                        fetch(`/api/get_chat/${currentChatId}`, { credentials: 'include' })
+                        olderMessagesCursor = null;
+                        fetch(`/api/get_chat/${currentChatId}?limit=${CHAT_PAGE_SIZE}`, { credentials: 'include' })
                         .then(response => response.json())
                         .then(chatData => {
                             if (chatData.success) {
                                 currentChatTitle.textContent = chatData.chat.title;
+                                olderMessagesCursor = chatData.page && chatData.page.has_more ? chatData.page.start : null;
                                 chatData.chat.messages.forEach(addMessageToUI);
                                 scrollToBottom();
                                 
@@ -1739,6 +1987,53 @@ function clearAllChats() {
 }
 
 // Settings functions
+// Save settings changes. Changes made in quick succession (e.g. toggling the
+// theme back and forth) are merged and sent in one request once they stop for
+// SETTINGS_SAVE_DELAY ms; `immediate` sends them, and anything pending, right
+// away. Resolves with the server's answer, whose `settings` are the fields
+// that actually changed.
+function saveSettings(changes, immediate = false) {
+    Object.assign(pendingSettings, changes);
+    clearTimeout(pendingSettingsTimer);
+    pendingSettingsTimer = setTimeout(flushSettings, immediate ? 0 : SETTINGS_SAVE_DELAY);
+    return new Promise((resolve, reject) => pendingSettingsCallbacks.push({ resolve, reject }));
+}
+
+function flushSettings() {
+    const settings = pendingSettings;
+    const callbacks = pendingSettingsCallbacks;
+    pendingSettings = {};
+    pendingSettingsCallbacks = [];
+    pendingSettingsTimer = null;
+
+    fetch('/api/update_settings', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(settings),
+        credentials: 'include'
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success && currentUser) {
+            // Everything sent is now stored, changed or not
+            Object.assign(currentUser, settings);
+        }
+        callbacks.forEach(callback => callback.resolve(data));
+    })
+    .catch(err => callbacks.forEach(callback => callback.reject(err)));
+}
+
+// Changes still waiting when the page goes away are sent anyway
+window.addEventListener('pagehide', () => {
+    if (pendingSettingsTimer !== null) {
+        clearTimeout(pendingSettingsTimer);
+        navigator.sendBeacon('/api/update_settings',
+            new Blob([JSON.stringify(pendingSettings)], { type: 'application/json' }));
+        pendingSettings = {};
+        pendingSettingsTimer = null;
+    }
+});
+
 function updateSettings(event) {
     event.preventDefault();
     const theme = themeSelect.value;
@@ -1798,17 +2093,9 @@ function updateSettings(event) {
     };
 
     // Save all settings
-    fetch('/api/update_settings', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(settingsToSave),
-        credentials: 'include'
-    })
-    .then(response => response.json())
+    saveSettings(settingsToSave, true)
     .then(data => {
         if (data.success) {
-            currentUser = data.user;
-            
             // Apply theme transition effect for smooth changes
             document.body.classList.add('theme-transition');
             
@@ -2166,6 +2453,20 @@ function setupEventListeners() {
     
     // Delete account button
     document.getElementById('delete-account-btn')?.addEventListener('click', deleteAccount);
+    
+    // Model benchmark button
+    document.getElementById('run-benchmark-btn')?.addEventListener('click', runModelBenchmark);
+    
+    // Load older messages when scrolling to the top of a long chat
+    messagesContainer.addEventListener('scroll', () => {
+        if (messagesContainer.scrollTop < 100) {
+            loadOlderMessages();
+        }
+    });
+    
+    // Chat search
+    document.getElementById('search-chats-btn')?.addEventListener('click', showSearchModal);
+    document.getElementById('search-chats-input')?.addEventListener('input', onSearchInput);
 
     // Confirmation dialog
     confirmOkBtn.addEventListener('click', () => {
@@ -2295,6 +2596,8 @@ function setupSettingsTabNavigation() {
                 
                 // Special case for model section - make sure sliders are initialized
                 if (target === 'model') {
+                    loadModelBenchmarks();
+                    
                     // Ensure model is selected correctly
                     const modelSelect = document.getElementById('model-select');
                     if (modelSelect && currentUser && currentUser.model) {
@@ -2565,93 +2868,171 @@ function toggleCompactSidebar(enabled) {
 }
 
 // Export chat history functionality
-function exportChatHistory() {
-    showToast('Preparing export...', 'info');
-    
-    // Fetch all chats for the user
-    fetch('/api/get_chats', { credentials: 'include' })
+// Full-text chat search
+let searchDebounceTimer = null;
+let searchRequestId = 0;
+
+function showSearchModal() {
+    const searchModal = document.getElementById('search-modal');
+    const input = document.getElementById('search-chats-input');
+    showModal(searchModal);
+    input.value = '';
+    document.getElementById('search-results').innerHTML = '';
+    setTimeout(() => input.focus(), 50);
+}
+
+function onSearchInput(event) {
+    clearTimeout(searchDebounceTimer);
+    const query = event.target.value.trim();
+    if (!query) {
+        document.getElementById('search-results').innerHTML = '';
+        return;
+    }
+    searchDebounceTimer = setTimeout(() => searchChats(query), 200);
+}
+
+function searchChats(query) {
+    // Ignore answers to queries that have been typed over since
+    const requestId = ++searchRequestId;
+    fetch(`/api/search_chats?q=${encodeURIComponent(query)}`, { credentials: 'include' })
     .then(response => response.json())
-    .then(async data => {
-        if (!data.success || !data.chats || data.chats.length === 0) {
-            showToast('No chats to export', 'error');
-            return;
+    .then(data => {
+        if (requestId !== searchRequestId || !data.success) return;
+        renderSearchResults(data.results);
+    })
+    .catch(error => console.error('Error searching chats:', error));
+}
+
+function renderSearchResults(results) {
+    const container = document.getElementById('search-results');
+    container.innerHTML = '';
+    
+    if (results.length === 0) {
+        const empty = document.createElement('p');
+        empty.className = 'search-empty';
+        empty.textContent = 'No matching chats.';
+        container.appendChild(empty);
+        return;
+    }
+    
+    results.forEach(result => {
+        const item = document.createElement('div');
+        item.className = 'search-result';
+        
+        const title = document.createElement('div');
+        title.className = 'search-result-title';
+        title.textContent = result.title;
+        item.appendChild(title);
+        
+        if (result.snippet) {
+            const snippet = document.createElement('div');
+            snippet.className = 'search-result-snippet';
+            snippet.textContent = result.snippet;
+            item.appendChild(snippet);
         }
         
-        try {
-            // Create a text file for each chat
-            const files = [];
-            
-            for (const chat of data.chats) {
-                // Fetch full chat data with messages
-                const chatResponse = await fetch(`/api/get_chat/${chat.id}`, { credentials: 'include' });
-                const chatData = await chatResponse.json();
-                
-                if (chatData.success && chatData.chat) {
-                    let chatContent = `# ${chatData.chat.title}\n`;
-                    chatContent += `Exported: ${new Date().toLocaleString()}\n\n`;
-                    
-                    // Add messages
-                    chatData.chat.messages.forEach(msg => {
-                        chatContent += `## ${msg.role === 'user' ? 'User' : 'Assistant'} - ${new Date(msg.timestamp * 1000).toLocaleString()}\n\n`;
-                        chatContent += msg.content + '\n\n';
-                        chatContent += '---\n\n';
-                    });
-                    
-                    files.push({
-                        name: `${chatData.chat.title.replace(/[^a-z0-9]/gi, '_').toLowerCase()}.md`,
-                        content: chatContent
-                    });
-                }
-            }
-            
-            // Create a summary file
-            let summaryContent = `# Chatly Export\n`;
-            summaryContent += `Exported: ${new Date().toLocaleString()}\n`;
-            summaryContent += `User: ${currentUser.username}\n\n`;
-            summaryContent += `Total Chats: ${files.length}\n\n`;
-            summaryContent += `## Chats\n`;
-            
-            files.forEach(file => {
-                summaryContent += `- ${file.name}\n`;
-            });
-            
-            files.push({
-                name: 'summary.md',
-                content: summaryContent
-            });
-            
-            // Use JSZip to create a zip file
-            const zip = new JSZip();
-            
-            // Add files to the zip
-            files.forEach(file => {
-                zip.file(file.name, file.content);
-            });
-            
-            // Generate the zip file
-            zip.generateAsync({ type: 'blob' })
-            .then(blob => {
-                // Create a download link
-                const link = document.createElement('a');
-                link.href = URL.createObjectURL(blob);
-                link.download = `chatly_export_${Date.now()}.zip`;
-                
-                // Trigger the download
-                document.body.appendChild(link);
-                link.click();
-                document.body.removeChild(link);
-                
-                showToast('Export complete!', 'success');
-            });
-        } catch (error) {
-            console.error('Export error:', error);
-            showToast('Failed to export chats', 'error');
+        item.addEventListener('click', () => {
+            document.getElementById('search-modal').classList.remove('active');
+            loadChat(result.chat_id);
+            renderChatList();
+        });
+        container.appendChild(item);
+    });
+}
+
+// Model benchmarks shown in the model settings section
+let benchmarkPollTimer = null;
+
+function loadModelBenchmarks() {
+    fetch('/api/system/benchmark', { credentials: 'include' })
+    .then(response => response.json())
+    .then(data => {
+        if (!data.success) return;
+        renderModelBenchmarks(data.results, data.state);
+        
+        // Poll while a run is in progress so results appear as each model finishes
+        clearTimeout(benchmarkPollTimer);
+        if (data.state.running) {
+            benchmarkPollTimer = setTimeout(loadModelBenchmarks, 2000);
         }
     })
-    .catch(err => {
-        console.error('Export error:', err);
-        showToast('Failed to export chats', 'error');
+    .catch(error => console.error('Error loading benchmarks:', error));
+}
+
+function renderModelBenchmarks(results, state) {
+    const tbody = document.querySelector('#benchmark-table tbody');
+    const status = document.getElementById('benchmark-status');
+    const button = document.getElementById('run-benchmark-btn');
+    if (!tbody) return;
+    
+    const formatSeconds = value => value === null || value === undefined ? '-' : `${value.toFixed(2)}s`;
+    const rows = Object.values(results).sort((a, b) => (b.tokens_per_second || 0) - (a.tokens_per_second || 0));
+    tbody.innerHTML = '';
+    rows.forEach(result => {
+        const row = document.createElement('tr');
+        const cells = result.error
+            ? [result.model, 'Failed', '-', '-', '-']
+            : [
+                result.model,
+                formatSeconds(result.load_seconds),
+                formatSeconds(result.ttft_seconds),
+                result.tokens_per_second ? result.tokens_per_second.toFixed(1) : '-',
+                result.memory_bytes ? `${(result.memory_bytes / 2 ** 30).toFixed(2)} GB` : '-'
+            ];
+        cells.forEach(text => {
+            const cell = document.createElement('td');
+            cell.textContent = text;
+            row.appendChild(cell);
+        });
+        if (result.error) row.title = result.error;
+        tbody.appendChild(row);
     });
+    
+    if (state.running) {
+        status.textContent = `Benchmarking ${state.current || '...'} (${state.done}/${state.total})`;
+    } else {
+        status.textContent = rows.length ? '' : 'No benchmarks yet.';
+    }
+    if (button) button.disabled = state.running;
+}
+
+function runModelBenchmark() {
+    fetch('/api/system/benchmark', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({}),
+        credentials: 'include'
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (!data.success) {
+            showToast(data.message || 'Could not start the benchmark', 'error');
+            return;
+        }
+        showToast('Benchmark started, this can take a few minutes', 'info');
+        setTimeout(loadModelBenchmarks, 500);
+    })
+    .catch(error => {
+        console.error('Error starting benchmark:', error);
+        showToast('Could not start the benchmark', 'error');
+    });
+}
+
+function exportChatHistory() {
+    if (!chats || chats.length === 0) {
+        showToast('No chats to export', 'error');
+        return;
+    }
+    
+    // The server streams the ZIP as it is written, so the browser downloads it directly
+    const link = document.createElement('a');
+    link.href = '/api/export';
+    link.download = `chatly_export_${Date.now()}.zip`;
+    document.body.appendChild(link);
+    link.click();
+    document.body.removeChild(link);
+    
+    showToast('Export started', 'success');
 }
 
 // Delete account functionality
@@ -2772,18 +3153,10 @@ function resetSettings() {
     resetBtn.disabled = true;
     
     // Save to server
-    fetch('/api/update_settings', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(defaultSettings),
-        credentials: 'include'
-    })
-    .then(response => response.json())
+    saveSettings(defaultSettings, true)
     .then(data => {
         if (data.success) {
             // Apply all settings
-            currentUser = data.user;
-            
             // Update UI with new settings
             applyTheme(defaultSettings.theme);
             document.body.setAttribute('data-theme', defaultSettings.colorTheme);
@@ -3239,14 +3612,8 @@ function toggleTheme() {
             settingsToUpdate.colorTheme = 'blue';
         }
         
-        // Save to server
-        fetch('/api/update_settings', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(settingsToUpdate),
-            credentials: 'include'
-        })
-        .then(response => response.json())
+        // Save to server, together with any other toggles made right after
+        saveSettings(settingsToUpdate)
         .then(data => {
             if (!data.success) {
                 console.warn('Failed to save theme preference');
@@ -3408,21 +3775,13 @@ function regenerateResponse(message) {
     showTypingIndicator();
     
     // Resend the last user message
-    fetch('/api/send_message', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ 
-            chat_id: currentChatId, 
-            message: lastUserMessage,
-            regenerate: true
-        }),
-        credentials: 'include'
+    streamChatResponse({ 
+        chat_id: currentChatId, 
+        message: lastUserMessage,
+        regenerate: true
     })
-    .then(response => response.json())
     .then(data => {
-        removeTypingIndicator();
         if (data.success) {
-            addMessageToUI(data.message);
             scrollToBottom();
         } else {
             showToast('Failed to regenerate response', 'error');
@@ -3616,23 +3975,13 @@ function createMessageActions(message, messageDiv) {
             messageDiv.remove();
             
             // Send regeneration request
-            fetch('/api/send_message', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({
-                    chat_id: currentChatId,
-                    message: userMessage,
-                    regenerate: true
-                }),
-                credentials: 'include'
+            streamChatResponse({
+                chat_id: currentChatId,
+                message: userMessage,
+                regenerate: true
             })
-            .then(response => response.json())
             .then(data => {
-                removeTypingIndicator();
                 if (data.success) {
-                    addMessageToUI(data.message);
                     scrollToBottom();
                 } else {
                     showToast('Failed to regenerate response', 'error');
@@ -3813,20 +4162,9 @@ document.addEventListener('click', function(e) {
             messageElement.remove();
             
             // Send regeneration request to server
-            fetch('/api/send_message', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify(payload),
-                credentials: 'include'
-            })
-            .then(response => response.json())
+            streamChatResponse(payload)
             .then(data => {
-                removeTypingIndicator();
                 if (data.success) {
-                    // Add the message to the UI
-                    addMessageToUI(data.message);
                     scrollToBottom();
                 } else {
                     showToast(data.message || 'Failed to regenerate response', 'error');
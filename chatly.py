@@ -1,16 +1,46 @@
-from flask import Flask, request, jsonify, session, send_from_directory, make_response
+from flask import Flask, Response, request, jsonify, session, send_from_directory, make_response, g
 from flask_cors import CORS
 import os
 import json
+import copy
 import uuid
+import hashlib
+import hmac
+import base64
+import math
+import re
 import time
+import threading
+import zipfile
+import sqlite3
+import logging
+import logging.handlers
+import queue
+import sys
+import atexit
+import signal
+import socket
 import requests
-from cryptography.fernet import Fernet
+from requests.adapters import HTTPAdapter
+from werkzeug.middleware.proxy_fix import ProxyFix
+from collections import OrderedDict
+from contextlib import contextmanager
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows: locks only cover one process, see KeyedLocks
 
 app = Flask(__name__, static_folder=".")
-app.secret_key = os.urandom(24)
 CORS(app, supports_credentials=True)
 
+# Behind reverse proxies the client address (rate limits, logs) and scheme come
+# from the X-Forwarded-For/-Proto headers, set by this many trusted proxies
+TRUSTED_PROXIES = int(os.environ.get("CHATLY_TRUSTED_PROXIES", 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
 # Add cache control headers to prevent caching issues
 @app.after_request
 def add_cache_control(response):
@@ -24,176 +54,3046 @@ def add_cache_control(response):
 DEFAULT_MODEL = "gemma3:1b"
 
 # Mock mode for development without Ollama
-MOCK_MODE = False  # Set to True to use mock responses instead of Ollama
+MOCK_MODE = False  # Set to True to start with mock responses instead of Ollama, see set_mock_mode
+
+# Logging. Records are handed to a queue and written to stdout by a background
+# thread, so a slow pipe never stalls a request. CHATLY_LOG_FORMAT=json emits one
+# JSON object per line with the structured fields (user, chat_id, model, ...).
+LOG_LEVEL = os.environ.get("CHATLY_LOG_LEVEL", "INFO").upper()
+UNKNOWN_LOG_LEVEL = None if isinstance(logging.getLevelName(LOG_LEVEL), int) else LOG_LEVEL
+if UNKNOWN_LOG_LEVEL:
+    LOG_LEVEL = "INFO"  # Warned about once logging is set up
+LOG_FORMAT = os.environ.get("CHATLY_LOG_FORMAT", "text")
+LOG_CHUNKS = os.environ.get("CHATLY_LOG_CHUNKS", "0") == "1"  # Log every streamed chunk (very verbose)
+
+STANDARD_LOG_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+def log_fields(record):
+    """The structured fields passed to a log call with extra={...}"""
+    return {key: value for key, value in vars(record).items() if key not in STANDARD_LOG_ATTRIBUTES}
+
+class JSONLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **log_fields(record)
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = log_fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+log_listener = None
+
+def setup_logging():
+    """Also called again in forked workers, whose copy of the listener thread did not survive the fork"""
+    global log_listener
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JSONLogFormatter())
+    else:
+        handler.setFormatter(TextLogFormatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+    
+    log_queue = queue.SimpleQueue()
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    
+    logger = logging.getLogger("chatly")
+    logger.setLevel(LOG_LEVEL)
+    logger.handlers.clear()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+    # Chunk logging goes through its own logger so it can be switched on separately
+    logging.getLogger("chatly.chunks").setLevel(logging.DEBUG if LOG_CHUNKS else logging.WARNING)
+    return logger
+
+log = setup_logging()
+chunk_log = logging.getLogger("chatly.chunks")
+if UNKNOWN_LOG_LEVEL:
+    log.warning("Unknown CHATLY_LOG_LEVEL %r, logging at INFO", UNKNOWN_LOG_LEVEL)
+
+# Ollama backend. Every call goes through one keep-alive session so requests
+# reuse pooled connections instead of opening a new TCP connection each time.
+OLLAMA_URL = os.environ.get("CHATLY_OLLAMA_URL", "http://127.0.0.1:11434").rstrip("/")
+OLLAMA_POOL_SIZE = int(os.environ.get("CHATLY_OLLAMA_POOL_SIZE", 32))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("CHATLY_OLLAMA_CONNECT_TIMEOUT", 5))
+OLLAMA_READ_TIMEOUT = float(os.environ.get("CHATLY_OLLAMA_READ_TIMEOUT", 30))  # Max wait between two chunks
+OLLAMA_STATUS_TIMEOUT = float(os.environ.get("CHATLY_OLLAMA_STATUS_TIMEOUT", 2))
+
+def create_ollama_session(pool_size=OLLAMA_POOL_SIZE):
+    ollama_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    ollama_session.mount("http://", adapter)
+    ollama_session.mount("https://", adapter)
+    return ollama_session
+
+ollama_session = create_ollama_session()
+
+# Metrics, exposed in the Prometheus text format by /api/system/metrics
+METRICS_PUBLIC = os.environ.get("CHATLY_METRICS_PUBLIC", "0") == "1"  # Otherwise only logged-in users
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STORAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 35, 50, 75, 100, 150, 200, 500)
+
+class Metric:
+    """A counter, gauge or histogram with labels"""
+    def __init__(self, name, help_text, metric_type, buckets=None):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.buckets = buckets
+        self.values = {}  # sorted label items -> value, or [bucket counts, sum, count]
+        self.callback = None
+        self.lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+    
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+    
+    def set_callback(self, callback):
+        """Compute the values at scrape time: callback() returns [(labels dict, value), ...]"""
+        self.callback = callback
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        if self.callback:
+            values = {tuple(sorted(labels.items())): value for labels, value in self.callback()}
+        else:
+            with self.lock:
+                values = {key: (list(value[0]), value[1], value[2]) if self.buckets else value
+                          for key, value in self.values.items()}
+        
+        for key, value in sorted(values.items()):
+            if not self.buckets:
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+                continue
+            counts, total, count = value
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', str(bound)),))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return "\n".join(lines)
+
+def format_labels(items):
+    if not items:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in items)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + "}"
+
+metrics = {}
+
+def register_metric(name, help_text, metric_type, buckets=None):
+    metrics[name] = Metric(name, help_text, metric_type, buckets)
+    return metrics[name]
 
-# Directories setup
+http_requests = register_metric("chatly_http_requests_total", "HTTP requests by route, method and status", "counter")
+http_latency = register_metric("chatly_http_request_duration_seconds", "Time to produce the response (headers for streams)", "histogram", LATENCY_BUCKETS)
+ollama_ttft = register_metric("chatly_ollama_time_to_first_token_seconds", "Time from sending a generation to its first token", "histogram", LATENCY_BUCKETS)
+ollama_generation_time = register_metric("chatly_ollama_generation_seconds", "Total generation time", "histogram", LATENCY_BUCKETS)
+ollama_tokens_per_second = register_metric("chatly_ollama_tokens_per_second", "Generation speed reported by Ollama", "histogram", RATE_BUCKETS)
+ollama_tokens = register_metric("chatly_ollama_generated_tokens_total", "Tokens generated", "counter")
+ollama_generations = register_metric("chatly_ollama_generations_total", "Generations completed", "counter")
+storage_latency = register_metric("chatly_storage_seconds", "Storage work by operation (read, write, encrypt, decrypt)", "histogram", STORAGE_BUCKETS)
+queue_waiting = register_metric("chatly_generation_queue_waiting", "Generations waiting for a slot", "gauge")
+queue_running = register_metric("chatly_generation_in_flight", "Generations running", "gauge")
+cache_lookups = register_metric("chatly_cache_lookups_total", "Cache lookups by cache and result", "counter")
+cache_bytes = register_metric("chatly_cache_bytes", "Bytes held by each cache", "gauge")
+models_resident = register_metric("chatly_model_resident", "Models Chatly expects Ollama to keep loaded", "gauge")
+generations_cancelled = register_metric("chatly_generations_cancelled_total", "Generations stopped before the end, by reason", "counter")
+logins = register_metric("chatly_logins_total", "Login attempts by result (ok, failed, throttled)", "counter")
+
+@contextmanager
+def timed(metric, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric.observe(time.perf_counter() - started, **labels)
+
+def observe_ollama_stats(model, stats):
+    """Record the metrics of one finished generation (see stream_with_ollama's stats)"""
+    ollama_generations.inc(model=model)
+    if "first_token_seconds" in stats:
+        ollama_ttft.observe(stats["first_token_seconds"], model=model)
+    if "generation_seconds" in stats:
+        ollama_generation_time.observe(stats["generation_seconds"], model=model)
+    if stats.get("eval_count"):
+        ollama_tokens.inc(stats["eval_count"], model=model)
+        if stats.get("eval_duration"):
+            ollama_tokens_per_second.observe(stats["eval_count"] / (stats["eval_duration"] / 1e9), model=model)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if "request_started" in g:
+        http_latency.observe(time.perf_counter() - g.request_started, route=route, method=request.method)
+    http_requests.inc(route=route, method=request.method, status=response.status_code)
+    return response
+
+# Directories of the file storage backend
 users_dir = "Data/users"
 chats_dir = "Data/chats"
-
-os.makedirs(users_dir, exist_ok=True)
-os.makedirs(chats_dir, exist_ok=True)
+credentials_file = "Data/credentials.index"
 
 # Setup encryption
-def get_encryption_key():
-    key_file = "Key/encryption.key"
-    if os.path.exists(key_file):
+def load_or_create_key(key_file, generate):
+    """Read a key file, creating it first if needed (exclusively, in case several workers start at once)"""
+    try:
+        descriptor = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
         with open(key_file, "rb") as f:
             return f.read()
-    else:
-        key = Fernet.generate_key()
-        with open(key_file, "wb") as f:
-            f.write(key)
-        return key
+    key = generate()
+    with os.fdopen(descriptor, "wb") as f:
+        f.write(key)
+    return key
+
+def write_key_file(key_file, keys):
+    """Replace a key file with one key per line, readable by the owner only"""
+    temp_file = f"{key_file}.{os.getpid()}.tmp"
+    descriptor = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "wb") as f:
+        f.write(b"\n".join(keys))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, key_file)
+
+def key_id(key):
+    """Short fingerprint naming a key in logs and progress files, without revealing it"""
+    return hashlib.sha256(key).hexdigest()[:12]
+
+# Encryption keys. Everything is written with the current key, Key/encryption.key;
+# Key/retired.keys lists earlier keys, one per line, which are still tried when
+# reading (like MultiFernet). Tools/rotate_key.py makes a new current key and
+# re-encrypts Data/ while Chatly keeps running: every process checks the key
+# files at most every KEY_CHECK_INTERVAL seconds, and at once when it meets a
+# token none of its keys can read.
+ENCRYPTION_KEY_FILE = "Key/encryption.key"
+RETIRED_KEYS_FILE = "Key/retired.keys"
+KEY_CHECK_INTERVAL = 5
 
-encryption_key = get_encryption_key()
-cipher_suite = Fernet(encryption_key)
+class KeyRing:
+    """The current encryption key and the retired ones, reloaded when their files change"""
+    def __init__(self, key_file, retired_file):
+        self.key_file = key_file
+        self.retired_file = retired_file
+        self.lock = threading.Lock()
+        self.listeners = []  # Called after the keys were reloaded
+        self.load()
+
+    def files_stamp(self):
+        stamp = []
+        for path in (self.key_file, self.retired_file):
+            try:
+                stat = os.stat(path)
+                stamp.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def load(self):
+        # Stamped before reading, so a rotation landing in between is picked up next time
+        stamp = self.files_stamp()
+        current_key = load_or_create_key(self.key_file, Fernet.generate_key).strip()
+        if stamp[0] is None:
+            stamp = self.files_stamp()  # The key was only just created
+        retired_keys = []
+        if os.path.exists(self.retired_file):
+            with open(self.retired_file, "rb") as f:
+                retired_keys = [key for key in f.read().split() if key != current_key]
+        self.current = Fernet(current_key)
+        # The current key comes first, so up-to-date tokens are decrypted at the first try
+        self.fernet = MultiFernet([self.current] + [Fernet(key) for key in retired_keys])
+        self.current_key = current_key
+        self.retired_keys = retired_keys
+        self.stamp = stamp
+        self.checked_at = time.monotonic()
+
+    def refresh(self, force=False):
+        """Reload the keys if their files changed. Returns True if they did"""
+        if not force and time.monotonic() - self.checked_at < KEY_CHECK_INTERVAL:
+            return False
+        with self.lock:
+            self.checked_at = time.monotonic()
+            if self.files_stamp() == self.stamp:
+                return False
+            self.load()
+        log.info("Encryption keys reloaded: current key %s, %s retired key(s)",
+                 key_id(self.current_key), len(self.retired_keys))
+        for listener in self.listeners:
+            listener()
+        return True
+
+    def encrypt(self, data):
+        self.refresh()
+        return self.current.encrypt(data)
+
+    def decrypt(self, token):
+        self.refresh()
+        try:
+            return self.fernet.decrypt(token)
+        except InvalidToken:
+            # Possibly written by a process that already has a newer key
+            if self.refresh(force=True):
+                return self.fernet.decrypt(token)
+            raise
+
+    def reencrypt(self, token):
+        """The token encrypted with the current key, or None if it already is.
+        Raises InvalidToken if no key can read it."""
+        try:
+            # Only checks the signature, which is all it takes to tell the key
+            self.current.extract_timestamp(token)
+            return None
+        except InvalidToken:
+            return self.fernet.rotate(token)
+
+    def rotate(self):
+        """Make a new current key. The old one is retired, still read until nothing uses it.
+        Returns the new key."""
+        with self.lock:
+            self.load()
+            new_key = Fernet.generate_key()
+            # Retired first: whichever file a reader sees, it never loses the old key
+            write_key_file(self.retired_file, [self.current_key] + self.retired_keys)
+            write_key_file(self.key_file, [new_key])
+            self.load()
+        return new_key
+
+    def retire(self):
+        """Forget the retired keys, once everything is re-encrypted with the current one"""
+        with self.lock:
+            if os.path.exists(self.retired_file):
+                os.remove(self.retired_file)
+            self.load()
+
+def get_secret_key():
+    """Signs the session cookies. Persisted, so sessions survive restarts and are valid in every worker"""
+    return load_or_create_key("Key/secret.key", lambda: os.urandom(32))
+
+key_ring = KeyRing(ENCRYPTION_KEY_FILE, RETIRED_KEYS_FILE)
+app.secret_key = get_secret_key()
 
 # Helper functions
 def encrypt_data(data):
-    if isinstance(data, str):
-        return cipher_suite.encrypt(data.encode()).decode()
-    elif isinstance(data, dict):
-        return cipher_suite.encrypt(json.dumps(data).encode()).decode()
+    with timed(storage_latency, operation="encrypt"):
+        if isinstance(data, str):
+            return key_ring.encrypt(data.encode()).decode()
+        elif isinstance(data, dict):
+            return key_ring.encrypt(json.dumps(data).encode()).decode()
     return None
 
 def decrypt_data(encrypted_data):
     try:
         if isinstance(encrypted_data, str):
-            return cipher_suite.decrypt(encrypted_data.encode()).decode()
+            with timed(storage_latency, operation="decrypt"):
+                return key_ring.decrypt(encrypted_data.encode()).decode()
         return None
     except Exception as e:
-        print(f"Decryption error: {e}")
+        log.error("Decryption error: %s", e)
         return None
 
-def get_user_data(username):
-    user_file = os.path.join(users_dir, f"{username}.json")
-    if not os.path.exists(user_file):
-        return None
+class LRUCache:
+    """Thread-safe LRU cache bounded both by entry count and by total size in bytes.
+
+    Values are stored as decrypted JSON text and parsed on every hit, so callers
+    always get their own copy and can mutate it freely. With a ttl (seconds),
+    entries also expire that long after they were set. An entry set with a
+    stamp (e.g. the file's size and mtime) is only returned to a get with the
+    same stamp, so a copy changed elsewhere is read again.
+    """
+    def __init__(self, max_entries, max_bytes, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (text, expires_at, stamp)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key, stamp=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                self._pop(key)
+                self.evictions += 1
+                entry = None
+            if entry is not None and entry[2] != stamp:
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        return json.loads(entry[0])
+    
+    def set(self, key, text, stamp=None):
+        with self.lock:
+            self._pop(key)
+            if len(text) > self.max_bytes:
+                return
+            self.entries[key] = (text, time.time() + self.ttl if self.ttl else None, stamp)
+            self.size += len(text)
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (evicted, _, _) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+    
+    def delete(self, key):
+        with self.lock:
+            self._pop(key)
     
-    with open(user_file, "r") as f:
+    def delete_where(self, predicate):
+        with self.lock:
+            for key in [key for key in self.entries if predicate(key)]:
+                self._pop(key)
+    
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+# Decrypted user records and chats, keyed by username and (username, chat_id)
+user_cache = LRUCache(
+    max_entries=int(os.environ.get("CHATLY_USER_CACHE_ENTRIES", 1000)),
+    max_bytes=int(os.environ.get("CHATLY_USER_CACHE_MB", 8)) * 1024 * 1024
+)
+chat_cache = LRUCache(
+    max_entries=int(os.environ.get("CHATLY_CHAT_CACHE_ENTRIES", 500)),
+    max_bytes=int(os.environ.get("CHATLY_CHAT_CACHE_MB", 64)) * 1024 * 1024
+)
+# A user record holds the password encrypted once more, so a cached copy may
+# still use a key that is about to be retired
+key_ring.listeners.append(lambda: user_cache.delete_where(lambda key: True))
+
+# Durability. Files that are rewritten as a whole (user records, chat indexes,
+# compacted chat logs) are written to a temporary file and renamed over the
+# original, so a crash leaves either the old or the new version, never half of
+# one. CHATLY_FSYNC sets how much is flushed to disk before a write returns:
+#   off     leave it to the OS (fastest, a power loss can drop recent writes)
+#   normal  fsync rewritten files before the rename (default)
+#   full    also fsync appended records and the directory after a rename
+# SQLite's synchronous pragma follows the same setting.
+FSYNC_POLICY = os.environ.get("CHATLY_FSYNC", "normal")
+LOCK_DIR = "Data/locks"
+LOCK_STRIPES = int(os.environ.get("CHATLY_LOCK_STRIPES", 64))  # Lock files per kind of lock
+
+def fsync_directory(path):
+    try:
+        descriptor = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return  # Not supported on this platform
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+def atomic_write(path, text):
+    """Replace a file's contents with text via a temporary file and a rename"""
+    temp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_file, "w") as f:
+            f.write(text)
+            if FSYNC_POLICY != "off":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_file, path)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    if FSYNC_POLICY == "full":
+        fsync_directory(path)
+
+@contextmanager
+def file_lock(path):
+    """Hold path + ".lock" exclusively, against other threads and processes alike (flock
+    where available), e.g. around reading, changing and rewriting a shared file"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+
+def complete_length(f, size):
+    """Bytes of a binary file up to and including its last newline"""
+    end = size
+    while end > 0:
+        start = max(0, end - 4096)
+        f.seek(start)
+        newline = f.read(end - start).rfind(b"\n")
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+def append_lines(path, lines):
+    """Append whole lines to a file, first cutting off a line left incomplete by a crash mid-append"""
+    with open(path, "ab+") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = complete_length(f, size)
+        if end < size:
+            f.truncate(end)
+            log.error("Dropped an incomplete record at the end of %s", path)
+        f.write("".join(lines).encode())
+        f.flush()
+        if FSYNC_POLICY == "full":
+            os.fsync(f.fileno())
+
+def read_complete_lines(path):
+    """A file's lines, without a last line that has no newline yet (being appended, or cut short by a crash)"""
+    with open(path, "r") as f:
+        lines = f.readlines()
+    if lines and not lines[-1].endswith("\n"):
+        lines.pop()
+    return lines
+
+class KeyedLocks:
+    """Reentrant locks by key (e.g. username, chat_id), also held across processes.
+
+    Within a process every key has its own lock. With shared storage
+    (SHARED_STORAGE), keys are also hashed onto LOCK_STRIPES lock files held with
+    flock, so Chatly workers sharing a Data/ directory serialize on the same
+    records. Several keys share a stripe, so a thread tracks the stripes it holds
+    and flocks each only once, however many of its keys map to it. Where flock is
+    not available (Windows) the locks only cover the current process.
+    Locks are taken in one order only: a chat lock may be held while taking a
+    user lock, and a user lock while taking the credential lock, never the
+    other way round. A thread never holds two chat locks at once.
+    """
+    def __init__(self, kind):
+        self.kind = kind
+        self.locks = {}  # key -> [RLock, number of threads using it]
+        self.guard = threading.Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def hold(self, *key):
+        with self.guard:
+            entry = self.locks.setdefault(key, [threading.RLock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                stripe = self._hold_stripe(key) if SHARED_STORAGE and fcntl is not None else None
+                try:
+                    yield
+                finally:
+                    if stripe is not None:
+                        self._release_stripe(stripe)
+        finally:
+            with self.guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
+    def _hold_stripe(self, key):
+        stripe = int(hashlib.sha1("\0".join(key).encode()).hexdigest(), 16) % LOCK_STRIPES
+        stripes = self.local.__dict__.setdefault("stripes", {})  # stripe -> [lock file, holds]
+        if stripe not in stripes:
+            os.makedirs(LOCK_DIR, exist_ok=True)
+            lock_file = open(os.path.join(LOCK_DIR, f"{self.kind}-{stripe}.lock"), "a")
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            stripes[stripe] = [lock_file, 0]
+        stripes[stripe][1] += 1
+        return stripe
+
+    def _release_stripe(self, stripe):
+        stripes = self.local.stripes
+        stripes[stripe][1] -= 1
+        if not stripes[stripe][1]:
+            stripes.pop(stripe)[0].close()  # Closing releases the flock
+
+chat_locks = KeyedLocks("chat")
+user_locks = KeyedLocks("user")
+credential_locks = KeyedLocks("credential")
+
+# Flags switched while running (mock mode) that every worker process has to
+# agree on. With shared storage they live in RUNTIME_FLAGS_FILE and are read
+# again whenever it changes; otherwise they are only kept in memory.
+RUNTIME_FLAGS_FILE = "Data/runtime.json"
+
+class RuntimeFlags:
+    def __init__(self, path, defaults):
+        self.path = path
+        self.defaults = dict(defaults)
+        self.values = dict(defaults)
+        self.stamp = None
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        if SHARED_STORAGE:
+            with self.lock:
+                self._reload()
+        return self.values[name]
+
+    def set(self, name, value):
+        with self.lock:
+            if SHARED_STORAGE:
+                self._reload()
+            self.values = {**self.values, name: value}
+            self._save()
+
+    def reset(self):
+        """Back to the defaults, when the server starts"""
+        with self.lock:
+            self.values = dict(self.defaults)
+            self._save()
+
+    def _save(self):
+        if SHARED_STORAGE:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            atomic_write(self.path, json.dumps(self.values))
+            self.stamp = FileStorage.file_stamp(self.path)
+
+    def _reload(self):
+        stamp = FileStorage.file_stamp(self.path)
+        if stamp is None or stamp == self.stamp:
+            return
+        try:
+            with open(self.path, "r") as f:
+                self.values = {**self.defaults, **json.load(f)}
+            self.stamp = stamp
+        except (OSError, ValueError) as e:
+            log.error("Could not read runtime flags from %s: %s", self.path, e)
+
+runtime_flags = RuntimeFlags(RUNTIME_FLAGS_FILE, {"mock_mode": MOCK_MODE})
+
+# Small JSON documents the worker processes keep together: what every worker is
+# generating (the scheduler), which models are loaded and how much they are asked
+# for, and the rate limiters' hits. With shared storage each lives in a file
+# under STATE_DIR, read and changed by one process at a time under its file
+# lock; otherwise only in memory.
+STATE_DIR = "Data/state"
+
+class SharedState:
+    def __init__(self, name, default):
+        self.path = os.path.join(STATE_DIR, f"{name}.json")
+        self.default = default
+        self.value = copy.deepcopy(default)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def edit(self, save=True):
+        """Yield the document to change in place, or with save=False only to read"""
+        with self.lock:
+            if not SHARED_STORAGE:
+                yield self.value
+                return
+            with file_lock(self.path):
+                try:
+                    with open(self.path, "r") as f:
+                        value = json.load(f)
+                except FileNotFoundError:
+                    value = copy.deepcopy(self.default)
+                except ValueError as e:
+                    log.error("Could not read %s, starting over: %s", self.path, e)
+                    value = copy.deepcopy(self.default)
+                yield value
+                if save:
+                    atomic_write(self.path, json.dumps(value))
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def mock_mode():
+    """Whether replies are mocked instead of generated by Ollama"""
+    return runtime_flags.get("mock_mode")
+
+def set_mock_mode(enabled):
+    runtime_flags.set("mock_mode", enabled)
+
+# Storage. Everything Chatly persists goes through `storage`, one of two
+# backends with the same methods, chosen with CHATLY_STORAGE:
+#   file    an encrypted file per user and an append-only log per chat under Data/ (default)
+#   sqlite  one SQLite database in WAL mode, every record encrypted in its own column
+# The caches and the search index below work the same on top of either. Messages
+# are addressed by their position in the chat, which neither backend ever changes.
+STORAGE_BACKEND = os.environ.get("CHATLY_STORAGE", "file")
+SQLITE_PATH = os.environ.get("CHATLY_SQLITE_PATH", "Data/chatly.db")
+SQLITE_SYNCHRONOUS = {"off": "OFF", "normal": "NORMAL", "full": "FULL"}  # By CHATLY_FSYNC
+# Worker processes of the built-in server (see serve_workers). When more than one
+# process uses the same storage, cached records are checked against a cheap
+# stamp from the backend (file size/mtime, row revision) before every use.
+WORKERS = int(os.environ.get("CHATLY_WORKERS", 1))
+SHARED_STORAGE = WORKERS > 1 or os.environ.get("CHATLY_SHARED_STORAGE", "0") == "1"
+# Without shared storage records are only locked within this process. It then
+# holds a shared flock on LOCAL_LOCKING_FILE while it runs, which tools rewriting
+# records next to a running Chatly (Tools/rotate_key.py) take exclusively: they
+# refuse to start beside such a process, and one started meanwhile waits for them.
+LOCAL_LOCKING_FILE = os.path.join(LOCK_DIR, "local-locking.lock")
+local_locking = None
+if not SHARED_STORAGE and fcntl is not None:
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    local_locking = open(LOCAL_LOCKING_FILE, "a")
+    try:
+        fcntl.flock(local_locking.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        log.warning("Waiting for Tools/rotate_key.py to finish (CHATLY_SHARED_STORAGE=1 runs alongside it)")
+        fcntl.flock(local_locking.fileno(), fcntl.LOCK_SH)
+
+def page_range(total, message_at, limit=None, before=None, since=None):
+    """(start, end) of the messages a page covers, see read_chat_page"""
+    end = total if before is None else max(0, min(before, total))
+    start = 0
+    if since is not None:
+        # Messages are appended in time order: binary search for the first one at or after `since`
+        low, high = 0, end
+        while low < high:
+            middle = (low + high) // 2
+            message = message_at(middle)
+            if message is not None and message.get("timestamp", 0) >= since:
+                high = middle
+            else:
+                low = middle + 1
+        start = low
+    if limit is not None:
+        start = max(start, end - limit)
+    return start, end
+
+def slice_chat(chat_data, limit=None, before=None, since=None):
+    """read_chat_page for a chat already in memory"""
+    messages = chat_data.pop("messages", [])
+    start, end = page_range(len(messages), messages.__getitem__, limit, before, since)
+    chat_data["messages"] = messages[start:end]
+    return chat_data, start, len(messages)
+
+# Chats are stored as append-only logs: one line per record, each record
+# encrypted on its own as "<tag> <token>". The tag stays in plaintext so
+# readers can skip records without decrypting them.
+#   H  header, the chat's metadata (title, ...) when the log was written
+#   U  metadata update merged over the header (e.g. a rename)
+#   M  a single message
+# Legacy chats (one encrypted JSON blob in <chat_id>.json) are still read and
+# are migrated to a log the first time they are written to.
+CHAT_LOG_EXTENSION = ".log"
+CHAT_LOG_COMPACT_THRESHOLD = 20  # Superseded U records before a log is rewritten
+
+# Per-user chat index, one small encrypted file listing every chat's id,
+# title, created/updated timestamps and message count, so the sidebar can be
+# loaded without opening any chat. Rebuilt from the chat files when missing.
+CHAT_INDEX_FILE = "chats.index"
+SEARCH_INDEX_FILE = "search.index"
+CREDENTIALS_COMPACT_THRESHOLD = 100  # Superseded credential lines before the log is rewritten
+
+def encode_chat_record(tag, record):
+    return f"{tag} {encrypt_data(record)}\n"
+
+def read_chat_records(log_file, tags=None):
+    """Yield (tag, record) pairs from a chat log, optionally only for some tags"""
+    with timed(storage_latency, operation="read"):
+        lines = read_complete_lines(log_file)
+    for line in lines:
+        tag, _, token = line.rstrip("\n").partition(" ")
+        if not token or (tags is not None and tag not in tags):
+            continue
+        decrypted_data = decrypt_data(token)
+        if not decrypted_data:
+            log.error("Skipping unreadable record in %s", log_file)
+            continue
+        yield tag, json.loads(decrypted_data)
+
+def read_chat_log(log_file):
+    """Replay a chat log, returns (chat_data, number of superseded records)"""
+    chat_data = None
+    messages = []
+    superseded = 0
+    for tag, record in read_chat_records(log_file):
+        if tag == "M":
+            messages.append(record)
+        elif tag == "H":
+            chat_data = record
+        elif tag == "U":
+            chat_data = {**(chat_data or {}), **record}
+            superseded += 1
+
+    if chat_data is None and not messages:
+        return None, superseded
+
+    chat_data = chat_data or {"title": "New Chat"}
+    chat_data["messages"] = messages
+    return chat_data, superseded
+
+class UnreadableMessages:
+    """Positions of the message records no key can decrypt, per chat.
+
+    Full reads skip those records, so pages and counts (which otherwise never
+    decrypt the messages they step over) must skip the same ones. Each chat's
+    messages are checked once, then only the ones appended since; the entry is
+    tied to the chat's first message record, so a rewritten chat is rechecked.
+    """
+
+    def __init__(self, max_chats=10000):
+        self.max_chats = max_chats
+        self.chats = OrderedDict()
+        self.lock = threading.Lock()
+
+    def positions(self, key, count, first_token, tokens_from):
+        """The sorted unreadable positions among `count` messages; tokens_from(start) lists the tokens from start on"""
+        with self.lock:
+            entry = self.chats.pop(key, None)
+        if entry is None or entry["first"] != first_token or entry["checked"] > count:
+            entry = {"first": first_token, "checked": 0, "unreadable": []}
+        if entry["checked"] < count:
+            for position, token in enumerate(tokens_from(entry["checked"]), start=entry["checked"]):
+                if not token or decrypt_data(token) is None:
+                    entry["unreadable"].append(position)
+            entry["checked"] = count
+        with self.lock:
+            self.chats[key] = entry
+            while len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+        return entry["unreadable"]
+
+unreadable_messages = UnreadableMessages()
+
+def read_legacy_chat(chat_file):
+    with open(chat_file, "r") as f:
         encrypted_data = f.read()
         decrypted_data = decrypt_data(encrypted_data)
         if decrypted_data:
             return json.loads(decrypted_data)
     return None
 
+# Key rotation: records still encrypted with a retired key are rewritten with
+# the current one (see KeyRing and Tools/rotate_key.py)
+def reencrypt_token(token):
+    """The stored token encrypted with the current key, None if it already is (or no key can read it)"""
+    try:
+        new_token = key_ring.reencrypt(token.encode())
+    except InvalidToken:
+        log.error("Skipping a record no encryption key can read")
+        return None
+    return new_token.decode() if new_token else None
+
+def reencrypt_user_token(token):
+    """reencrypt_token for a user record, whose password is encrypted once more inside it"""
+    decrypted_data = decrypt_data(token)
+    if decrypted_data is None:
+        return None
+    user_data = json.loads(decrypted_data)
+    password = user_data.get("password")
+    new_password = reencrypt_token(password) if isinstance(password, str) else None
+    if new_password is None:
+        return reencrypt_token(token)
+    user_data["password"] = new_password
+    return encrypt_data(json.dumps(user_data))
+
+class FileStorage:
+    """The original layout: Data/users/<user>.json and Data/chats/<user>/ with chat logs and indexes"""
+    name = "file"
+
+    def __init__(self, users_dir, chats_dir, credentials_file=credentials_file):
+        self.users_dir = users_dir
+        self.chats_dir = chats_dir
+        self.credentials_file = credentials_file
+        self.credentials = {}
+        self.credentials_position = None  # (inode, bytes read), like a search records position
+        self.credentials_lines = 0
+        self.credentials_lock = threading.Lock()
+        os.makedirs(users_dir, exist_ok=True)
+        os.makedirs(chats_dir, exist_ok=True)
+
+    def user_file(self, username):
+        return os.path.join(self.users_dir, f"{username}.json")
+
+    def user_chats_dir(self, username, create=False):
+        user_chats_dir = os.path.join(self.chats_dir, username)
+        if create:
+            os.makedirs(user_chats_dir, exist_ok=True)
+        return user_chats_dir
+
+    def chat_log_file(self, username, chat_id):
+        return os.path.join(self.chats_dir, username, f"{chat_id}{CHAT_LOG_EXTENSION}")
+
+    def legacy_chat_file(self, username, chat_id):
+        return os.path.join(self.chats_dir, username, f"{chat_id}.json")
+
+    def chat_index_file(self, username):
+        return os.path.join(self.chats_dir, username, CHAT_INDEX_FILE)
+
+    def search_index_file(self, username):
+        return os.path.join(self.chats_dir, username, SEARCH_INDEX_FILE)
+
+    @staticmethod
+    def file_stamp(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def after_fork(self):
+        pass
+
+    # Users
+    def user_stamp(self, username):
+        """Changes whenever the user's record is written"""
+        return self.file_stamp(self.user_file(username))
+
+    def load_user(self, username):
+        """The user's record as JSON text, None if there is none"""
+        user_file = self.user_file(username)
+        if not os.path.exists(user_file):
+            return None
+        with timed(storage_latency, operation="read"), open(user_file, "r") as f:
+            encrypted_data = f.read()
+        return decrypt_data(encrypted_data)
+
+    def save_user(self, username, json_data):
+        encrypted_data = encrypt_data(json_data)
+        with timed(storage_latency, operation="write"):
+            atomic_write(self.user_file(username), encrypted_data)
+
+    def delete_user(self, username):
+        self.delete_user_chats(username)
+        user_chats_dir = self.user_chats_dir(username)
+        if os.path.isdir(user_chats_dir):
+            try:
+                os.rmdir(user_chats_dir)
+            except OSError as e:
+                log.error("Could not remove %s: %s", user_chats_dir, e)
+        if os.path.exists(self.user_file(username)):
+            os.remove(self.user_file(username))
+        self.save_credential(username, None)
+
+    def has_user(self, username):
+        return os.path.exists(self.user_file(username))
+
+    def list_users(self):
+        return sorted(os.path.splitext(file)[0] for file in os.listdir(self.users_dir) if file.endswith(".json"))
+
+    # Credentials, an append-only log of [username, password hash] lines (a null
+    # hash removes the user), in plaintext: the hashes are salted, and logging in
+    # decrypts nothing. Kept in memory, only lines appended since are read.
+    def load_credentials(self):
+        with self.credentials_lock:
+            try:
+                f = open(self.credentials_file, "r")
+            except FileNotFoundError:
+                self.credentials, self.credentials_position, self.credentials_lines = {}, None, 0
+                return self.credentials
+            with f:
+                stat = os.fstat(f.fileno())
+                position = self.credentials_position
+                if position is None or position[0] != stat.st_ino or position[1] > stat.st_size:
+                    self.credentials, self.credentials_lines = {}, 0
+                    position = (stat.st_ino, 0)
+                if position[1] == stat.st_size:
+                    return self.credentials
+                with timed(storage_latency, operation="read"):
+                    f.seek(position[1])
+                    data = f.read()
+            # Only whole lines (ASCII, so characters are bytes); one being appended is read next time
+            complete = data[:data.rfind("\n") + 1]
+            for line in complete.splitlines():
+                username, password_hash = json.loads(line)
+                if password_hash is None:
+                    self.credentials.pop(username, None)
+                else:
+                    self.credentials[username] = password_hash
+                self.credentials_lines += 1
+            self.credentials_position = (position[0], position[1] + len(complete))
+            return self.credentials
+
+    def load_credential(self, username):
+        return self.load_credentials().get(username)
+
+    def save_credential(self, username, password_hash):
+        """Set a user's password hash, None removes it"""
+        with credential_locks.hold("log"):
+            credentials = self.load_credentials()
+            if password_hash is None and username not in credentials:
+                return
+            with timed(storage_latency, operation="write"):
+                append_lines(self.credentials_file, [json.dumps([username, password_hash]) + "\n"])
+            credentials = self.load_credentials()
+            if self.credentials_lines > 2 * len(credentials) + CREDENTIALS_COMPACT_THRESHOLD:
+                # Mostly superseded lines: rewrite the log with one line per user
+                lines = [json.dumps([name, value]) + "\n" for name, value in credentials.items()]
+                with timed(storage_latency, operation="write"):
+                    atomic_write(self.credentials_file, "".join(lines))
+
+    # Chats
+    def chat_stamp(self, username, chat_id):
+        """Changes whenever the chat is written (appends grow the log, rewrites replace it)"""
+        return (self.file_stamp(self.chat_log_file(username, chat_id)) or
+                self.file_stamp(self.legacy_chat_file(username, chat_id)))
+
+    def list_chat_ids(self, username):
+        user_chats_dir = self.user_chats_dir(username)
+        if not os.path.isdir(user_chats_dir):
+            return []
+        chat_ids = set()
+        for file in os.listdir(user_chats_dir):
+            chat_id, extension = os.path.splitext(file)
+            if extension in (CHAT_LOG_EXTENSION, ".json"):
+                chat_ids.add(chat_id)
+        return sorted(chat_ids)
+
+    def load_chat(self, username, chat_id, compact=True):
+        """compact=False never takes the chat's lock, for callers that may hold another chat's"""
+        log_file = self.chat_log_file(username, chat_id)
+        legacy_file = self.legacy_chat_file(username, chat_id)
+        if os.path.exists(log_file):
+            chat_data, superseded = read_chat_log(log_file)
+            if compact and chat_data is not None and superseded >= CHAT_LOG_COMPACT_THRESHOLD:
+                with chat_locks.hold(username, chat_id):
+                    # Read again under the lock, so nothing appended meanwhile is lost
+                    chat_data, _ = read_chat_log(log_file)
+                    if chat_data is not None:
+                        self.write_chat(username, chat_id, chat_data)
+            return chat_data
+        if os.path.exists(legacy_file):
+            return read_legacy_chat(legacy_file)
+        return None
+
+    def load_chat_page(self, username, chat_id, limit=None, before=None, since=None):
+        """A chat log is sliced by its plaintext tags, so only the returned messages are decrypted"""
+        log_file = self.chat_log_file(username, chat_id)
+        if not os.path.exists(log_file):
+            chat_data = self.load_chat(username, chat_id)
+            return slice_chat(chat_data, limit, before, since) if chat_data is not None else None
+
+        with timed(storage_latency, operation="read"):
+            lines = read_complete_lines(log_file)
+        chat_data = {"title": "New Chat"}
+        message_tokens = []
+        for line in lines:
+            tag, _, token = line.rstrip("\n").partition(" ")
+            if tag == "M":
+                message_tokens.append(token)
+            elif tag in ("H", "U") and token:
+                decrypted_data = decrypt_data(token)
+                if decrypted_data:
+                    chat_data = {**chat_data, **json.loads(decrypted_data)} if tag == "U" else json.loads(decrypted_data)
+
+        # Positions count only the messages read_chat_log returns
+        unreadable = set(self.unreadable_positions(log_file, message_tokens))
+        if unreadable:
+            message_tokens = [token for position, token in enumerate(message_tokens) if position not in unreadable]
+
+        def message_at(position):
+            decrypted_data = decrypt_data(message_tokens[position])
+            return json.loads(decrypted_data) if decrypted_data else None
+
+        start, end = page_range(len(message_tokens), message_at, limit, before, since)
+        chat_data["messages"] = [message for message in map(message_at, range(start, end)) if message is not None]
+        return chat_data, start, len(message_tokens)
+
+    @staticmethod
+    def unreadable_positions(log_file, message_tokens):
+        return unreadable_messages.positions(log_file, len(message_tokens), message_tokens[0] if message_tokens else None,
+                                             lambda start: message_tokens[start:])
+
+    def count_messages(self, username, chat_id):
+        log_file = self.chat_log_file(username, chat_id)
+        if os.path.exists(log_file):
+            with timed(storage_latency, operation="read"):
+                lines = read_complete_lines(log_file)
+            message_tokens = [token for tag, _, token in (line.rstrip("\n").partition(" ") for line in lines)
+                              if tag == "M"]
+            return len(message_tokens) - len(self.unreadable_positions(log_file, message_tokens))
+        chat_data = self.load_chat(username, chat_id)
+        return len(chat_data.get("messages", [])) if chat_data else 0
+
+    def write_chat(self, username, chat_id, data):
+        """Write a chat as a fresh, compacted log (header + one record per message)"""
+        self.user_chats_dir(username, create=True)
+        header = {key: value for key, value in data.items() if key != "messages"}
+        lines = [encode_chat_record("H", header)]
+        lines.extend(encode_chat_record("M", message) for message in data.get("messages", []))
+
+        with timed(storage_latency, operation="write"):
+            atomic_write(self.chat_log_file(username, chat_id), "".join(lines))
+
+        # Whatever was in a legacy blob is now in the log
+        legacy_file = self.legacy_chat_file(username, chat_id)
+        if os.path.exists(legacy_file):
+            os.remove(legacy_file)
+
+    def migrate_chat(self, username, chat_id):
+        """Convert a legacy single-blob chat into a log. Returns True if it was migrated"""
+        log_file = self.chat_log_file(username, chat_id)
+        legacy_file = self.legacy_chat_file(username, chat_id)
+        if os.path.exists(log_file) or not os.path.exists(legacy_file):
+            return False
+
+        chat_data = read_legacy_chat(legacy_file)
+        if chat_data is None:
+            return False
+        self.write_chat(username, chat_id, chat_data)
+        return True
+
+    def append_chat(self, username, chat_id, messages, metadata=None):
+        """Costs O(size of the new records) instead of rewriting the whole chat"""
+        log_file = self.chat_log_file(username, chat_id)
+        if not os.path.exists(log_file) and not self.migrate_chat(username, chat_id):
+            # Brand new chat, start the log with its metadata
+            self.write_chat(username, chat_id, {**(metadata or {"title": "New Chat"}), "messages": messages})
+            return
+
+        lines = []
+        if metadata:
+            lines.append(encode_chat_record("U", metadata))
+        lines.extend(encode_chat_record("M", message) for message in messages)
+        with timed(storage_latency, operation="write"):
+            append_lines(log_file, lines)
+
+    def delete_chat(self, username, chat_id):
+        for chat_file in (self.chat_log_file(username, chat_id), self.legacy_chat_file(username, chat_id)):
+            if os.path.exists(chat_file):
+                os.remove(chat_file)
+        with user_locks.hold(username):
+            index = self.load_chat_index(username)
+            if index.pop(chat_id, None) is not None:
+                self.save_chat_index(username, index)
+
+    def delete_user_chats(self, username):
+        """Every chat of the user, with their chat index and search records"""
+        user_chats_dir = self.user_chats_dir(username)
+        if not os.path.isdir(user_chats_dir):
+            return
+        for file in os.listdir(user_chats_dir):
+            if file.endswith((".json", CHAT_LOG_EXTENSION, ".tmp")) or file in (CHAT_INDEX_FILE, SEARCH_INDEX_FILE):
+                try:
+                    os.remove(os.path.join(user_chats_dir, file))
+                except OSError as e:
+                    log.error("Could not remove %s of %s: %s", file, username, e)
+
+    # Chat index
+    def load_chat_index(self, username):
+        index_file = self.chat_index_file(username)
+        if not os.path.exists(index_file):
+            return self.rebuild_chat_index(username)
+
+        with timed(storage_latency, operation="read"), open(index_file, "r") as f:
+            encrypted_data = f.read()
+        decrypted_data = decrypt_data(encrypted_data)
+        if decrypted_data is None:
+            log.error("Chat index for %s is unreadable, rebuilding it", username)
+            return self.rebuild_chat_index(username)
+        return json.loads(decrypted_data)
+
+    def save_chat_index(self, username, index):
+        self.user_chats_dir(username, create=True)
+        encrypted_data = encrypt_data(index)
+        with timed(storage_latency, operation="write"):
+            atomic_write(self.chat_index_file(username), encrypted_data)
+
+    def update_chat_entry(self, username, chat_id, fields):
+        with user_locks.hold(username):
+            index = self.load_chat_index(username)
+            now = int(time.time())
+            entry = index.get(chat_id) or {"title": "New Chat", "created": now, "updated": now, "message_count": 0}
+            entry.update(fields)
+            index[chat_id] = entry
+            self.save_chat_index(username, index)
+
+    def rebuild_chat_index(self, username):
+        """Rebuild a user's chat index by scanning their chat files"""
+        user_chats_dir = self.user_chats_dir(username, create=True)
+        index = {}
+        for file in os.listdir(user_chats_dir):
+            chat_id, extension = os.path.splitext(file)
+            chat_path = os.path.join(user_chats_dir, file)
+
+            if extension == CHAT_LOG_EXTENSION:
+                # Only metadata and the last message are decrypted, the rest is counted by tag
+                title = None
+                message_count = 0
+                last_message_line = None
+                for line in read_complete_lines(chat_path):
+                    tag, _, token = line.rstrip("\n").partition(" ")
+                    if tag == "M":
+                        message_count += 1
+                        last_message_line = token
+                    elif tag in ("H", "U"):
+                        decrypted_data = decrypt_data(token)
+                        if decrypted_data:
+                            title = json.loads(decrypted_data).get("title", title)
+                last_message = json.loads(decrypt_data(last_message_line) or "{}") if last_message_line else {}
+            elif extension == ".json" and not os.path.exists(self.chat_log_file(username, chat_id)):
+                chat_data = read_legacy_chat(chat_path)
+                if not chat_data:
+                    continue
+                title = chat_data.get("title")
+                message_count = len(chat_data.get("messages", []))
+                last_message = chat_data["messages"][-1] if message_count else {}
+            else:
+                continue
+
+            mtime = int(os.path.getmtime(chat_path))
+            created = chat_id.split("_")[1] if chat_id.count("_") >= 2 else ""
+            index[chat_id] = {
+                "title": title or "New Chat",
+                "created": int(created) if created.isdigit() else mtime,
+                "updated": last_message.get("timestamp", mtime),
+                "message_count": message_count
+            }
+
+        with user_locks.hold(username):
+            self.save_chat_index(username, index)
+        return index
+
+    # Search records, an append-only file of "<tag> <token>" lines like a chat log.
+    # A read position is (inode, bytes read): a rewritten file has a new inode.
+    def has_search_records(self, username):
+        return os.path.exists(self.search_index_file(username))
+
+    def append_search_records(self, username, records):
+        lines = [encode_chat_record(tag, record) for tag, record in records]
+        with timed(storage_latency, operation="write"), user_locks.hold(username):
+            append_lines(self.search_index_file(username), lines)
+
+    def read_search_records(self, username, position=None):
+        """Records appended since `position`, returns (records, new position, whether reading restarted)"""
+        index_file = self.search_index_file(username)
+        if not os.path.exists(index_file):
+            return [], None, position is not None
+
+        with timed(storage_latency, operation="read"), open(index_file, "r") as f:
+            inode = os.fstat(f.fileno()).st_ino
+            reset = position is None or position[0] != inode
+            offset = 0 if reset else position[1]
+            f.seek(offset)
+            data = f.read()
+        # Only whole lines; a record being appended right now is picked up next time
+        complete = data[:data.rfind("\n") + 1]
+        records = []
+        for line in complete.splitlines():
+            tag, _, token = line.partition(" ")
+            decrypted_data = decrypt_data(token) if token else None
+            if decrypted_data:
+                records.append((tag, json.loads(decrypted_data)))
+        return records, (inode, offset + len(complete)), reset
+
+    def replace_search_records(self, username, records):
+        self.user_chats_dir(username, create=True)
+        text = "".join(encode_chat_record(tag, record) for tag, record in records)
+        with timed(storage_latency, operation="write"), user_locks.hold(username):
+            atomic_write(self.search_index_file(username), text)
+
+    # Key rotation, under the same locks as the writes it races with
+    @staticmethod
+    def reencrypt_file(path, reencrypt=reencrypt_token, records=False):
+        """Rewrite a file of one token, or of "<tag> <token>" lines, if any of it
+        uses a retired key. Returns the number of tokens re-encrypted."""
+        if not os.path.exists(path):
+            return 0
+        if not records:
+            with open(path, "r") as f:
+                new_token = reencrypt(f.read())
+            if new_token is None:
+                return 0
+            with timed(storage_latency, operation="write"):
+                atomic_write(path, new_token)
+            return 1
+
+        lines = read_complete_lines(path)
+        rewritten = 0
+        for number, line in enumerate(lines):
+            tag, _, token = line.rstrip("\n").partition(" ")
+            new_token = reencrypt(token) if token else None
+            if new_token is not None:
+                lines[number] = f"{tag} {new_token}\n"
+                rewritten += 1
+        if rewritten:
+            with timed(storage_latency, operation="write"):
+                atomic_write(path, "".join(lines))
+        return rewritten
+
+    def reencrypt_chat(self, username, chat_id):
+        with chat_locks.hold(username, chat_id):
+            return (self.reencrypt_file(self.chat_log_file(username, chat_id), records=True) +
+                    self.reencrypt_file(self.legacy_chat_file(username, chat_id)))
+
+    def reencrypt_user(self, username):
+        """The user's record, chat index and search records; their chats go through reencrypt_chat"""
+        with user_locks.hold(username):
+            return (self.reencrypt_file(self.user_file(username), reencrypt_user_token) +
+                    self.reencrypt_file(self.chat_index_file(username)) +
+                    self.reencrypt_file(self.search_index_file(username), records=True))
+
+class SQLiteStorage:
+    """Everything in one SQLite database. Only keys, timestamps and counters are
+    stored in plaintext, for the indexes; user records, titles, chat metadata,
+    messages and search records are each encrypted with the same key as the files.
+    """
+    name = "sqlite"
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            revision INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS chats (
+            username TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            title TEXT NOT NULL,
+            metadata TEXT NOT NULL,
+            created INTEGER NOT NULL,
+            updated INTEGER NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            revision INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (username, chat_id)
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            username TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            timestamp INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (username, chat_id, position)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS messages_by_time ON messages (username, chat_id, timestamp);
+        CREATE TABLE IF NOT EXISTS search_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS search_records_by_user ON search_records (username, id);
+        CREATE TABLE IF NOT EXISTS search_generations (
+            username TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS credentials (
+            username TEXT PRIMARY KEY,
+            password_hash TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.local = threading.local()
+        connection = self.connection()
+        connection.executescript(self.SCHEMA)
+        for table in ("users", "chats"):
+            # Databases created before rows had revisions
+            if "revision" not in [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]:
+                connection.execute(f"ALTER TABLE {table} ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+
+    def after_fork(self):
+        """A forked worker must not share its parent's connections"""
+        self.local = threading.local()
+
+    def connection(self):
+        """One connection per thread, in autocommit mode: transactions are explicit"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS.get(FSYNC_POLICY, 'NORMAL')}")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self, write=True):
+        """BEGIN IMMEDIATE for writes, so concurrent writers queue up front instead of failing on upgrade"""
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def query(self, sql, parameters=()):
+        with timed(storage_latency, operation="read"):
+            return self.connection().execute(sql, parameters).fetchall()
+
+    @staticmethod
+    def decrypt_json(token):
+        decrypted_data = decrypt_data(token)
+        return json.loads(decrypted_data) if decrypted_data else None
+
+    # Users
+    def user_stamp(self, username):
+        rows = self.query("SELECT revision FROM users WHERE username = ?", (username,))
+        return rows[0][0] if rows else None
+
+    def load_user(self, username):
+        rows = self.query("SELECT data FROM users WHERE username = ?", (username,))
+        return decrypt_data(rows[0][0]) if rows else None
+
+    def save_user(self, username, json_data):
+        encrypted_data = encrypt_data(json_data)
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            connection.execute("INSERT INTO users (username, data) VALUES (?, ?) "
+                               "ON CONFLICT (username) DO UPDATE SET data = excluded.data, revision = revision + 1",
+                               (username, encrypted_data))
+
+    def delete_user(self, username):
+        self.delete_user_chats(username)
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            connection.execute("DELETE FROM users WHERE username = ?", (username,))
+            connection.execute("DELETE FROM credentials WHERE username = ?", (username,))
+
+    def has_user(self, username):
+        return bool(self.query("SELECT 1 FROM users WHERE username = ?", (username,)))
+
+    def list_users(self):
+        return [row[0] for row in self.query("SELECT username FROM users ORDER BY username")]
+
+    # Credentials, salted password hashes in plaintext (see FileStorage)
+    def load_credential(self, username):
+        rows = self.query("SELECT password_hash FROM credentials WHERE username = ?", (username,))
+        return rows[0][0] if rows else None
+
+    def save_credential(self, username, password_hash):
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            if password_hash is None:
+                connection.execute("DELETE FROM credentials WHERE username = ?", (username,))
+            else:
+                connection.execute("INSERT INTO credentials (username, password_hash) VALUES (?, ?) "
+                                   "ON CONFLICT (username) DO UPDATE SET password_hash = excluded.password_hash",
+                                   (username, password_hash))
+
+    # Chats
+    def chat_stamp(self, username, chat_id):
+        rows = self.query("SELECT revision FROM chats WHERE username = ? AND chat_id = ?", (username, chat_id))
+        return rows[0][0] if rows else None
+
+    def list_chat_ids(self, username):
+        return [row[0] for row in self.query("SELECT chat_id FROM chats WHERE username = ? ORDER BY chat_id",
+                                             (username,))]
+
+    def load_chat_metadata(self, connection, username, chat_id):
+        row = connection.execute("SELECT metadata FROM chats WHERE username = ? AND chat_id = ?",
+                                 (username, chat_id)).fetchone()
+        return (self.decrypt_json(row[0]) or {"title": "New Chat"}) if row else None
+
+    def load_chat(self, username, chat_id, compact=True):
+        with timed(storage_latency, operation="read"), self.transaction(write=False) as connection:
+            chat_data = self.load_chat_metadata(connection, username, chat_id)
+            if chat_data is None:
+                return None
+            rows = connection.execute("SELECT data FROM messages WHERE username = ? AND chat_id = ? ORDER BY position",
+                                      (username, chat_id)).fetchall()
+        chat_data["messages"] = [message for message in (self.decrypt_json(row[0]) for row in rows) if message]
+        return chat_data
+
+    def load_chat_page(self, username, chat_id, limit=None, before=None, since=None):
+        """Sliced with the (username, chat_id, position/timestamp) indexes, only the page is decrypted"""
+        with timed(storage_latency, operation="read"), self.transaction(write=False) as connection:
+            chat_data = self.load_chat_metadata(connection, username, chat_id)
+            if chat_data is None:
+                return None
+            total = connection.execute("SELECT COUNT(*) FROM messages WHERE username = ? AND chat_id = ?",
+                                       (username, chat_id)).fetchone()[0]
+            unreadable = self.unreadable_positions(connection, username, chat_id, total)
+            if not unreadable:
+                end = total if before is None else max(0, min(before, total))
+                start = 0
+                if since is not None:
+                    row = connection.execute("SELECT MIN(position) FROM messages WHERE username = ? AND chat_id = ? "
+                                             "AND timestamp >= ? AND position < ?",
+                                             (username, chat_id, since, end)).fetchone()
+                    start = row[0] if row[0] is not None else end
+                if limit is not None:
+                    start = max(start, end - limit)
+                rows = connection.execute("SELECT data FROM messages WHERE username = ? AND chat_id = ? "
+                                          "AND position >= ? AND position < ? ORDER BY position",
+                                          (username, chat_id, start, end)).fetchall()
+        if unreadable:
+            # Positions must count only the messages load_chat returns, so page over those
+            chat_data = self.load_chat(username, chat_id)
+            return slice_chat(chat_data, limit, before, since) if chat_data is not None else None
+        chat_data["messages"] = [message for message in (self.decrypt_json(row[0]) for row in rows) if message]
+        return chat_data, start, total
+
+    def count_messages(self, username, chat_id):
+        with self.transaction(write=False) as connection:
+            total = connection.execute("SELECT COUNT(*) FROM messages WHERE username = ? AND chat_id = ?",
+                                       (username, chat_id)).fetchone()[0]
+            return total - len(self.unreadable_positions(connection, username, chat_id, total))
+
+    def unreadable_positions(self, connection, username, chat_id, total):
+        first = connection.execute("SELECT data FROM messages WHERE username = ? AND chat_id = ? AND position = 0",
+                                   (username, chat_id)).fetchone()
+        return unreadable_messages.positions(
+            (self.path, username, chat_id), total, first[0] if first else None,
+            lambda start: [row[0] for row in connection.execute(
+                "SELECT data FROM messages WHERE username = ? AND chat_id = ? AND position >= ? ORDER BY position",
+                (username, chat_id, start))]
+        )
+
+    def insert_messages(self, connection, username, chat_id, start, messages):
+        connection.executemany(
+            "INSERT INTO messages (username, chat_id, position, timestamp, data) VALUES (?, ?, ?, ?, ?)",
+            [(username, chat_id, start + number, int(message.get("timestamp", 0)), encrypt_data(message))
+             for number, message in enumerate(messages)]
+        )
+
+    def ensure_chat(self, connection, username, chat_id, metadata):
+        now = int(time.time())
+        connection.execute(
+            "INSERT INTO chats (username, chat_id, title, metadata, created, updated) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (username, chat_id) DO NOTHING",
+            (username, chat_id, encrypt_data(metadata.get("title", "New Chat")), encrypt_data(metadata), now, now)
+        )
+
+    def write_chat(self, username, chat_id, data):
+        header = {key: value for key, value in data.items() if key != "messages"}
+        messages = data.get("messages", [])
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            self.ensure_chat(connection, username, chat_id, header)
+            connection.execute("UPDATE chats SET title = ?, metadata = ?, message_count = ?, revision = revision + 1 "
+                               "WHERE username = ? AND chat_id = ?",
+                               (encrypt_data(header.get("title", "New Chat")), encrypt_data(header), len(messages),
+                                username, chat_id))
+            connection.execute("DELETE FROM messages WHERE username = ? AND chat_id = ?", (username, chat_id))
+            self.insert_messages(connection, username, chat_id, 0, messages)
+
+    def append_chat(self, username, chat_id, messages, metadata=None):
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            existing = self.load_chat_metadata(connection, username, chat_id)
+            if existing is None:
+                self.ensure_chat(connection, username, chat_id, metadata or {"title": "New Chat"})
+            elif metadata:
+                merged = {**existing, **metadata}
+                connection.execute("UPDATE chats SET title = ?, metadata = ? WHERE username = ? AND chat_id = ?",
+                                   (encrypt_data(merged.get("title", "New Chat")), encrypt_data(merged),
+                                    username, chat_id))
+            connection.execute("UPDATE chats SET revision = revision + 1 WHERE username = ? AND chat_id = ?",
+                               (username, chat_id))
+            start = connection.execute("SELECT COUNT(*) FROM messages WHERE username = ? AND chat_id = ?",
+                                       (username, chat_id)).fetchone()[0]
+            self.insert_messages(connection, username, chat_id, start, messages)
+
+    def delete_chat(self, username, chat_id):
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            connection.execute("DELETE FROM messages WHERE username = ? AND chat_id = ?", (username, chat_id))
+            connection.execute("DELETE FROM chats WHERE username = ? AND chat_id = ?", (username, chat_id))
+
+    def delete_user_chats(self, username):
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            for table in ("messages", "chats", "search_records", "search_generations"):
+                connection.execute(f"DELETE FROM {table} WHERE username = ?", (username,))
+
+    # Chat index, the plaintext columns of the chats table plus the encrypted title
+    def load_chat_index(self, username):
+        rows = self.query("SELECT chat_id, title, created, updated, message_count FROM chats WHERE username = ?",
+                          (username,))
+        return {
+            chat_id: {"title": decrypt_data(title) or "New Chat", "created": created, "updated": updated,
+                      "message_count": message_count}
+            for chat_id, title, created, updated, message_count in rows
+        }
+
+    def update_chat_entry(self, username, chat_id, fields):
+        columns = {key: value for key, value in fields.items() if key in ("created", "updated", "message_count")}
+        if "title" in fields:
+            columns["title"] = encrypt_data(fields["title"])
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            self.ensure_chat(connection, username, chat_id, {"title": fields.get("title", "New Chat")})
+            if columns:
+                assignments = ", ".join(f"{column} = ?" for column in columns)
+                connection.execute(f"UPDATE chats SET {assignments} WHERE username = ? AND chat_id = ?",
+                                   (*columns.values(), username, chat_id))
+
+    def rebuild_chat_index(self, username):
+        """Recount messages and reset titles and update times from the chats themselves"""
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            rows = connection.execute("SELECT chat_id, metadata FROM chats WHERE username = ?", (username,)).fetchall()
+            for chat_id, metadata in rows:
+                title = (self.decrypt_json(metadata) or {}).get("title") or "New Chat"
+                count, last = connection.execute(
+                    "SELECT COUNT(*), MAX(timestamp) FROM messages WHERE username = ? AND chat_id = ?",
+                    (username, chat_id)).fetchone()
+                connection.execute("UPDATE chats SET title = ?, message_count = ?, updated = COALESCE(?, updated) "
+                                   "WHERE username = ? AND chat_id = ?",
+                                   (encrypt_data(title), count, last, username, chat_id))
+        return self.load_chat_index(username)
+
+    # Search records. A read position is (generation, last id read); replacing
+    # a user's records starts a new generation.
+    def has_search_records(self, username):
+        return bool(self.query("SELECT 1 FROM search_generations WHERE username = ?", (username,)))
+
+    def append_search_records(self, username, records):
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            connection.executemany("INSERT INTO search_records (username, tag, data) VALUES (?, ?, ?)",
+                                   [(username, tag, encrypt_data(record)) for tag, record in records])
+
+    def read_search_records(self, username, position=None):
+        with timed(storage_latency, operation="read"), self.transaction(write=False) as connection:
+            row = connection.execute("SELECT generation FROM search_generations WHERE username = ?",
+                                     (username,)).fetchone()
+            if row is None:
+                return [], None, position is not None
+            reset = position is None or position[0] != row[0]
+            last_id = 0 if reset else position[1]
+            rows = connection.execute("SELECT id, tag, data FROM search_records WHERE username = ? AND id > ? "
+                                      "ORDER BY id", (username, last_id)).fetchall()
+        records = []
+        for record_id, tag, data in rows:
+            record = self.decrypt_json(data)
+            if record:
+                records.append((tag, record))
+            last_id = record_id
+        return records, (row[0], last_id), reset
+
+    def replace_search_records(self, username, records):
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            connection.execute("DELETE FROM search_records WHERE username = ?", (username,))
+            connection.execute("INSERT INTO search_generations (username, generation) VALUES (?, 1) "
+                               "ON CONFLICT (username) DO UPDATE SET generation = generation + 1", (username,))
+            connection.executemany("INSERT INTO search_records (username, tag, data) VALUES (?, ?, ?)",
+                                   [(username, tag, encrypt_data(record)) for tag, record in records])
+
+    # Key rotation
+    def reencrypt_rows(self, select, update, parameters, reencrypt=reencrypt_token):
+        """Re-encrypt the token in the last column of the selected rows. The other
+        columns are the parameters of the update, after the new token."""
+        with timed(storage_latency, operation="write"), self.transaction() as connection:
+            updates = []
+            for *key, token in connection.execute(select, parameters).fetchall():
+                new_token = reencrypt(token)
+                if new_token is not None:
+                    updates.append((new_token, *key))
+            connection.executemany(update, updates)
+        return len(updates)
+
+    def reencrypt_chat(self, username, chat_id):
+        rewritten = 0
+        for column in ("title", "metadata"):
+            rewritten += self.reencrypt_rows(
+                f"SELECT username, chat_id, {column} FROM chats WHERE username = ? AND chat_id = ?",
+                f"UPDATE chats SET {column} = ? WHERE username = ? AND chat_id = ?", (username, chat_id))
+        return rewritten + self.reencrypt_rows(
+            "SELECT username, chat_id, position, data FROM messages WHERE username = ? AND chat_id = ?",
+            "UPDATE messages SET data = ? WHERE username = ? AND chat_id = ? AND position = ?", (username, chat_id))
+
+    def reencrypt_user(self, username):
+        """The user's record and search records; their chats go through reencrypt_chat"""
+        return (self.reencrypt_rows("SELECT username, data FROM users WHERE username = ?",
+                                    "UPDATE users SET data = ? WHERE username = ?", (username,), reencrypt_user_token) +
+                self.reencrypt_rows("SELECT id, data FROM search_records WHERE username = ?",
+                                    "UPDATE search_records SET data = ? WHERE id = ?", (username,)))
+
+def create_storage(backend=STORAGE_BACKEND):
+    if backend == "file":
+        return FileStorage(users_dir, chats_dir)
+    if backend == "sqlite":
+        return SQLiteStorage(SQLITE_PATH)
+    raise ValueError(f"Unknown storage backend '{backend}' (CHATLY_STORAGE), expected 'file' or 'sqlite'")
+
+storage = create_storage()
+
+def user_stamp(username):
+    """What a cached user record is checked against, None when this process is the only one using the storage"""
+    return storage.user_stamp(username) if SHARED_STORAGE else None
+
+def chat_stamp(username, chat_id):
+    return storage.chat_stamp(username, chat_id) if SHARED_STORAGE else None
+
+def get_user_data(username):
+    # Taken before reading, so a write landing in between makes the cached copy look stale, not fresh
+    stamp = user_stamp(username)
+    user_data = user_cache.get(username, stamp)
+    if user_data is not None:
+        return user_data
+
+    decrypted_data = storage.load_user(username)
+    if decrypted_data:
+        user_cache.set(username, decrypted_data, stamp)
+        return json.loads(decrypted_data)
+    return None
+
 def save_user_data(username, data):
-    user_file = os.path.join(users_dir, f"{username}.json")
-    encrypted_data = encrypt_data(data)
-    
-    with open(user_file, "w") as f:
-        f.write(encrypted_data)
+    json_data = json.dumps(data)
+    with user_locks.hold(username):
+        storage.save_user(username, json_data)
+        user_cache.set(username, json_data, user_stamp(username))
+    return True
+
+def delete_user_data(username):
+    """Delete a user's record and everything stored for them"""
+    generation_jobs.cancel(username, reason="deleted")
+    chat_cache.delete_where(lambda key: key[0] == username)
+    forget_search_index(username)
+    storage.delete_user(username)
+    user_cache.delete(username)
+
+# Passwords, stored as salted hashes in the storage backend's credential index
+# rather than in the encrypted user record, so checking one costs a hash and no
+# decryption. CHATLY_PASSWORD_HASH picks scrypt (the default where OpenSSL has
+# it) or pbkdf2; hashes made with other settings are redone with the current
+# ones at the user's next login. Records from before hashing still hold the
+# password encrypted, and are moved over the same way.
+PASSWORD_HASH = os.environ.get("CHATLY_PASSWORD_HASH", "scrypt" if hasattr(hashlib, "scrypt") else "pbkdf2")
+SCRYPT_COST = int(os.environ.get("CHATLY_SCRYPT_COST", 2 ** 14))  # n, with r=8 and p=1: 16 MB per hash
+PBKDF2_ITERATIONS = int(os.environ.get("CHATLY_PBKDF2_ITERATIONS", 600000))
+dummy_password_hash = None
+
+def scrypt(password, salt, n, r, p, length=32):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=length)
+
+def password_hash_settings():
+    """The part of a new hash naming the scheme and its parameters"""
+    if PASSWORD_HASH == "scrypt":
+        return f"scrypt${SCRYPT_COST}$8$1"
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}"
+
+def hash_password(password):
+    """'<scheme>$<parameters...>$<salt>$<digest>', salt and digest in base64"""
+    salt = os.urandom(16)
+    if PASSWORD_HASH == "scrypt":
+        digest = scrypt(password, salt, SCRYPT_COST, 8, 1)
+    else:
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS)
+    return f"{password_hash_settings()}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+
+def check_password(password, password_hash):
+    try:
+        scheme, *parameters, salt, digest = password_hash.split("$")
+        salt, digest = base64.b64decode(salt), base64.b64decode(digest)
+        if scheme == "scrypt":
+            computed = scrypt(password, salt, *map(int, parameters), length=len(digest))
+        elif scheme == "pbkdf2_sha256":
+            computed = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, int(parameters[0]), len(digest))
+        else:
+            raise ValueError(f"unknown scheme '{scheme}'")
+    except (ValueError, TypeError) as e:
+        log.error("Unreadable password hash: %s", e)
+        return False
+    return hmac.compare_digest(computed, digest)
+
+def set_password(username, password):
+    """Store a new password hash, dropping any encrypted password left in the user's record"""
+    password_hash = hash_password(password)  # Outside the lock, it takes a while on purpose
+    with user_locks.hold(username):
+        storage.save_credential(username, password_hash)
+        user_data = get_user_data(username)
+        if user_data is not None and "password" in user_data:
+            del user_data["password"]
+            save_user_data(username, user_data)
+
+def verify_password(username, password):
+    """Check a user's password, upgrading how it is stored on success if needed"""
+    global dummy_password_hash
+    password_hash = storage.load_credential(username)
+    if password_hash is None:
+        user_data = get_user_data(username)
+        stored_password = decrypt_data(user_data.get("password")) if user_data else None
+        if stored_password is None:
+            # Costs as much as a wrong password, so the answer doesn't tell which users exist
+            dummy_password_hash = dummy_password_hash or hash_password("")
+            check_password(password, dummy_password_hash)
+            return False
+        if not hmac.compare_digest(stored_password.encode(), password.encode()):
+            return False
+    elif not check_password(password, password_hash):
+        return False
+
+    if password_hash is None or not password_hash.startswith(password_hash_settings() + "$"):
+        set_password(username, password)
     return True
 
+class RateLimiter:
+    """Sliding window: at most `limit` hits per key in any `window` seconds.
+
+    The hits are a SharedState, so with shared storage all workers count
+    together. Keys are stored hashed, keys not hit within the window are
+    dropped, and only the most recently hit max_keys keys are remembered.
+    """
+    def __init__(self, name, limit, window, max_keys=10000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.hits = SharedState(f"ratelimit-{name}", {})  # key -> hit times, least recently hit key first
+
+    @staticmethod
+    def _key(key):
+        # No client addresses or usernames in the state file
+        return hashlib.sha256(str(key).encode()).hexdigest()[:32]
+
+    def _recent(self, hits, key, now):
+        return [t for t in hits.get(key, []) if t > now - self.window]
+
+    def retry_after(self, key):
+        """Seconds until the key may be hit again, 0 if it may be now"""
+        now = time.time()
+        with self.hits.edit(save=False) as hits:
+            times = self._recent(hits, self._key(key), now)
+        if len(times) < self.limit:
+            return 0
+        return times[-self.limit] + self.window - now
+
+    def hit(self, key):
+        now = time.time()
+        key = self._key(key)
+        with self.hits.edit() as hits:
+            times = self._recent(hits, key, now)
+            hits.pop(key, None)
+            hits[key] = (times + [now])[-self.limit:]  # Older hits no longer matter
+            # Dicts keep their order, the least recently hit keys come first
+            for old_key in list(hits):
+                if len(hits) > self.max_keys or hits[old_key][-1] <= now - self.window:
+                    del hits[old_key]
+                else:
+                    break
+
+    def reset(self, key):
+        with self.hits.edit() as hits:
+            hits.pop(self._key(key), None)
+
+# Password guessing is turned away before any storage or hashing work: failed
+# logins and registrations of taken names per client address (see
+# TRUSTED_PROXIES), and wrong passwords per user. Successful ones don't count,
+# so users sharing an address (a proxy, an office) don't lock each other out.
+LOGIN_FAILURES_PER_IP = int(os.environ.get("CHATLY_LOGIN_FAILURES_PER_IP", 30))  # Per minute
+PASSWORD_FAILURES_PER_USER = int(os.environ.get("CHATLY_PASSWORD_FAILURES_PER_USER", 5))  # Per 5 minutes
+login_failures = RateLimiter("login", LOGIN_FAILURES_PER_IP, 60)
+password_failures = RateLimiter("password", PASSWORD_FAILURES_PER_USER, 300)
+
+def throttled_response(retry_after):
+    seconds = math.ceil(retry_after)
+    response = jsonify({"success": False, "message": f"Too many attempts, try again in {seconds} seconds",
+                        "error": "rate_limited"})
+    response.headers["Retry-After"] = str(seconds)
+    return response, 429
+
+def request_data():
+    """The JSON object sent with the request, {} if there is none or the body is something else"""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+def filled_in(*values):
+    """True if every value from a request body is a non-empty string"""
+    return all(isinstance(value, str) and value for value in values)
+
+def load_chat_index(username):
+    return storage.load_chat_index(username)
+
+def update_chat_index(username, chat_id, **fields):
+    """Create or update a chat's index entry, e.g. update_chat_index(user, id, title="...")"""
+    storage.update_chat_entry(username, chat_id, fields)
+
+def rebuild_chat_index(username):
+    return storage.rebuild_chat_index(username)
+
 def get_user_chats(username):
-    user_chats_dir = os.path.join(chats_dir, username)
-    os.makedirs(user_chats_dir, exist_ok=True)
+    index = load_chat_index(username)
+    chats = [{"id": chat_id, **entry} for chat_id, entry in index.items()]
+    # Newest chats first, same order the sidebar adds them in
+    chats.sort(key=lambda chat: chat["created"], reverse=True)
+    return chats
+
+# Full-text search. Each user has an inverted index of the words in their chats,
+# persisted by the storage backend as an append-only sequence of individually
+# encrypted records, so indexing a new message costs one appended record:
+#   P  postings of one message: chat id, position of the message in the chat, term counts
+#   T  terms of a chat's title (the latest T of a chat wins)
+#   D  a chat was deleted, drop everything indexed for it before this record
+# The records are loaded into memory on the first search and afterwards only
+# the ones appended since are read. Snippets are cut from the matching message,
+# read and decrypted on its own.
+SEARCH_INDEX_USERS = int(os.environ.get("CHATLY_SEARCH_INDEX_USERS", 100))  # Indexes kept in memory
+SEARCH_INDEX_COMPACT_THRESHOLD = 500  # Dead records before the index is rewritten
+SEARCH_SNIPPET_LENGTH = 160
+SEARCH_TERM_PATTERN = re.compile(r"\w{2,40}")
+
+def tokenize(text):
+    return SEARCH_TERM_PATTERN.findall(text.lower())
+
+def count_terms(text):
+    counts = {}
+    for term in tokenize(text):
+        counts[term] = counts.get(term, 0) + 1
+    return counts
+
+class SearchIndex:
+    """In-memory inverted index of one user's chats, caught up from the stored records on demand"""
+    def __init__(self, username):
+        self.username = username
+        self.position = None  # Storage read position of the records applied so far
+        self.reset()
+        self.lock = threading.Lock()
+
+    def reset(self):
+        self.postings = {}  # term -> {chat_id: {message position: count}}
+        self.chat_terms = {}  # chat_id -> terms with postings in that chat
+        self.titles = {}  # chat_id -> title terms
+        self.message_count = 0
+        self.dead_records = 0
+
+    def refresh(self):
+        """Apply the records appended since the last call"""
+        records, self.position, restarted = storage.read_search_records(self.username, self.position)
+        if restarted:
+            # The records were rewritten (compacted or rebuilt), start over
+            self.reset()
+        for tag, record in records:
+            self.apply(tag, record)
+
+    def apply(self, tag, record):
+        chat_id = record["c"]
+        if tag == "P":
+            if "i" not in record:
+                # Written when postings held byte offsets into chat logs, have the index rebuilt
+                self.dead_records = SEARCH_INDEX_COMPACT_THRESHOLD
+                return
+            for term, count in record["t"].items():
+                self.postings.setdefault(term, {}).setdefault(chat_id, {})[record["i"]] = count
+            self.chat_terms.setdefault(chat_id, set()).update(record["t"])
+            self.message_count += 1
+        elif tag == "T":
+            self.dead_records += chat_id in self.titles
+            self.titles[chat_id] = set(record["t"])
+        elif tag == "D":
+            positions = set()
+            for term in self.chat_terms.pop(chat_id, ()):
+                chats = self.postings.get(term, {})
+                positions.update(chats.pop(chat_id, {}))
+                if not chats:
+                    self.postings.pop(term, None)
+            self.message_count -= len(positions)
+            self.titles.pop(chat_id, None)
+            self.dead_records += 1
+
+    def search(self, query, limit):
+        """Rank chats containing every query term (the last one as a prefix), best first.
+
+        Returns (chat_id, score, position of the best matching message or None) tuples.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        # The last term may still be being typed, so it matches as a prefix
+        *exact_terms, last = terms
+        term_groups = [[term] for term in exact_terms]
+        term_groups.append([term for term in self.postings if term.startswith(last)] or [last])
+
+        scores = None
+        best_message = {}
+        total = max(self.message_count, 1)
+        for group in term_groups:
+            group_scores = {}
+            for term in group:
+                chats = self.postings.get(term, {})
+                document_frequency = sum(len(positions) for positions in chats.values())
+                idf = math.log(1 + total / max(document_frequency, 1))
+                for chat_id, positions in chats.items():
+                    frequency = sum(positions.values())
+                    group_scores[chat_id] = group_scores.get(chat_id, 0) + idf * (1 + math.log(frequency))
+                    for position, count in positions.items():
+                        best_message.setdefault(chat_id, {}).setdefault(position, 0)
+                        best_message[chat_id][position] += count * idf
+                for chat_id, title_terms in self.titles.items():
+                    if term in title_terms:
+                        # A match in the title counts double
+                        group_scores[chat_id] = group_scores.get(chat_id, 0) + 2 * idf
+            scores = group_scores if scores is None else {
+                chat_id: score + group_scores[chat_id] for chat_id, score in scores.items() if chat_id in group_scores
+            }
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        results = []
+        for chat_id, score in ranked:
+            messages = best_message.get(chat_id)
+            position = max(messages, key=messages.get) if messages else None
+            results.append((chat_id, score, position))
+        return results
+
+search_indexes = OrderedDict()  # username -> SearchIndex, least recently used first
+search_indexes_lock = threading.Lock()
+
+def get_search_index(username):
+    """The user's in-memory search index, loaded (or rebuilt) on first use"""
+    with search_indexes_lock:
+        index = search_indexes.get(username)
+        if index is not None:
+            search_indexes.move_to_end(username)
+            return index
+
+    if not storage.has_search_records(username):
+        rebuild_search_index(username)
+    index = SearchIndex(username)
+    with search_indexes_lock:
+        index = search_indexes.setdefault(username, index)
+        while len(search_indexes) > SEARCH_INDEX_USERS:
+            search_indexes.popitem(last=False)
+    return index
+
+def forget_search_index(username):
+    """Drop a user's in-memory search index, e.g. when their records are deleted"""
+    with search_indexes_lock:
+        search_indexes.pop(username, None)
+
+def search_records_for(chat_id, title, start, messages):
+    """Search records for a chat's title and for messages stored from position `start` on"""
+    records = []
+    if title is not None:
+        records.append(("T", {"c": chat_id, "t": sorted(count_terms(title))}))
+    for position, message in enumerate(messages, start):
+        terms = count_terms(message.get("content", ""))
+        if terms:
+            records.append(("P", {"c": chat_id, "i": position, "t": terms}))
+    return records
+
+def build_search_records(store, username):
+    """Search records for every chat of a user in the given storage backend.
+
+    Called while holding a chat's lock (a first append indexes everything), so
+    the chats are read without compacting them, which would take their locks.
+    """
+    records = []
+    for chat_id in store.list_chat_ids(username):
+        chat_data = store.load_chat(username, chat_id, compact=False)
+        if chat_data is not None:
+            records.extend(search_records_for(chat_id, chat_data.get("title"), 0, chat_data.get("messages", [])))
+    return records
+
+def append_search_records(username, records):
+    if not records:
+        return
+    if not storage.has_search_records(username):
+        # Index everything, including chats written before search existed
+        rebuild_search_index(username)
+        return
+    storage.append_search_records(username, records)
+
+def index_chat_messages(username, chat_id, start, messages, title=None):
+    """Add messages just stored from position `start` of a chat to the search index"""
+    append_search_records(username, search_records_for(chat_id, title, start, messages))
+
+def reindex_chat(username, chat_id, title, messages):
+    """Replace everything indexed for a chat, e.g. after it was rewritten as a whole"""
+    append_search_records(username, [("D", {"c": chat_id})] + search_records_for(chat_id, title, 0, messages))
+
+def unindex_chat(username, chat_id):
+    if storage.has_search_records(username):
+        storage.append_search_records(username, [("D", {"c": chat_id})])
+
+def rebuild_search_index(username):
+    """Replace a user's search records with fresh ones from their chats. Returns the number of chats indexed"""
+    storage.replace_search_records(username, build_search_records(storage, username))
+    return len(storage.list_chat_ids(username))
+
+def make_snippet(content, query):
+    """A SEARCH_SNIPPET_LENGTH window of content around the first query term it contains"""
+    lowered = content.lower()
+    positions = [lowered.find(term) for term in tokenize(query)]
+    positions = [position for position in positions if position >= 0]
+    start = max(0, min(positions) - SEARCH_SNIPPET_LENGTH // 4) if positions else 0
+    snippet = content[start:start + SEARCH_SNIPPET_LENGTH].strip()
+    return ("..." if start > 0 else "") + snippet + ("..." if start + SEARCH_SNIPPET_LENGTH < len(content) else "")
+
+def search_chats(username, query, limit=20):
+    index = get_search_index(username)
+    with index.lock:
+        index.refresh()
+        if index.dead_records >= SEARCH_INDEX_COMPACT_THRESHOLD:
+            rebuild_search_index(username)
+            index.refresh()
+        matches = index.search(query, limit)
+
+    chat_index = load_chat_index(username)
+    results = []
+    for chat_id, score, position in matches:
+        result = {
+            "chat_id": chat_id,
+            "title": chat_index.get(chat_id, {}).get("title", "New Chat"),
+            "score": round(score, 3),
+            "snippet": None
+        }
+        page = read_chat_page(username, chat_id, 1, position + 1) if position is not None else None
+        if page and page[0]["messages"]:
+            message = page[0]["messages"][0]
+            result.update(snippet=make_snippet(message.get("content", ""), query),
+                          role=message.get("role"), timestamp=message.get("timestamp"))
+        results.append(result)
+    return results
+
+def get_chat_data(username, chat_id):
+    chat_data = chat_cache.get((username, chat_id), chat_stamp(username, chat_id))
+    if chat_data is not None:
+        return chat_data
+
+    # Loaded under the chat's lock so a write landing meanwhile can't be cached over with an older copy
+    with chat_locks.hold(username, chat_id):
+        chat_data = storage.load_chat(username, chat_id)
+        if chat_data is not None:
+            chat_cache.set((username, chat_id), json.dumps(chat_data), chat_stamp(username, chat_id))
+    return chat_data
+
+def read_chat_page(username, chat_id, limit=None, before=None, since=None):
+    """A slice of a chat's messages, returns (chat_data with only those messages, index of the first, total) or None.
+
+    `before` (a message index) pages backwards from the newest message, `since`
+    (a timestamp) returns the messages from that time on. Unless the chat is
+    cached, the backend decrypts only the returned messages.
+    """
+    cached = chat_cache.get((username, chat_id), chat_stamp(username, chat_id))
+    if cached is not None:
+        return slice_chat(cached, limit, before, since)
+    return storage.load_chat_page(username, chat_id, limit, before, since)
+
+def count_chat_messages(username, chat_id):
+    chat_data = chat_cache.get((username, chat_id), chat_stamp(username, chat_id))
+    return len(chat_data["messages"]) if chat_data is not None else storage.count_messages(username, chat_id)
+
+def save_chat_data(username, chat_id, data):
+    with chat_locks.hold(username, chat_id):
+        storage.write_chat(username, chat_id, data)
+        reindex_chat(username, chat_id, data.get("title"), data.get("messages", []))
+        chat_cache.set((username, chat_id), json.dumps(data), chat_stamp(username, chat_id))
+    return True
+
+def append_chat_messages(username, chat_id, messages, metadata=None):
+    """Append messages (and optionally a metadata update) to a chat without rewriting it.
+
+    Returns the number of messages in the chat afterwards.
+    """
+    with chat_locks.hold(username, chat_id):
+        chat_data = chat_cache.get((username, chat_id), chat_stamp(username, chat_id))
+        # Position of the first new message, for the search postings
+        start = len(chat_data["messages"]) if chat_data is not None else storage.count_messages(username, chat_id)
+        storage.append_chat(username, chat_id, messages, metadata)
+        index_chat_messages(username, chat_id, start, messages, (metadata or {}).get("title"))
+
+        # Write-through: apply the same update to the cached copy, if there is one
+        if chat_data is not None:
+            chat_data.update(metadata or {})
+            chat_data["messages"].extend(messages)
+            chat_cache.set((username, chat_id), json.dumps(chat_data), chat_stamp(username, chat_id))
+    return start + len(messages)
+
+def update_chat_metadata(username, chat_id, metadata):
+    return append_chat_messages(username, chat_id, [], metadata)
+
+def delete_chat_data(username, chat_id):
+    """Delete a chat, its index entry and its search postings"""
+    # A reply still being generated would otherwise bring the chat back when it is saved
+    generation_jobs.cancel(username, chat_id=chat_id, reason="deleted")
+    with chat_locks.hold(username, chat_id):
+        chat_cache.delete((username, chat_id))
+        unindex_chat(username, chat_id)
+        storage.delete_chat(username, chat_id)
+
+def delete_all_chats(username):
+    generation_jobs.cancel(username, reason="deleted")
+    chat_cache.delete_where(lambda key: key[0] == username)
+    forget_search_index(username)
+    storage.delete_user_chats(username)
+
+def get_current_model(username):
+    user_data = get_user_data(username)
+    if user_data and 'model' in user_data:
+        # Check if the model is already a full name with version
+        if ':' in user_data['model']:
+            return user_data['model']
+            
+        # For backward compatibility, handle old short names
+        model_map = {
+            # Legacy model name mapping
+            'mistral': 'mistral:latest',
+            'gemma': 'gemma3:1b',
+            'tinyllama': 'tinyllama:latest',
+            'phi3': 'phi3:3.8b',
+            'phi': 'phi:latest',
+            'deepseek-coder': 'deepseek-coder:latest',
+            'deepseek-r1': 'deepseek-r1:8b',
+            'tinystories': 'gurubot/tinystories-656k-q8:latest',
+            'llama2-uncensored': 'llama2-uncensored:latest',
+            'llava': 'llava:7b',
+            'phi4-mini': 'phi4-mini:latest',
+            'phi4': 'phi4:latest',
+            'codellama': 'codellama:latest',
+            'smollm-1.7b': 'smollm:1.7b',
+            'smollm-135m': 'smollm:135m',
+            'qwen3-8b': 'qwen3:8b',
+            'qwen3-0.6b': 'qwen3:0.6b',
+            'deepscaler': 'deepscaler:latest',
+            'dolphin-mistral': 'dolphin-mistral:latest',
+            'dolphin-phi': 'dolphin-phi:latest'
+        }
+
+        return model_map.get(user_data['model'], DEFAULT_MODEL)
+    return DEFAULT_MODEL
+
+# Generation scheduler. Generations are queued per model, each model runs at
+# most MODEL_CONCURRENCY generations at once and at most MAX_ACTIVE_MODELS
+# models run at the same time, so Ollama is not made to swap models in and out
+# of memory. Queued requests for a model that is already running go first,
+# unless another model has been waiting longer than MODEL_SWITCH_WAIT. Worker
+# processes keep their own queues but share what each is running (a SharedState),
+# so the limits hold for all of them together; a worker with requests waiting for
+# another worker's generations to end checks again every SCHEDULER_POLL_INTERVAL.
+# Fairness across users only looks at the worker's own generations.
+MODEL_CONCURRENCY = int(os.environ.get("CHATLY_MODEL_CONCURRENCY", 2))
+MAX_ACTIVE_MODELS = int(os.environ.get("CHATLY_MAX_ACTIVE_MODELS", 1))
+MODEL_SWITCH_WAIT = float(os.environ.get("CHATLY_MODEL_SWITCH_WAIT", 20))
+QUEUE_TIMEOUT = float(os.environ.get("CHATLY_QUEUE_TIMEOUT", 300))  # Max seconds a request waits for its turn
+SCHEDULER_POLL_INTERVAL = 0.5
+QUEUE_BUSY_MESSAGE = "All models are busy right now and your message could not be processed in time. Please try again in a moment."
+
+class GenerationTicket:
+    """A queued or running generation, granted by GenerationScheduler"""
+    def __init__(self, username, model):
+        self.id = uuid.uuid4().hex
+        self.username = username
+        self.model = model
+        self.enqueued_at = time.time()
+        self.granted = threading.Event()
+        self.released = False
+        self.callbacks = []
     
-    chats = []
-    for file in os.listdir(user_chats_dir):
-        if file.endswith(".json"):
-            chat_id = file.split(".")[0]
-            chat_path = os.path.join(user_chats_dir, file)
+    def wait(self, timeout=None):
+        return self.granted.wait(timeout)
+
+class GenerationScheduler:
+    def __init__(self, model_concurrency, max_active_models, switch_wait):
+        self.model_concurrency = model_concurrency
+        self.max_active_models = max_active_models
+        self.switch_wait = switch_wait
+        self.waiting = {}  # model -> list of tickets, oldest first
+        self.running = {}  # model -> list of tickets
+        self.workers = SharedState("scheduler", {})  # pid -> {model: generations running}
+        self.last_model = None
+        self.poller = None
+        self.lock = threading.Lock()
+    
+    def submit(self, username, model, on_granted=None):
+        """Queue a generation. on_granted, if given, is called (from any thread) once it may start"""
+        ticket = GenerationTicket(username, model)
+        if on_granted:
+            ticket.callbacks.append(on_granted)
+        with self.lock:
+            self.waiting.setdefault(model, []).append(ticket)
+            granted = self._dispatch()
+            if SHARED_STORAGE and self.waiting and self.poller is None:
+                self.poller = threading.Thread(target=self._poll, name="chatly-scheduler", daemon=True)
+                self.poller.start()
+        self._notify(granted)
+        return ticket
+    
+    def release(self, ticket):
+        """Finish a running generation, or give up on a waiting one"""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            for queues in (self.running, self.waiting):
+                tickets = queues.get(ticket.model, [])
+                if ticket in tickets:
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del queues[ticket.model]
+            granted = self._dispatch()
+        self._notify(granted)
+    
+    def position(self, ticket):
+        """1-based position among the requests waiting for the same model, 0 once running"""
+        with self.lock:
+            tickets = self.waiting.get(ticket.model, [])
+            return tickets.index(ticket) + 1 if ticket in tickets else 0
+    
+    def busy_models(self):
+        """Models with generations waiting in this worker or running in any"""
+        with self.lock:
+            busy = set(self.running) | set(self.waiting)
+        with self.workers.edit(save=False) as workers:
+            for running in workers.values():
+                busy.update(running)
+        return busy
+    
+    def stats(self):
+        with self.lock:
+            models = set(self.waiting) | set(self.running)
+            return {
+                model: {
+                    "waiting": len(self.waiting.get(model, [])),
+                    "running": len(self.running.get(model, []))
+                }
+                for model in sorted(models)
+            }
+    
+    def _dispatch(self):
+        """Grant as many waiting tickets as the limits allow. Called with the lock held"""
+        granted = []
+        pid = os.getpid()
+        with self.workers.edit() as workers:
+            others = {}  # model -> generations running in other workers
+            for worker, running in list(workers.items()):
+                if int(worker) == pid:
+                    continue
+                if not process_alive(int(worker)):
+                    del workers[worker]
+                    continue
+                for model, count in running.items():
+                    others[model] = others.get(model, 0) + count
             
-            with open(chat_path, "r") as f:
-                encrypted_data = f.read()
-                decrypted_data = decrypt_data(encrypted_data)
-                if decrypted_data:
-                    chat_data = json.loads(decrypted_data)
-                    title = chat_data.get("title", "New Chat")
-                    chats.append({"id": chat_id, "title": title})
+            while True:
+                model = self._next_model(others)
+                if model is None:
+                    break
+                ticket = self._next_ticket(model)
+                self.waiting[model].remove(ticket)
+                if not self.waiting[model]:
+                    del self.waiting[model]
+                self.running.setdefault(model, []).append(ticket)
+                self.last_model = model
+                granted.append(ticket)
+            
+            if self.running:
+                workers[str(pid)] = {model: len(tickets) for model, tickets in self.running.items()}
+            else:
+                workers.pop(str(pid), None)
+        return granted
     
-    return chats
+    def _poll(self):
+        """Dispatch again now and then while tickets wait: other workers don't say when theirs end"""
+        while True:
+            time.sleep(SCHEDULER_POLL_INTERVAL)
+            with self.lock:
+                if not self.waiting:
+                    self.poller = None
+                    return
+                granted = self._dispatch()
+            self._notify(granted)
+    
+    def _next_model(self, others):
+        now = time.time()
+        active = set(self.running) | set(others)
+        
+        def running(model):
+            return len(self.running.get(model, [])) + others.get(model, 0)
+        
+        # Models that are already loaded (running) keep going while they have capacity...
+        loaded = [model for model in active if model in self.waiting and running(model) < self.model_concurrency]
+        # ...unless a model that is not loaded has waited too long, then they drain
+        starving = [model for model in self.waiting if model not in active and model != self.last_model
+                    and now - self.waiting[model][0].enqueued_at >= self.switch_wait]
+        if loaded and not (starving and len(active) >= self.max_active_models):
+            return min(loaded, key=lambda model: self.waiting[model][0].enqueued_at)
+        
+        if len(active) >= self.max_active_models:
+            return None
+        candidates = [model for model in self.waiting if model not in active]
+        if not candidates:
+            return None
+        if starving:
+            return min(starving, key=lambda model: self.waiting[model][0].enqueued_at)
+        # Otherwise prefer the model used last, it is most likely still in memory
+        if self.last_model in candidates:
+            return self.last_model
+        return min(candidates, key=lambda model: self.waiting[model][0].enqueued_at)
+    
+    def _next_ticket(self, model):
+        # Fairness across users: whoever has the fewest generations running goes first
+        running_per_user = {}
+        for tickets in self.running.values():
+            for ticket in tickets:
+                running_per_user[ticket.username] = running_per_user.get(ticket.username, 0) + 1
+        return min(self.waiting[model], key=lambda ticket: (running_per_user.get(ticket.username, 0), ticket.enqueued_at))
+    
+    def _notify(self, tickets):
+        for ticket in tickets:
+            ticket.granted.set()
+            for callback in ticket.callbacks:
+                callback()
 
-def get_chat_data(username, chat_id):
-    chat_file = os.path.join(chats_dir, username, f"{chat_id}.json")
-    if not os.path.exists(chat_file):
+generation_scheduler = GenerationScheduler(MODEL_CONCURRENCY, MAX_ACTIVE_MODELS, MODEL_SWITCH_WAIT)
+
+# Generation jobs. Every reply is generated by a background job, decoupled from
+# the HTTP request that started it: requests only follow the job's events. The
+# job keeps the chunks produced so far, so a client that lost its stream (a page
+# reload, a proxy idle timeout) reattaches with /api/resume_generation and the
+# number of token events it already has. A job nobody follows for RESUME_GRACE
+# seconds is cancelled, like one stopped with /api/cancel_generation: the
+# connection to Ollama is closed at once, which makes Ollama stop generating,
+# and the partial reply is saved marked as cancelled. With shared storage the
+# events are also spooled, encrypted, to JOBS_DIR so a client can reattach
+# through any worker, and a cancel request that reaches a worker not running
+# the job is left in CANCEL_DIR. Workers with jobs poll both directories.
+RESUME_GRACE = float(os.environ.get("CHATLY_RESUME_GRACE", 30))
+STREAM_KEEPALIVE = float(os.environ.get("CHATLY_STREAM_KEEPALIVE", 15))  # Ping a stream idle this long
+JOB_RETENTION = 60  # Seconds a finished job can still be followed
+JOBS_DIR = "Data/jobs"
+CANCEL_DIR = "Data/cancel"
+JOB_POLL_INTERVAL = 0.5
+SPOOL_POLL_INTERVAL = 0.1
+SPOOL_HEARTBEAT = 2  # The worker running a job touches its spool this often...
+SPOOL_STALE = 10  # ...so a spool untouched this long lost its worker
+SPOOL_MAX_AGE = 3600
+CANCEL_MARKER_TTL = 60
+
+class GenerationJob:
+    """A reply being generated in the background, followed by any number of streams.
+
+    Its events are dicts: {"q": position} while queued, {"t": text} per chunk
+    and {"d": assistant message, "title": title} once the turn is saved, with
+    "d" None if the turn was dropped after a cancel (see finish_chat_turn).
+    """
+    def __init__(self, username, chat_id, title, user_message, position):
+        self.id = uuid.uuid4().hex
+        self.username = username
+        self.chat_id = chat_id
+        self.title = title
+        self.user_message = user_message
+        self.position = position  # Index of user_message in the chat
+        self.started_at = time.time()
+        self.cancelled = threading.Event()
+        self.abort = None  # Closes the open connection to Ollama, see attach()
+        self.lock = threading.Lock()
+        self.changed = threading.Condition()
+        self.chunks = []  # The reply so far, one entry per token event
+        self.queue_position = 0
+        self.result = None  # The saved assistant message
+        self.finished_at = None
+        self.followers = 0
+        self.listeners = []  # Called after every change, from the job's thread
+        self.detached_at = None  # Since when nobody follows the job
+        self.spool = None
+
+    def attach(self, abort):
+        """Register how to close the connection to Ollama while it is open (None once it is closed)"""
+        with self.lock:
+            self.abort = abort
+            cancelled = self.cancelled.is_set()
+        if abort and cancelled:
+            abort()
+
+    def cancel(self, reason):
+        with self.lock:
+            if self.cancelled.is_set() or self.finished_at:
+                return False
+            self.cancelled.set()
+            abort = self.abort
+        generations_cancelled.inc(reason=reason)
+        log.info("Generation cancelled", extra={"user": self.username, "chat_id": self.chat_id,
+                                                "job_id": self.id, "reason": reason})
+        if abort:
+            abort()
+        return True
+
+    def add_chunk(self, content):
+        with self.changed:
+            self.chunks.append(content)
+        self._publish({"t": content})
+
+    def set_queue_position(self, position):
+        with self.changed:
+            if position == self.queue_position:
+                return
+            self.queue_position = position
+        self._publish({"q": position})
+
+    def complete(self, assistant_message):
+        with self.changed:
+            self.result = assistant_message
+            self.finished_at = time.time()
+        self._publish(self.final_event())
+
+    def final_event(self):
+        """The event that ends a finished job, None if it failed"""
+        if self.result or self.cancelled.is_set():
+            return {"d": self.result, "title": self.title}
+        return None
+
+    def _publish(self, event):
+        if self.spool and event:
+            self.spool.write(event)
+        with self.changed:
+            self.changed.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def follow(self, listener=None):
+        with self.changed:
+            self.followers += 1
+            self.detached_at = None
+            if listener:
+                self.listeners.append(listener)
+
+    def unfollow(self, listener=None):
+        with self.changed:
+            self.followers -= 1
+            if listener:
+                self.listeners.remove(listener)
+            if not self.followers:
+                self.detached_at = time.time()
+
+    def events_since(self, offset, queue_position):
+        """Events for a follower that has `offset` chunks and saw `queue_position`: (events, queue position, done)"""
+        with self.changed:
+            events = [{"t": chunk} for chunk in self.chunks[offset:]]
+            if self.queue_position != queue_position:
+                events.insert(0, {"q": self.queue_position})
+            if self.finished_at and self.final_event():
+                events.append(self.final_event())
+            return events, self.queue_position, self.finished_at is not None
+
+    def wait_for_change(self, offset, queue_position, timeout):
+        """Block until events_since(offset, queue_position) has something, False on timeout"""
+        with self.changed:
+            return self.changed.wait_for(lambda: len(self.chunks) > offset or self.finished_at
+                                         or self.queue_position != queue_position, timeout)
+
+def follow_job(job, offset=0):
+    """Yield a local job's events from chunk `offset` on until it is done, {} when idle for STREAM_KEEPALIVE"""
+    job.follow()
+    try:
+        queue_position = 0
+        while True:
+            if not job.wait_for_change(offset, queue_position, STREAM_KEEPALIVE):
+                yield {}
+                continue
+            events, queue_position, finished = job.events_since(offset, queue_position)
+            for event in events:
+                offset += "t" in event
+                yield event
+            if finished:
+                return
+    finally:
+        job.unfollow()
+
+class JobSpool:
+    """A job's events in a file, one line each, so a stream in any worker can follow it.
+
+    The first line is a plain JSON header with the job id, user and chat id,
+    the second an encrypted {"s": {"title", "message", "position"}} and then
+    one encrypted line per event.
+    """
+    def __init__(self, path, job):
+        self.path = path
+        self.lock = threading.Lock()
+        self.touched = time.time()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "ab", buffering=0)
+        header = {"job_id": job.id, "user": job.username, "chat_id": job.chat_id}
+        start = {"s": {"title": job.title, "message": job.user_message, "position": job.position}}
+        self.file.write(json.dumps(header).encode() + b"\n" + self.encrypt(start))
+
+    @staticmethod
+    def encrypt(event):
+        return key_ring.encrypt(json.dumps(event).encode()) + b"\n"
+
+    def write(self, event):
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(self.encrypt(event))
+                self.touched = time.time()
+
+    def heartbeat(self):
+        if time.time() - self.touched >= SPOOL_HEARTBEAT:
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                pass
+            self.touched = time.time()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def read_spool(path, offset=0):
+    """The complete lines of a spool from byte `offset` on, and the offset after them"""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    return data[:end].splitlines(), offset + end
+
+def read_spool_info(path):
+    """Header and start of a spool merged into one dict, with "done" once the reply is saved; None if unreadable"""
+    try:
+        lines, _ = read_spool(path)
+        info = json.loads(lines[0])
+        info.update(json.loads(key_ring.decrypt(lines[1]))["s"])
+        info["done"] = len(lines) > 2 and "d" in json.loads(key_ring.decrypt(lines[-1]))
+        info["stale"] = time.time() - os.path.getmtime(path) > SPOOL_STALE
+        return info
+    except (OSError, IndexError, ValueError, InvalidToken):
+        return None
+
+def follow_spool(path, attached_path, offset=0):
+    """Like follow_job, for a job running in another worker: tail its spool and tell that worker it is followed"""
+    position = 0
+    seen = 0
+    touched = 0
+    idle_since = time.time()
+    while True:
+        now = time.time()
+        try:
+            lines, position = read_spool(path, position)
+            if not lines and now - os.path.getmtime(path) > SPOOL_STALE:
+                return  # The worker running the job is gone
+            if now - touched >= 1:
+                with open(attached_path, "a"):
+                    os.utime(attached_path)
+                touched = now
+        except FileNotFoundError:
+            return
+        for line in lines:
+            if line.startswith(b"{"):
+                continue  # The plain header
+            event = json.loads(key_ring.decrypt(line))
+            if "t" in event:
+                seen += 1
+                if seen <= offset:
+                    continue
+            elif "s" in event or ("q" in event and seen < offset):
+                continue
+            yield event
+            if "d" in event:
+                return
+        if lines:
+            idle_since = now
+        elif now - idle_since >= STREAM_KEEPALIVE:
+            yield {}
+            idle_since = now
+        time.sleep(SPOOL_POLL_INTERVAL)
+
+class GenerationJobs:
+    def __init__(self, jobs_dir, cancel_dir):
+        self.jobs_dir = jobs_dir
+        self.cancel_dir = cancel_dir
+        self.jobs = {}  # id -> GenerationJob, kept JOB_RETENTION seconds after they finish
+        self.lock = threading.Lock()
+        self.poller = None
+
+    def spool_path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.spool")
+
+    def attached_path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.attached")
+
+    def start(self, job):
+        if SHARED_STORAGE:
+            job.spool = JobSpool(self.spool_path(job.id), job)
+        with self.lock:
+            self.jobs[job.id] = job
+            if self.poller is None:
+                self.poller = threading.Thread(target=self._poll, name="chatly-job-poller", daemon=True)
+                self.poller.start()
+        return job
+
+    def finish(self, job, assistant_message):
+        job.complete(assistant_message)
+        if job.spool:
+            job.spool.close()
+
+    def get(self, username, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return job if job and job.username == username else None
+
+    def open_stream(self, username, chat_id, job_id, offset=0):
+        """(title, events) to follow a job from chunk `offset` on, wherever it runs; None if it is gone"""
+        job = self.get(username, job_id)
+        if job and job.chat_id == chat_id:
+            return job.title, follow_job(job, offset)
+        if not SHARED_STORAGE or not re.fullmatch(r"[0-9a-f]{32}", job_id):
+            return None
+        info = read_spool_info(self.spool_path(job_id))
+        if not info or info["user"] != username or info["chat_id"] != chat_id or info["stale"]:
+            return None
+        return info["title"], follow_spool(self.spool_path(job_id), self.attached_path(job_id), offset)
+
+    def running_in_chat(self, username, chat_id):
+        """{"job_id", "message", "position"} of a reply still being generated in the chat, or None"""
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job.username == username
+                    and job.chat_id == chat_id and not job.finished_at]
+        if jobs:
+            job = max(jobs, key=lambda job: job.started_at)
+            return {"job_id": job.id, "message": job.user_message, "position": job.position}
+        if not SHARED_STORAGE or not os.path.isdir(self.jobs_dir):
+            return None
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith(".spool") or name[:-len(".spool")] in self.jobs:
+                continue
+            try:
+                with open(os.path.join(self.jobs_dir, name), "rb") as f:
+                    header = json.loads(f.readline())
+            except (OSError, ValueError):
+                continue
+            if header["user"] == username and header["chat_id"] == chat_id:
+                info = read_spool_info(os.path.join(self.jobs_dir, name))
+                if info and not info["done"] and not info["stale"]:
+                    return {"job_id": info["job_id"], "message": info["message"], "position": info["position"]}
         return None
+
+    def cancel(self, username, job_id=None, chat_id=None, reason="request"):
+        """Cancel the user's job `job_id`, all their jobs in `chat_id`, or with neither all their jobs.
+        True if one was found or may run elsewhere"""
+        with self.lock:
+            found = [job for job in self.jobs.values() if job.username == username and not job.finished_at
+                     and (job.id == job_id if job_id else chat_id is None or job.chat_id == chat_id)]
+        for job in found:
+            job.cancel(reason)
+        if not SHARED_STORAGE or (found and job_id):
+            return bool(found)
+
+        # The job may be running in another worker, or other jobs in the chat
+        os.makedirs(self.cancel_dir, exist_ok=True)
+        marker = {"user": username, "job_id": job_id, "chat_id": chat_id, "reason": reason, "at": time.time()}
+        atomic_write(os.path.join(self.cancel_dir, f"{uuid.uuid4().hex}.json"), json.dumps(marker))
+        return True
+
+    def _poll(self):
+        while True:
+            time.sleep(JOB_POLL_INTERVAL)
+            with self.lock:
+                jobs = list(self.jobs.values())
+            if not jobs:
+                continue
+            now = time.time()
+            for job in jobs:
+                if job.finished_at:
+                    if now - job.finished_at > JOB_RETENTION:
+                        self._forget(job)
+                    continue
+                if job.spool:
+                    job.spool.heartbeat()
+                if job.detached_at and now - max(job.detached_at, self._attached_at(job)) > RESUME_GRACE:
+                    job.cancel("disconnect")
+            if SHARED_STORAGE:
+                self._read_cancel_markers(jobs)
+                self._remove_stale_spools(now)
+
+    def _forget(self, job):
+        with self.lock:
+            self.jobs.pop(job.id, None)
+        if job.spool:
+            for path in (self.spool_path(job.id), self.attached_path(job.id)):
+                self._remove(path)
+
+    def _attached_at(self, job):
+        """When a stream in another worker last said it follows the job"""
+        if not job.spool:
+            return 0
+        try:
+            return os.path.getmtime(self.attached_path(job.id))
+        except FileNotFoundError:
+            return 0
+
+    def _read_cancel_markers(self, jobs):
+        """Cancel the local jobs named by markers other workers left in cancel_dir"""
+        try:
+            names = os.listdir(self.cancel_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.cancel_dir, name)
+            try:
+                with open(path, "r") as f:
+                    marker = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if time.time() - marker["at"] > CANCEL_MARKER_TTL:
+                self._remove(path)
+                continue
+            for job in jobs:
+                # A chat-wide cancel only applies to jobs that were already running
+                if job.username == marker["user"] and (job.id == marker["job_id"] if marker["job_id"]
+                                                       else marker["chat_id"] in (None, job.chat_id)
+                                                       and job.started_at <= marker["at"]):
+                    job.cancel(marker["reason"])
+                    if marker["job_id"]:
+                        self._remove(path)
+
+    def _remove_stale_spools(self, now):
+        """Spools left behind by workers that died"""
+        for name in os.listdir(self.jobs_dir) if os.path.isdir(self.jobs_dir) else ():
+            path = os.path.join(self.jobs_dir, name)
+            try:
+                if now - os.path.getmtime(path) > SPOOL_MAX_AGE:
+                    self._remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+generation_jobs = GenerationJobs(JOBS_DIR, CANCEL_DIR)
+
+# Model residency. A user's model is loaded in the background when they log in
+# or pick it in the settings, so the first message does not pay for the load.
+# Every request tells Ollama how long to keep the model loaded: models asked for
+# often in the last MODEL_DEMAND_WINDOW seconds are kept longer, and past
+# MAX_RESIDENT_MODELS the least used idle model is unloaded.
+MODEL_KEEP_ALIVE_MIN = int(os.environ.get("CHATLY_MODEL_KEEP_ALIVE_MIN", 300))
+MODEL_KEEP_ALIVE_MAX = int(os.environ.get("CHATLY_MODEL_KEEP_ALIVE_MAX", 3600))
+MODEL_DEMAND_WINDOW = int(os.environ.get("CHATLY_MODEL_DEMAND_WINDOW", 900))
+MAX_RESIDENT_MODELS = int(os.environ.get("CHATLY_MAX_RESIDENT_MODELS", 2))
+MODEL_LOAD_TIMEOUT = float(os.environ.get("CHATLY_MODEL_LOAD_TIMEOUT", 300))
+
+class ModelResidencyManager:
+    def __init__(self, max_resident, keep_alive_min, keep_alive_max, demand_window):
+        self.max_resident = max_resident
+        self.keep_alive_min = keep_alive_min
+        self.keep_alive_max = keep_alive_max
+        self.demand_window = demand_window
+        # "demand": model -> timestamps of recent requests, "resident": model -> time
+        # until which Ollama keeps it loaded. Shared by the worker processes
+        self.state = SharedState("models", {"demand": {}, "resident": {}})
+        self.loading = set()  # Preloads running in this process
+        self.lock = threading.Lock()
     
-    with open(chat_file, "r") as f:
-        encrypted_data = f.read()
-        decrypted_data = decrypt_data(encrypted_data)
-        if decrypted_data:
-            return json.loads(decrypted_data)
-    return None
+    def _recent_demand(self, state, model, now):
+        """Requests for model within the demand window, dropping older ones from state"""
+        timestamps = [t for t in state["demand"].get(model, []) if t > now - self.demand_window]
+        if timestamps:
+            state["demand"][model] = timestamps
+        else:
+            state["demand"].pop(model, None)
+        return len(timestamps)
+    
+    def keep_alive(self, model):
+        """The keep_alive (seconds) to send with the next request for model, counting that request"""
+        now = time.time()
+        with self.state.edit(save=False) as state:
+            recent = sum(1 for t in state["demand"].get(model, []) if t > now - self.demand_window)
+        return min(self.keep_alive_max, self.keep_alive_min * (recent + 1))
+    
+    def record(self, model, keep_alive, demand=True):
+        """Note a request Ollama accepted for model: it stays loaded for keep_alive seconds.
+        Preloads pass demand=False, only requests for a reply count as demand"""
+        now = time.time()
+        with self.state.edit() as state:
+            if demand:
+                state["demand"].setdefault(model, []).append(now)
+                self._recent_demand(state, model, now)
+            state["resident"][model] = now + keep_alive
+    
+    def is_resident(self, model):
+        with self.state.edit(save=False) as state:
+            return state["resident"].get(model, 0) > time.time()
+    
+    def preload(self, model):
+        """Load model in the background, unless it is loaded or already loading"""
+        if mock_mode() or self.is_resident(model):
+            return
+        with self.lock:
+            if model in self.loading:
+                return
+            self.loading.add(model)
+        threading.Thread(target=self._load, args=(model,), daemon=True).start()
+    
+    def _load(self, model):
+        started = time.perf_counter()
+        keep_alive = self.keep_alive(model)
+        try:
+            # A generate request without a prompt only loads the model
+            response = ollama_session.post(
+                f"{OLLAMA_URL}/api/generate",
+                json={"model": model, "keep_alive": keep_alive},
+                timeout=(OLLAMA_CONNECT_TIMEOUT, MODEL_LOAD_TIMEOUT)
+            )
+            response.raise_for_status()
+            self.record(model, keep_alive, demand=False)
+            log.info("Model preloaded", extra={"model": model, "latency": round(time.perf_counter() - started, 3)})
+        except requests.exceptions.RequestException as e:
+            log.warning("Could not preload %s: %s", model, e, extra={"model": model})
+        finally:
+            with self.lock:
+                self.loading.discard(model)
+        self.evict_cold(keep=model)
+    
+    def evict_cold(self, keep=None):
+        """Unload the least demanded idle models while more than max_resident are loaded"""
+        now = time.time()
+        busy = generation_scheduler.busy_models()
+        with self.lock:
+            busy |= self.loading
+        with self.state.edit() as state:
+            resident = state["resident"]
+            for model, expires_at in list(resident.items()):
+                if expires_at <= now:
+                    del resident[model]
+            idle = [model for model in resident if model not in busy and model != keep]
+            idle.sort(key=lambda model: (self._recent_demand(state, model, now), max(state["demand"].get(model) or [0])))
+            evicted = idle[:max(0, len(resident) - self.max_resident)]
+            for model in evicted:
+                del resident[model]
+        
+        for model in evicted:
+            try:
+                ollama_session.post(f"{OLLAMA_URL}/api/generate", json={"model": model, "keep_alive": 0},
+                                    timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT))
+                log.info("Model unloaded", extra={"model": model})
+            except requests.exceptions.RequestException as e:
+                log.warning("Could not unload %s: %s", model, e, extra={"model": model})
+    
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            loading = set(self.loading)
+        with self.state.edit(save=False) as state:
+            return {
+                model: {
+                    "keep_alive_left": round(expires_at - now),
+                    "recent_requests": sum(1 for t in state["demand"].get(model, []) if t > now - self.demand_window),
+                    "loading": model in loading
+                }
+                for model, expires_at in state["resident"].items() if expires_at > now
+            }
+
+model_residency = ModelResidencyManager(MAX_RESIDENT_MODELS, MODEL_KEEP_ALIVE_MIN, MODEL_KEEP_ALIVE_MAX,
+                                        MODEL_DEMAND_WINDOW)
+
+# User settings, kept in the user record (passwords are in the credential
+# index). Every setting with its allowed values (or type) and default; anything
+# else sent to /api/update_settings is refused.
+COLOR_THEMES = ("blue", "green", "monochrome", "orange", "purple", "rose", "teal")
+SETTINGS_SCHEMA = {
+    "theme": (("dark", "light"), "dark"),
+    "colorTheme": (COLOR_THEMES, "blue"),
+    "model": (str, DEFAULT_MODEL),
+    "compactSidebar": (bool, True),
+    "glassmorphism": (bool, True),
+    "animations": (bool, True),
+    "fontSize": (("small", "medium", "large"), "medium"),
+    "showLineNumbers": (bool, True),
+    "autoScroll": (bool, True)
+}
+MAX_SETTING_LENGTH = 200  # For free-form (str) settings
+
+def user_settings(user_data):
+    """All of a user's settings, with defaults for the ones never set"""
+    return {name: user_data.get(name, default) for name, (_, default) in SETTINGS_SCHEMA.items()}
+
+def validate_settings(data):
+    """The settings in a request body, and the names of any that are unknown or invalid"""
+    if not isinstance(data, dict):
+        return {}, ["(body)"]
+    settings = {}
+    invalid = []
+    for name, value in data.items():
+        allowed = SETTINGS_SCHEMA.get(name, (None, None))[0]
+        if allowed is bool:
+            valid = isinstance(value, bool)
+        elif allowed is str:
+            valid = isinstance(value, str) and 0 < len(value) <= MAX_SETTING_LENGTH
+        else:
+            valid = allowed is not None and isinstance(value, str) and value in allowed
+        if valid:
+            settings[name] = value
+        else:
+            invalid.append(name)
+    return settings, invalid
+
+class SettingsWriter:
+    """Writes settings changes, coalescing those that arrive together for a user.
 
-def save_chat_data(username, chat_id, data):
-    user_chats_dir = os.path.join(chats_dir, username)
-    os.makedirs(user_chats_dir, exist_ok=True)
-    
-    chat_file = os.path.join(user_chats_dir, f"{chat_id}.json")
-    encrypted_data = encrypt_data(data)
-    
-    with open(chat_file, "w") as f:
-        f.write(encrypted_data)
-    return True
+    Changes queue up per user. Whichever request gets the user's lock first
+    writes everything queued by then in one save; the requests that were
+    waiting behind it find their changes already written.
+    """
+    def __init__(self):
+        self.pending = {}  # username -> changes not written yet
+        self.lock = threading.Lock()
 
-def get_current_model(username):
-    user_data = get_user_data(username)
-    if user_data and 'model' in user_data:
-        # Check if the model is already a full name with version
-        if ':' in user_data['model']:
-            return user_data['model']
-            
-        # For backward compatibility, handle old short names
-        model_map = {
-            # Legacy model name mapping
-            'mistral': 'mistral:latest',
-            'gemma': 'gemma3:1b',
-            'tinyllama': 'tinyllama:latest',
-            'phi3': 'phi3:3.8b',
-            'phi': 'phi:latest',
-            'deepseek-coder': 'deepseek-coder:latest',
-            'deepseek-r1': 'deepseek-r1:8b',
-            'tinystories': 'gurubot/tinystories-656k-q8:latest',
-            'llama2-uncensored': 'llama2-uncensored:latest',
-            'llava': 'llava:7b',
-            'phi4-mini': 'phi4-mini:latest',
-            'phi4': 'phi4:latest',
-            'codellama': 'codellama:latest',
-            'smollm-1.7b': 'smollm:1.7b',
-            'smollm-135m': 'smollm:135m',
-            'qwen3-8b': 'qwen3:8b',
-            'qwen3-0.6b': 'qwen3:0.6b',
-            'deepscaler': 'deepscaler:latest',
-            'dolphin-mistral': 'dolphin-mistral:latest',
-            'dolphin-phi': 'dolphin-phi:latest'
-        }
+    def update(self, username, changes):
+        with self.lock:
+            self.pending.setdefault(username, {}).update(changes)
+        with user_locks.hold(username):
+            with self.lock:
+                batch = self.pending.pop(username, None)
+            if not batch:
+                return
+            user_data = get_user_data(username)
+            if user_data is not None:
+                user_data.update(batch)
+                save_user_data(username, user_data)
 
-        return model_map.get(user_data['model'], DEFAULT_MODEL)
-    return DEFAULT_MODEL
+settings_writer = SettingsWriter()
 
 # API Endpoints
 @app.route("/api/register", methods=["POST"])
 def register():
-    data = request.json
+    data = request_data()
     username = data.get("username")
     password = data.get("password")
     
-    if not username or not password:
+    if not filled_in(username, password):
         return jsonify({"success": False, "message": "Username and password are required"}), 400
     
-    user_file = os.path.join(users_dir, f"{username}.json")
-    if os.path.exists(user_file):
+    retry_after = login_failures.retry_after(request.remote_addr)
+    if retry_after:
+        return throttled_response(retry_after)
+    if storage.has_user(username):
+        login_failures.hit(request.remote_addr)
         return jsonify({"success": False, "message": "Username already exists"}), 400
+    password_hash = hash_password(password)
     
     # Create user data with default settings for all preferences
-    user_data = {
-        "username": username,
-        "password": encrypt_data(password),
-        "theme": "dark",
-        "colorTheme": "blue",
-        "model": "gemma3:1b",
-        "compactSidebar": True,
-        "glassmorphism": True,
-        "animations": True,
-        "fontSize": "medium",
-        "showLineNumbers": True,
-        "autoScroll": True
-    }
+    user_data = {"username": username, **user_settings({})}
     
-    save_user_data(username, user_data)
+    # Checked and created under the user's lock, so two registrations can't both take the name
+    with user_locks.hold(username):
+        if storage.has_user(username):
+            login_failures.hit(request.remote_addr)
+            return jsonify({"success": False, "message": "Username already exists"}), 400
+        # The credential first: a record without one could never be logged into
+        storage.save_credential(username, password_hash)
+        save_user_data(username, user_data)
     session["username"] = username
+    model_residency.preload(get_current_model(username))
     
     return jsonify({"success": True, "message": "User registered successfully"}), 201
 
@@ -210,52 +3110,43 @@ def current_user():
     # Return all user settings, ensure defaults for any missing settings
     return jsonify({
         "success": True,
-        "user": {
-            "username": username,
-            "theme": user_data.get("theme", "dark"),
-            "colorTheme": user_data.get("colorTheme", "blue"),
-            "model": user_data.get("model", "gemma3:1b"),
-            "compactSidebar": user_data.get("compactSidebar", True),
-            "glassmorphism": user_data.get("glassmorphism", True),
-            "animations": user_data.get("animations", True),
-            "fontSize": user_data.get("fontSize", "medium"),
-            "showLineNumbers": user_data.get("showLineNumbers", True),
-            "autoScroll": user_data.get("autoScroll", True)
-        }
+        "user": {"username": username, **user_settings(user_data)}
     }), 200
 
 @app.route("/api/login", methods=["POST"])
 def login():
-    data = request.json
+    data = request_data()
     username = data.get("username")
     password = data.get("password")
     
-    user_data = get_user_data(username)
-    if not user_data:
+    if not filled_in(username, password):
+        return jsonify({"success": False, "message": "Username and password are required"}), 400
+    
+    retry_after = max(login_failures.retry_after(request.remote_addr), password_failures.retry_after(username))
+    if retry_after:
+        logins.inc(result="throttled")
+        return throttled_response(retry_after)
+    
+    if not verify_password(username, password):
+        login_failures.hit(request.remote_addr)
+        password_failures.hit(username)
+        logins.inc(result="failed")
         return jsonify({"success": False, "message": "Invalid credentials"}), 401
+    password_failures.reset(username)
+    logins.inc(result="ok")
     
-    decrypted_password = decrypt_data(user_data["password"])
-    if password != decrypted_password:
+    user_data = get_user_data(username)
+    if not user_data:
         return jsonify({"success": False, "message": "Invalid credentials"}), 401
     
     session["username"] = username
+    model_residency.preload(get_current_model(username))
     
     # Return all user settings, ensure defaults for any missing settings
     return jsonify({
         "success": True, 
         "message": "Login successful",
-        "user": {
-            "username": username,
-            "theme": user_data.get("theme", "dark"),
-            "colorTheme": user_data.get("colorTheme", "blue"),
-            "model": user_data.get("model", "gemma3:1b"),
-            "compactSidebar": user_data.get("compactSidebar", True),
-            "glassmorphism": user_data.get("glassmorphism", True),
-            "animations": user_data.get("animations", True),
-            "fontSize": user_data.get("fontSize", "medium"),
-            "showLineNumbers": user_data.get("showLineNumbers", True),
-            "autoScroll": user_data.get("autoScroll", True)
-        }
+        "user": {"username": username, **user_settings(user_data)}
     }), 200
 
 @app.route("/api/logout", methods=["POST"])
@@ -268,22 +3159,22 @@ def change_password():
     if "username" not in session:
         return jsonify({"success": False, "message": "Not logged in"}), 401
     
-    data = request.json
+    data = request_data()
     old_password = data.get("old_password")
     new_password = data.get("new_password")
     
-    if not old_password or not new_password:
+    if not filled_in(old_password, new_password):
         return jsonify({"success": False, "message": "Old and new passwords are required"}), 400
     
     username = session["username"]
-    user_data = get_user_data(username)
-    
-    decrypted_password = decrypt_data(user_data["password"])
-    if old_password != decrypted_password:
+    retry_after = password_failures.retry_after(username)
+    if retry_after:
+        return throttled_response(retry_after)
+    if not verify_password(username, old_password):
+        password_failures.hit(username)
         return jsonify({"success": False, "message": "Incorrect old password"}), 401
     
-    user_data["password"] = encrypt_data(new_password)
-    save_user_data(username, user_data)
+    set_password(username, new_password)
     
     return jsonify({"success": True, "message": "Password changed successfully"}), 200
 
@@ -301,6 +3192,7 @@ def new_chat():
     }
     
     save_chat_data(username, chat_id, chat_data)
+    update_chat_index(username, chat_id, title="New Chat")
     
     return jsonify({
         "success": True,
@@ -308,32 +3200,21 @@ def new_chat():
         "title": "New Chat"
     }), 201
 
-@app.route("/api/send_message", methods=["POST"])
-def send_message():
-    if "username" not in session:
-        return jsonify({"success": False, "message": "Not logged in"}), 401
-    
-    data = request.json
-    chat_id = data.get("chat_id")
-    message = data.get("message")
-    
-    if not chat_id or not message:
-        return jsonify({"success": False, "message": "Chat ID and message are required"}), 400
-    
-    print(f"[DEBUG] Processing message for chat ID: {chat_id}")
-    print(f"[DEBUG] Message content: {message[:50]}...")
-    
-    username = session["username"]
+def start_chat_turn(username, chat_id, message):
+    """Load (or create) a chat and append the user's message to it"""
     chat_data = get_chat_data(username, chat_id)
     
     if not chat_data:
-        print(f"[DEBUG] No existing chat data found, creating new")
+        log.debug("No existing chat data found, creating new")
         chat_data = {
             "title": "New Chat",
             "messages": []
         }
+        # Stored now: a chat missing when the reply is saved has been deleted meanwhile
+        save_chat_data(username, chat_id, chat_data)
+        update_chat_index(username, chat_id, title="New Chat")
     else:
-        print(f"[DEBUG] Found existing chat with {len(chat_data.get('messages', []))} messages")
+        log.debug("Found existing chat with %s messages", len(chat_data.get('messages', [])))
     
     user_message = {
         "role": "user",
@@ -347,152 +3228,536 @@ def send_message():
         title = " ".join(words[:3]) + ("..." if len(words) > 3 else "")
         chat_data["title"] = title
     
-    current_model = get_current_model(username)
-    print(f"[DEBUG] Using model: {current_model}")
-    print(f"[DEBUG] MOCK_MODE is currently: {MOCK_MODE}")
-    
-    # Call process_with_ollama with explicit try/except for better debugging
-    try:
-        ollama_response = process_with_ollama(chat_data["messages"], current_model)
-        print(f"[DEBUG] Response received, length: {len(ollama_response)}")
-    except Exception as e:
-        print(f"[ERROR] Error in process_with_ollama: {str(e)}")
-        ollama_response = f"Error processing your message: {str(e)}"
-    
+    return chat_data
+
+def finish_chat_turn(username, chat_id, chat_data, content, cancelled=False):
+    """Append the assistant reply to the chat and persist the new turn.
+
+    Returns the assistant message, or None when the turn is dropped: cancelled
+    before anything was generated (e.g. still queued), or the chat was deleted
+    while the reply was generated.
+    """
+    if cancelled and not content:
+        log.debug("Generation cancelled before any reply, turn dropped", extra={"user": username, "chat_id": chat_id})
+        return None
     assistant_message = {
         "role": "assistant",
-        "content": ollama_response,
+        "content": content,
         "timestamp": int(time.time())
     }
+    if cancelled:
+        # Only the part generated before the generation was stopped
+        assistant_message["cancelled"] = True
     chat_data["messages"].append(assistant_message)
     
     try:
-        save_chat_data(username, chat_id, chat_data)
-        print(f"[DEBUG] Chat data saved successfully")
+        # Decided under the chat's lock: another turn may have been saved while this one was generating
+        with chat_locks.hold(username, chat_id):
+            if storage.chat_stamp(username, chat_id) is None:
+                log.debug("Chat deleted while generating, turn dropped", extra={"user": username, "chat_id": chat_id})
+                return None
+            # The first turn also sets the chat title
+            first_turn = count_chat_messages(username, chat_id) == 0
+            metadata = {"title": chat_data["title"]} if first_turn else None
+            message_count = append_chat_messages(username, chat_id, chat_data["messages"][-2:], metadata)
+            update_chat_index(
+                username, chat_id,
+                updated=assistant_message["timestamp"],
+                message_count=message_count,
+                **(metadata or {})
+            )
+        log.debug("Chat data saved successfully")
     except Exception as e:
-        print(f"[ERROR] Error saving chat data: {str(e)}")
+        log.error("Error saving chat data: %s", e)
+    
+    return assistant_message
+
+def start_generation(username, chat_id, chat_data, model, regenerate=False):
+    """Generate the reply to the chat's last message in a background job"""
+    job = GenerationJob(username, chat_id, chat_data["title"], chat_data["messages"][-1], len(chat_data["messages"]) - 1)
+    generation_jobs.start(job)
+    threading.Thread(target=run_generation, args=(job, chat_data, model, regenerate),
+                     name=f"chatly-job-{job.id[:8]}", daemon=True).start()
+    return job
+
+def run_generation(job, chat_data, model, regenerate):
+    """Body of a generation job: wait for a slot, stream the reply from Ollama into the job, save the turn"""
+    username, chat_id = job.username, job.chat_id
+    log_context = {"user": username, "chat_id": chat_id, "model": model, "job_id": job.id}
+    started = time.perf_counter()
+    assistant_message = None
+    try:
+        ollama_response = None if regenerate else get_cached_response(chat_data["messages"], model)
+        if ollama_response is not None:
+            job.add_chunk(ollama_response)
+        else:
+            ticket = generation_scheduler.submit(username, model)
+            try:
+                deadline = time.monotonic() + QUEUE_TIMEOUT
+                while not ticket.granted.is_set() and not job.cancelled.is_set() and time.monotonic() < deadline:
+                    job.set_queue_position(generation_scheduler.position(ticket))
+                    ticket.wait(1)
+                job.set_queue_position(0)
+                
+                if job.cancelled.is_set():
+                    ollama_response = ""
+                elif not ticket.granted.is_set():
+                    log.error("Gave up waiting for a slot after %ss", QUEUE_TIMEOUT, extra=log_context)
+                    ollama_response = QUEUE_BUSY_MESSAGE
+                else:
+                    try:
+                        stats = {}
+                        context = build_context_messages(username, chat_id, chat_data, model)
+                        for chunk in stream_with_ollama(context, model, stats, job):
+                            job.add_chunk(chunk)
+                        ollama_response = "".join(job.chunks)
+                        if stats["ok"]:
+                            cache_response(chat_data["messages"], model, ollama_response)
+                    except Exception as e:
+                        log.exception("Error in stream_with_ollama", extra=log_context)
+                        ollama_response = f"Error processing your message: {str(e)}"
+            finally:
+                generation_scheduler.release(ticket)
+        
+        assistant_message = finish_chat_turn(username, chat_id, chat_data, ollama_response, job.cancelled.is_set())
+        log.info("Reply generated", extra={**log_context, "length": len(ollama_response),
+                                           "latency": round(time.perf_counter() - started, 3)})
+    except Exception:
+        log.exception("Generation job failed", extra=log_context)
+    finally:
+        generation_jobs.finish(job, assistant_message)
+
+def job_event_line(event):
+    """One NDJSON line of a reply stream for a job event (see GenerationJob)"""
+    if "t" in event:
+        event = {"type": "token", "content": event["t"]}
+    elif "q" in event:
+        event = {"type": "queued", "position": event["q"]}
+    elif "d" in event and event["d"] is None:
+        # Cancelled before anything was generated, or the chat was deleted: nothing was saved
+        event = {"type": "dropped"}
+    elif "d" in event:
+        event = {"type": "done", "message": event["d"], "title": event["title"]}
+    else:
+        # Keeps proxies with idle timeouts from closing a quiet stream (e.g. while the model loads)
+        event = {"type": "ping"}
+    return json.dumps(event) + "\n"
+
+def job_stream_response(job_id, title, events):
+    def generate():
+        try:
+            yield json.dumps({"type": "start", "title": title, "job_id": job_id}) + "\n"
+            for event in events:
+                if event.get("q") != 0:
+                    yield job_event_line(event)
+        finally:
+            # Stop following the job; it keeps running and can be resumed
+            events.close()
+    
+    # X-Accel-Buffering stops nginx-style proxies from holding the stream back
+    return Response(generate(), mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+@app.route("/api/send_message", methods=["POST"])
+def send_message():
+    if "username" not in session:
+        return jsonify({"success": False, "message": "Not logged in"}), 401
+    
+    data = request_data()
+    chat_id = data.get("chat_id")
+    message = data.get("message")
+    
+    if not filled_in(chat_id, message):
+        return jsonify({"success": False, "message": "Chat ID and message are required"}), 400
+    
+    username = session["username"]
+    chat_data = start_chat_turn(username, chat_id, message)
+    
+    current_model = get_current_model(username)
+    log.debug("Processing message", extra={"user": username, "chat_id": chat_id, "model": current_model,
+                                           "mock_mode": mock_mode()})
+    
+    # The client does not learn the job id here, it can cancel by chat id instead
+    job = start_generation(username, chat_id, chat_data, current_model, data.get("regenerate"))
+    for event in follow_job(job):
+        pass
+    if job.result is None and job.cancelled.is_set():
+        return jsonify({"success": False, "message": "Generation cancelled, nothing was saved"}), 409
+    if job.result is None:
+        return jsonify({"success": False, "message": "Error processing your message"}), 500
     
     return jsonify({
         "success": True,
-        "message": assistant_message,
-        "title": chat_data["title"]
+        "message": job.result,
+        "title": job.title
     }), 200
 
-def process_with_ollama(messages, model):
-    # Use mock mode if enabled
-    global MOCK_MODE
+@app.route("/api/send_message_stream", methods=["POST"])
+def send_message_stream():
+    """Same as send_message, but streams the reply as newline-delimited JSON events.
+
+    Events are {"type": "start"} with the generation's job id, {"type":
+    "queued", "position": n} while waiting for a free slot, one {"type":
+    "token"} per chunk received from Ollama, {"type": "ping"} when nothing
+    happened for a while and a final {"type": "done"} carrying the saved
+    assistant message. The reply is generated by a background job: if the
+    stream is lost, /api/resume_generation picks it up again.
+    """
+    if "username" not in session:
+        return jsonify({"success": False, "message": "Not logged in"}), 401
     
-    if MOCK_MODE:
-        print("[DEBUG] Mock mode enabled, generating mock response")
-        last_message = messages[-1]["content"] if messages else ""
-        mock_response = generate_mock_response(last_message, model)
-        print(f"[DEBUG] Generated mock response: {mock_response[:50]}...")
-        return mock_response
-        
-    print("[DEBUG] Preparing Ollama API request")
-    ollama_messages = [{"role": msg["role"], "content": msg["content"]} for msg in messages]
+    data = request_data()
+    chat_id = data.get("chat_id")
+    message = data.get("message")
+    
+    if not filled_in(chat_id, message):
+        return jsonify({"success": False, "message": "Chat ID and message are required"}), 400
+    
+    username = session["username"]
+    chat_data = start_chat_turn(username, chat_id, message)
+    current_model = get_current_model(username)
+    log.debug("Streaming message", extra={"user": username, "chat_id": chat_id, "model": current_model})
+    
+    job = start_generation(username, chat_id, chat_data, current_model, data.get("regenerate"))
+    return job_stream_response(job.id, job.title, follow_job(job))
+
+@app.route("/api/resume_generation", methods=["POST"])
+def resume_generation():
+    """Reattach to a generation job: the same events as send_message_stream, from token event `offset` on"""
+    if "username" not in session:
+        return jsonify({"success": False, "message": "Not logged in"}), 401
+    
+    data = request_data()
+    chat_id = data.get("chat_id")
+    job_id = data.get("job_id")
+    offset = data.get("offset", 0)
+    if not filled_in(chat_id, job_id) or not isinstance(offset, int) or offset < 0:
+        return jsonify({"success": False, "message": "Chat ID, job ID and a valid offset are required"}), 400
+    
+    stream = generation_jobs.open_stream(session["username"], chat_id, job_id, offset)
+    if stream is None:
+        # Finished a while ago (the reply is in the chat) or lost with its worker
+        return jsonify({"success": False, "message": "Generation not found"}), 404
+    title, events = stream
+    return job_stream_response(job_id, title, events)
+
+@app.route("/api/cancel_generation", methods=["POST"])
+def cancel_generation():
+    """Stop a running generation, by the job id from the stream's start event or by chat id"""
+    if "username" not in session:
+        return jsonify({"success": False, "message": "Not logged in"}), 401
+    
+    data = request_data()
+    job_id = data.get("job_id")
+    chat_id = data.get("chat_id")
+    if not filled_in(job_id or chat_id) or not all(filled_in(value) for value in (job_id, chat_id) if value is not None):
+        return jsonify({"success": False, "message": "Job ID or chat ID is required"}), 400
+    
+    if not generation_jobs.cancel(session["username"], job_id, chat_id):
+        return jsonify({"success": False, "message": "No running generation found"}), 404
+    return jsonify({"success": True}), 200
+
+# Context window management. Only as much history as fits the model's context
+# budget is sent to Ollama. Older turns are replaced by a summary, computed in
+# blocks of CONTEXT_SUMMARY_BLOCK messages and stored in the chat so it is
+# reused on every following turn instead of being recomputed. The summary is
+# for the model only: get_chat and the export leave it out (INTERNAL_CHAT_FIELDS).
+CONTEXT_TOKENS = int(os.environ.get("CHATLY_CONTEXT_TOKENS", 4096))
+CONTEXT_REPLY_TOKENS = int(os.environ.get("CHATLY_CONTEXT_REPLY_TOKENS", 1024))  # Kept free for the reply
+CONTEXT_SUMMARIES = os.environ.get("CHATLY_CONTEXT_SUMMARIES", "1") != "0"
+CONTEXT_SUMMARY_BLOCK = 8
+CONTEXT_SUMMARY_TOKENS = 300
+INTERNAL_CHAT_FIELDS = ("summary",)
+MODEL_CONTEXT_TOKENS = {
+    # Models with a smaller context window than CONTEXT_TOKENS
+    'tinyllama:latest': 2048,
+    'phi:latest': 2048,
+    'smollm:1.7b': 2048,
+    'smollm:135m': 2048,
+    'gurubot/tinystories-656k-q8:latest': 512,
+    'dolphin-phi:latest': 2048
+}
+SUMMARY_PROMPT = ("Summarize the conversation below in a few sentences. Keep names, facts, decisions "
+                  "and open questions that later messages may refer to. Reply with the summary only.")
+
+def estimate_tokens(text):
+    # Roughly 4 characters per token for English text, plus per-message overhead
+    return len(text) // 4 + 4
 
+def get_context_budget(model):
+    context_tokens = MODEL_CONTEXT_TOKENS.get(model, CONTEXT_TOKENS)
+    return max(context_tokens - min(CONTEXT_REPLY_TOKENS, context_tokens // 2), 1)
+
+def build_context_messages(username, chat_id, chat_data, model):
+    """The messages to send to the model for this turn, trimmed to its context budget"""
+    messages = chat_data["messages"]
+    budget = get_context_budget(model)
+    sizes = [estimate_tokens(msg["content"]) for msg in messages]
+    if sum(sizes) <= budget:
+        return messages
+    
+    # Keep the newest messages that fit next to a summary (always at least the last one)
+    available = budget - (CONTEXT_SUMMARY_TOKENS if CONTEXT_SUMMARIES else 0)
+    cutoff = len(messages) - 1
+    used = sizes[cutoff]
+    while cutoff > 0 and used + sizes[cutoff - 1] <= available:
+        cutoff -= 1
+        used += sizes[cutoff]
+    
+    if not CONTEXT_SUMMARIES or mock_mode():
+        log.debug("Context trimmed to the last %s of %s messages", len(messages) - cutoff, len(messages))
+        return messages[cutoff:]
+    
+    # Summaries only move forward in whole blocks, so one is computed at most every few turns
+    cutoff = min(-(-cutoff // CONTEXT_SUMMARY_BLOCK) * CONTEXT_SUMMARY_BLOCK, len(messages) - 1)
+    summary = chat_data.get("summary") or {"upto": 0, "content": ""}
+    if summary["upto"] < cutoff:
+        content = summarize_messages(summary["content"], messages[summary["upto"]:cutoff], model)
+        if content is None:
+            log.debug("Summary failed, context trimmed to the last %s messages", len(messages) - cutoff)
+            return messages[cutoff:]
+        summary = {"upto": cutoff, "content": content}
+        chat_data["summary"] = summary
+        update_chat_metadata(username, chat_id, {"summary": summary})
+        log.debug("Summarized the first %s messages of chat %s", cutoff, chat_id)
+    
+    summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {summary['content']}"}
+    return [summary_message] + messages[summary["upto"]:]
+
+def public_chat(chat_data):
+    """A chat without the fields only Chatly itself uses, to show or export"""
+    return {key: value for key, value in chat_data.items() if key not in INTERNAL_CHAT_FIELDS}
+
+def summarize_messages(previous_summary, messages, model):
+    """Fold messages into a running summary with one non-streaming Ollama call, None on failure"""
+    transcript = "\n\n".join(f"{msg['role']}: {msg['content']}" for msg in messages)
+    if previous_summary:
+        transcript = f"Summary so far: {previous_summary}\n\n{transcript}"
     payload = {
         "model": model,
-        "messages": ollama_messages,
-        "stream": True
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript}
+        ],
+        "stream": False,
+        "options": {"num_predict": CONTEXT_SUMMARY_TOKENS},
+        # Without it Ollama would fall back to its default keep_alive for the model
+        "keep_alive": model_residency.keep_alive(model)
+    }
+    try:
+        response = ollama_session.post(
+            f"{OLLAMA_URL}/api/chat",
+            json=payload,
+            timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT * 4)
+        )
+        if response.status_code == 200:
+            model_residency.record(model, payload["keep_alive"])
+            return parse_ollama_chunk(response.json()).strip() or None
+        log.error("Summary request failed with HTTP %s", response.status_code)
+    except Exception as e:
+        log.error("Summary request failed: %s", e)
+    return None
+
+# Opt-in cache of generated replies, shared by all users, keyed by a hash of
+# the model and the conversation (roles and contents only). It only ever
+# answers a byte-identical conversation, e.g. the same first question asked in
+# fresh chats. Regenerate requests bypass it.
+RESPONSE_CACHE = os.environ.get("CHATLY_RESPONSE_CACHE", "0") == "1"
+response_cache = LRUCache(
+    max_entries=int(os.environ.get("CHATLY_RESPONSE_CACHE_ENTRIES", 2000)),
+    max_bytes=int(os.environ.get("CHATLY_RESPONSE_CACHE_MB", 32)) * 1024 * 1024,
+    ttl=float(os.environ.get("CHATLY_RESPONSE_CACHE_TTL", 3600))
+)
+
+def response_cache_key(messages, model):
+    """Hash of everything that decides a reply. Chat requests send no generation
+    options (Ollama uses the model's own), so that is the model and the messages"""
+    normalized = {
+        "model": model,
+        "messages": [{"role": msg["role"], "content": msg["content"].strip()} for msg in messages]
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+def get_cached_response(messages, model):
+    if not RESPONSE_CACHE or mock_mode():
+        return None
+    cached = response_cache.get(response_cache_key(messages, model))
+    if cached is not None:
+        log.debug("Response cache hit for model %s", model)
+        return cached["content"]
+    return None
+
+def cache_response(messages, model, content):
+    if RESPONSE_CACHE and not mock_mode():
+        response_cache.set(response_cache_key(messages, model), json.dumps({"content": content}))
+
+def process_with_ollama(messages, model, stats=None, job=None):
+    return "".join(stream_with_ollama(messages, model, stats, job))
+
+def build_ollama_payload(messages, model):
+    """Request body for Ollama's streaming /api/chat"""
+    return {
+        "model": model,
+        "messages": [{"role": msg["role"], "content": msg["content"]} for msg in messages],
+        "stream": True,
+        "keep_alive": model_residency.keep_alive(model)
     }
-    print(f"[DEBUG] Payload prepared: {len(ollama_messages)} messages for model {model}")
 
+def parse_ollama_chunk(data):
+    """Extract the generated text from one decoded line of an Ollama stream"""
+    # Try different possible response formats
+    # Format 1: Newer Ollama versions with 'message'
+    content = data.get("message", {}).get("content", "")
+    # Format 2: Some versions may return 'response' directly
+    if not content and "response" in data:
+        content = data.get("response", "")
+    # Format 3: Older versions or different modes
+    if not content and "content" in data:
+        content = data.get("content", "")
+    return content
+
+def abort_ollama_response(response):
+    """Unblock a thread reading a streamed response by shutting its socket down; the reader closes it"""
+    sock = getattr(getattr(response.raw, "_connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def stream_with_ollama(messages, model, stats=None, job=None):
+    """Yield the reply to `messages` chunk by chunk as Ollama produces it.
+
+    Error and fallback replies are yielded like any other text; pass a `stats`
+    dict to tell them apart, "ok" is set to True only for a real reply. If
+    `job` is cancelled the request to Ollama is closed and nothing more is
+    yielded, stats["cancelled"] is then set.
+    """
+    if stats is None:
+        stats = {}
+    stats["ok"] = False
+    # Use mock mode if enabled
+    if mock_mode():
+        log.debug("Mock mode enabled, generating mock response")
+        last_message = messages[-1]["content"] if messages else ""
+        mock_response = generate_mock_response(last_message, model)
+        log.debug("Generated mock response: %s...", mock_response[:50])
+        yield mock_response
+        return
+        
+    payload = build_ollama_payload(messages, model)
+    log.debug("Payload prepared", extra={"model": model, "messages": len(payload["messages"])})
+
+    started = time.perf_counter()
     try:
-        print("[DEBUG] Attempting to connect to Ollama API...")
         # Try to connect to Ollama with a longer timeout
-        response = requests.post(
-            "http://127.0.0.1:11434/api/chat",
+        response = ollama_session.post(
+            f"{OLLAMA_URL}/api/chat",
             json=payload,
             stream=True,
-            timeout=30  # Increased timeout to 30 seconds
+            timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT)
         )
-        print(f"[DEBUG] Ollama API response status: {response.status_code}")
 
         if response.status_code == 200:
-            full_response = ""
+            model_residency.record(model, payload["keep_alive"])
+            response_length = 0
             line_count = 0
-            for line in response.iter_lines(decode_unicode=True):
-                if line:
-                    print(f"[DEBUG] Raw line from Ollama: {line[:100]}...")
-                    try:
-                        data = json.loads(line)
-                        # Try different possible response formats
-                        # Format 1: Newer Ollama versions with 'message'
-                        content = data.get("message", {}).get("content", "")
-                        # Format 2: Some versions may return 'response' directly
-                        if not content and "response" in data:
-                            content = data.get("response", "")
-                        # Format 3: Older versions or different modes
-                        if not content and "content" in data:
-                            content = data.get("content", "")
+            if job:
+                job.attach(lambda: abort_ollama_response(response))
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    if job and job.cancelled.is_set():
+                        break
+                    if line:
+                        if LOG_CHUNKS:
+                            chunk_log.debug("Raw line from Ollama: %.100s", line)
+                        try:
+                            data = json.loads(line)
+                        except json.JSONDecodeError:
+                            log.error("Could not decode line: %s", line[:100])
+                            continue
+                        content = parse_ollama_chunk(data)
+                        if data.get("done"):
+                            # The last chunk carries Ollama's timings (eval_count, eval_duration, ...)
+                            stats.update({key: value for key, value in data.items() if key.endswith(("_count", "_duration"))})
                             
                         if content:
-                            full_response += content
+                            if not response_length:
+                                stats["first_token_seconds"] = time.perf_counter() - started
+                            response_length += len(content)
                             line_count += 1
-                            print(f"[DEBUG] Parsed content: '{content[:30]}...'")
-                    except json.JSONDecodeError:
-                        print(f"[ERROR] Could not decode line: {line[:100]}")
+                            if LOG_CHUNKS:
+                                chunk_log.debug("Parsed content: %.30r", content)
+                            yield content
+            except Exception:
+                # Reading fails once a cancel has shut the connection down
+                if not (job and job.cancelled.is_set()):
+                    raise
+            finally:
+                if job:
+                    job.attach(None)
+                response.close()
             
-            print(f"[DEBUG] Processed {line_count} response lines")
-            if not full_response:
-                print("[WARNING] Empty response from Ollama despite status 200")
-                # Try one more time to extract any text from the response
-                try:
-                    # Make one more attempt to read the entire response as a single chunk
-                    full_text_response = ""
-                    for line in response.iter_lines(decode_unicode=True):
-                        if line:
-                            full_text_response += line.decode('utf-8') if isinstance(line, bytes) else line
-                    
-                    if full_text_response:
-                        print(f"[DEBUG] Extracted raw text: {full_text_response[:100]}...")
-                        return full_text_response
-                except:
-                    pass
+            if job and job.cancelled.is_set():
+                stats["cancelled"] = True
+                log.debug("Generation cancelled", extra={"model": model, "length": response_length,
+                                                         "latency": round(time.perf_counter() - started, 3)})
+                return
+            
+            if not response_length:
+                log.warning("Empty response from Ollama despite status 200", extra={"model": model})
                 
-                # If we still don't have a response, check if Ollama is actually running
+                # Check if Ollama is actually running
                 try:
-                    health_check = requests.get("http://127.0.0.1:11434/api/version", timeout=2)
+                    health_check = ollama_session.get(f"{OLLAMA_URL}/api/version", timeout=OLLAMA_STATUS_TIMEOUT)
                     if health_check.status_code != 200:
-                        return "Ollama seems to be running but not responding properly. Please check if the model is loaded correctly."
+                        yield "Ollama seems to be running but not responding properly. Please check if the model is loaded correctly."
+                        return
                 except:
-                    return "Ollama appears to be offline. Please make sure Ollama is running and try again."
+                    yield "Ollama appears to be offline. Please make sure Ollama is running and try again."
+                    return
                 
-                return "I couldn't generate a response. Please check server logs for details."
+                yield "I couldn't generate a response. Please check server logs for details."
+                return
                 
-            print(f"[DEBUG] Final response length: {len(full_response)}")
-            return full_response
+            stats["ok"] = True
+            stats["generation_seconds"] = time.perf_counter() - started
+            observe_ollama_stats(model, stats)
+            log.debug("Generation finished", extra={
+                "model": model,
+                "chunks": line_count,
+                "length": response_length,
+                "ttft": round(stats["first_token_seconds"], 3),
+                "latency": round(stats["generation_seconds"], 3)
+            })
         else:
             error_msg = f"Error communicating with AI model (HTTP {response.status_code}). Make sure Ollama is running and the selected model '{model}' is available."
-            print(f"[ERROR] {error_msg}")
-            return error_msg
+            log.error(error_msg)
+            yield error_msg
     except requests.exceptions.ConnectionError:
-        error_msg = "Could not connect to Ollama. Please make sure Ollama is running at http://127.0.0.1:11434."
-        print(f"[ERROR] {error_msg}")
+        error_msg = f"Could not connect to Ollama. Please make sure Ollama is running at {OLLAMA_URL}."
+        log.error(error_msg)
         
         # Auto-enable mock mode if connection fails
-        MOCK_MODE = True
-        print("[DEBUG] Auto-enabled mock mode due to connection failure")
+        set_mock_mode(True)
+        log.debug("Auto-enabled mock mode due to connection failure")
         
         # Return a mock response instead
         last_message = messages[-1]["content"] if messages else ""
-        return generate_mock_response(last_message, model)
+        yield generate_mock_response(last_message, model)
     except requests.exceptions.Timeout:
         error_msg = "The request to Ollama timed out. Please check if the model is loaded with 'ollama pull " + model + "' and try again."
-        print(f"[ERROR] {error_msg}")
-        return error_msg
+        log.error(error_msg)
+        yield error_msg
     except Exception as e:
         error_msg = f"Error connecting to Ollama: {str(e)}. Please make sure Ollama is running."
-        print(f"[ERROR] {error_msg}")
-        print(f"[ERROR] Exception details: {type(e).__name__}: {str(e)}")
+        log.exception(error_msg)
         # Provide a fallback response when Ollama is unavailable
         last_user_message = next((msg["content"] for msg in reversed(messages) if msg["role"] == "user"), None)
         if last_user_message:
             # Return a simple echo response for debugging
-            return f"FALLBACK RESPONSE (Ollama unavailable): I received your message: '{last_user_message}'. Please make sure Ollama is running with the '{model}' model loaded."
-        return f"Error connecting to Ollama: {str(e)}. Please make sure Ollama is running."
+            yield f"FALLBACK RESPONSE (Ollama unavailable): I received your message: '{last_user_message}'. Please make sure Ollama is running with the '{model}' model loaded."
+            return
+        yield f"Error connecting to Ollama: {str(e)}. Please make sure Ollama is running."
 
 def generate_mock_response(message, model):
     """Generate a mock response for development without Ollama"""
@@ -538,26 +3803,148 @@ def get_chat(chat_id):
         return jsonify({"success": False, "message": "Not logged in"}), 401
     
     username = session["username"]
-    chat_data = get_chat_data(username, chat_id)
+    limit = request.args.get("limit", type=int)
+    before = request.args.get("before", type=int)
+    since = request.args.get("since", type=float)
     
-    if not chat_data:
-        return jsonify({"success": False, "message": "Chat not found"}), 404
+    # A reply still being generated is not saved yet, its user message neither. Looked up
+    # before the chat is read: if the turn was saved in between, the chat already has it
+    generation = generation_jobs.running_in_chat(username, chat_id) if before is None else None
+    
+    if limit is None and before is None and since is None:
+        chat_data = get_chat_data(username, chat_id)
+        if not chat_data:
+            return jsonify({"success": False, "message": "Chat not found"}), 404
+        response = {
+            "success": True,
+            "chat": public_chat(chat_data)
+        }
+        total = len(chat_data["messages"])
+    else:
+        # Paged: ?limit=50 for the newest messages, then ?limit=50&before=<page.start> for older
+        # ones; ?since=<timestamp> for the messages added from then on
+        page = read_chat_page(username, chat_id, max(limit, 1) if limit else None, before, since)
+        if not page:
+            return jsonify({"success": False, "message": "Chat not found"}), 404
+        chat_data, start, total = page
+        response = {
+            "success": True,
+            "chat": public_chat(chat_data),
+            "page": {
+                "start": start,
+                "total": total,
+                "has_more": start > 0
+            }
+        }
+    
+    if generation and total <= generation["position"]:
+        # Follow it with /api/resume_generation
+        response["generation"] = {"job_id": generation["job_id"], "message": generation["message"]}
+    return jsonify(response), 200
+
+@app.route("/api/search_chats", methods=["GET"])
+def search_chats_route():
+    """Search the user's chats: ?q=words&limit=20, best matches first with a snippet each"""
+    if "username" not in session:
+        return jsonify({"success": False, "message": "Not logged in"}), 401
+    
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"success": False, "message": "A search query is required"}), 400
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
     
     return jsonify({
         "success": True,
-        "chat": chat_data
+        "results": search_chats(session["username"], query, limit)
     }), 200
 
+class ZipStream:
+    """Write-only file object collecting what zipfile writes, drained chunk by chunk"""
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def chat_to_markdown(chat_data):
+    lines = [f"# {chat_data.get('title', 'Chat')}", ""]
+    for message in chat_data.get("messages", []):
+        role = "User" if message.get("role") == "user" else "Assistant"
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(message.get("timestamp", 0)))
+        lines += [f"## {role} - {timestamp}", "", message.get("content", ""), "", "---", ""]
+    return "\n".join(lines)
+
+def export_file_name(title, chat_id):
+    safe_title = re.sub(r"[^a-z0-9]+", "_", (title or "chat").lower()).strip("_")[:50] or "chat"
+    return f"{safe_title}_{chat_id}"
+
+def generate_chat_export(username):
+    """Yield a ZIP archive of the user's chats (Markdown and JSON each), one chat in memory at a time"""
+    stream = ZipStream()
+    archive = zipfile.ZipFile(stream, mode="w", compression=zipfile.ZIP_DEFLATED)
+    exported = []
+    for chat in get_user_chats(username):
+        # Read straight from storage so an export does not flush the chat cache
+        chat_data = storage.load_chat(username, chat["id"])
+        if chat_data is None:
+            continue
+        
+        name = export_file_name(chat_data.get("title"), chat["id"])
+        date_time = time.localtime(chat.get("updated") or time.time())[:6]
+        archive.writestr(zipfile.ZipInfo(f"markdown/{name}.md", date_time), chat_to_markdown(chat_data),
+                         compress_type=zipfile.ZIP_DEFLATED)
+        archive.writestr(zipfile.ZipInfo(f"json/{name}.json", date_time),
+                         json.dumps({"id": chat["id"], **public_chat(chat_data)}, indent=2, ensure_ascii=False),
+                         compress_type=zipfile.ZIP_DEFLATED)
+        exported.append(f"- [{chat_data.get('title', 'Chat')}](markdown/{name}.md)")
+        yield stream.drain()
+    
+    summary = [
+        "# Chatly Export",
+        f"Exported: {time.strftime('%Y-%m-%d %H:%M:%S')}",
+        f"User: {username}",
+        "",
+        f"Total Chats: {len(exported)}",
+        "",
+        "## Chats",
+        *exported
+    ]
+    archive.writestr("summary.md", "\n".join(summary) + "\n", compress_type=zipfile.ZIP_DEFLATED)
+    archive.close()
+    yield stream.drain()
+
+@app.route("/api/export", methods=["GET"])
+def export_chats():
+    """Download all of the user's chats as a ZIP, streamed while it is being written"""
+    if "username" not in session:
+        return jsonify({"success": False, "message": "Not logged in"}), 401
+    
+    username = session["username"]
+    file_name = f"chatly_export_{int(time.time())}.zip"
+    return Response(generate_chat_export(username), mimetype="application/zip", headers={
+        "Content-Disposition": f'attachment; filename="{file_name}"',
+        "X-Accel-Buffering": "no"
+    })
+
 @app.route("/api/rename_chat", methods=["POST"])
 def rename_chat():
     if "username" not in session:
         return jsonify({"success": False, "message": "Not logged in"}), 401
     
-    data = request.json
+    data = request_data()
     chat_id = data.get("chat_id")
     new_title = data.get("title")
     
-    if not chat_id or not new_title:
+    if not filled_in(chat_id, new_title):
         return jsonify({"success": False, "message": "Chat ID and title are required"}), 400
     
     username = session["username"]
@@ -566,8 +3953,9 @@ def rename_chat():
     if not chat_data:
         return jsonify({"success": False, "message": "Chat not found"}), 404
     
-    chat_data["title"] = new_title
-    save_chat_data(username, chat_id, chat_data)
+    with chat_locks.hold(username, chat_id):
+        update_chat_metadata(username, chat_id, {"title": new_title})
+        update_chat_index(username, chat_id, title=new_title)
     
     return jsonify({
         "success": True,
@@ -579,17 +3967,14 @@ def delete_chat():
     if "username" not in session:
         return jsonify({"success": False, "message": "Not logged in"}), 401
     
-    data = request.json
+    data = request_data()
     chat_id = data.get("chat_id")
     
-    if not chat_id:
+    if not filled_in(chat_id):
         return jsonify({"success": False, "message": "Chat ID is required"}), 400
     
     username = session["username"]
-    chat_file = os.path.join(chats_dir, username, f"{chat_id}.json")
-    
-    if os.path.exists(chat_file):
-        os.remove(chat_file)
+    delete_chat_data(username, chat_id)
     
     return jsonify({
         "success": True,
@@ -601,13 +3986,7 @@ def clear_chats():
     if "username" not in session:
         return jsonify({"success": False, "message": "Not logged in"}), 401
     
-    username = session["username"]
-    user_chats_dir = os.path.join(chats_dir, username)
-    
-    if os.path.exists(user_chats_dir):
-        for file in os.listdir(user_chats_dir):
-            if file.endswith(".json"):
-                os.remove(os.path.join(user_chats_dir, file))
+    delete_all_chats(session["username"])
     
     return jsonify({
         "success": True,
@@ -619,20 +3998,29 @@ def update_settings():
     if "username" not in session:
         return jsonify({"success": False, "message": "Not logged in"}), 401
     
-    data = request.json
+    settings, invalid = validate_settings(request.get_json(silent=True))
+    if invalid:
+        return jsonify({"success": False, "message": f"Invalid settings: {', '.join(invalid)}",
+                        "error": "validation_error"}), 400
+    
     username = session["username"]
     user_data = get_user_data(username)
+    if not user_data:
+        return jsonify({"success": False, "message": "User not found"}), 404
     
-    # Update all received settings
-    for key, value in data.items():
-        user_data[key] = value
-    
-    save_user_data(username, user_data)
+    # Only settings that differ are written, and only those are sent back
+    current = user_settings(user_data)
+    changed = {name: value for name, value in settings.items() if current[name] != value}
+    if changed:
+        settings_writer.update(username, changed)
+        if "model" in changed:
+            # Start loading the new model now rather than on the next message
+            model_residency.preload(get_current_model(username))
     
     return jsonify({
         "success": True,
         "message": "Settings updated successfully",
-        "user": user_data
+        "settings": changed
     }), 200
 
 @app.route("/api/delete_account", methods=["POST"])
@@ -640,47 +4028,30 @@ def delete_account():
     if "username" not in session:
         return jsonify({"success": False, "message": "Not logged in"}), 401
     
-    data = request.json
+    data = request_data()
     password = data.get("password")
     
-    if not password:
+    if not filled_in(password):
         return jsonify({"success": False, "message": "Password is required", "error": "missing_password"}), 400
     
     username = session["username"]
-    user_data = get_user_data(username)
-    
-    if not user_data:
+    if not storage.has_user(username):
         return jsonify({"success": False, "message": "User not found", "error": "user_not_found"}), 404
     
     # Verify password
-    decrypted_password = decrypt_data(user_data["password"])
-    if password != decrypted_password:
+    retry_after = password_failures.retry_after(username)
+    if retry_after:
+        return throttled_response(retry_after)
+    if not verify_password(username, password):
+        password_failures.hit(username)
         return jsonify({"success": False, "message": "Incorrect password", "error": "invalid_password"}), 401
     
-    # Delete user chats
-    user_chats_dir = os.path.join(chats_dir, username)
-    if os.path.exists(user_chats_dir):
-        for file in os.listdir(user_chats_dir):
-            if file.endswith(".json"):
-                try:
-                    os.remove(os.path.join(user_chats_dir, file))
-                except Exception as e:
-                    print(f"Error deleting chat file {file}: {e}")
-        
-        # Remove the empty directory
-        try:
-            os.rmdir(user_chats_dir)
-        except Exception as e:
-            print(f"Error removing chats directory: {e}")
-    
-    # Delete user account file
-    user_file = os.path.join(users_dir, f"{username}.json")
-    if os.path.exists(user_file):
-        try:
-            os.remove(user_file)
-        except Exception as e:
-            print(f"Error deleting user file: {e}")
-            return jsonify({"success": False, "message": "Failed to delete account", "error": "file_error"}), 500
+    # Delete the user's chats and account
+    try:
+        delete_user_data(username)
+    except (OSError, sqlite3.Error) as e:
+        log.error("Error deleting account of %s: %s", username, e)
+        return jsonify({"success": False, "message": "Failed to delete account", "error": "file_error"}), 500
     
     # Clear session
     session.pop("username", None)
@@ -707,42 +4078,185 @@ def serve_index():
 
 def check_ollama_status():
     """Check if Ollama is running and available"""
-    print("[DEBUG] Checking Ollama status...")
+    log.debug("Checking Ollama status...")
     try:
-        response = requests.get("http://127.0.0.1:11434/api/version", timeout=2)
+        response = ollama_session.get(f"{OLLAMA_URL}/api/version", timeout=OLLAMA_STATUS_TIMEOUT)
         if response.status_code == 200:
             version_info = response.json()
-            print(f"[DEBUG] Ollama is available, version: {version_info.get('version', 'unknown')}")
+            log.debug("Ollama is available, version: %s", version_info.get('version', 'unknown'))
             return {
                 "available": True,
                 "version": version_info.get("version", "unknown"),
                 "message": "Ollama is running"
             }
         else:
-            print(f"[DEBUG] Ollama returned error status: {response.status_code}")
+            log.debug("Ollama returned error status: %s", response.status_code)
             return {
                 "available": False,
                 "message": f"Ollama returned an error: HTTP {response.status_code}"
             }
     except requests.exceptions.ConnectionError:
-        print("[DEBUG] Connection error when checking Ollama")
+        log.debug("Connection error when checking Ollama")
         return {
             "available": False,
             "message": "Could not connect to Ollama"
         }
     except requests.exceptions.Timeout:
-        print("[DEBUG] Timeout when checking Ollama")
+        log.debug("Timeout when checking Ollama")
         return {
             "available": False,
             "message": "Connection to Ollama timed out"
         }
     except Exception as e:
-        print(f"[DEBUG] Exception when checking Ollama: {str(e)}")
+        log.debug("Exception when checking Ollama: %s", e)
         return {
             "available": False,
             "message": f"Error checking Ollama: {str(e)}"
         }
 
+# Model benchmarks. A fixed prompt set is run through each installed model and
+# the timings Ollama reports with the last chunk of every reply are kept in
+# BENCHMARK_FILE, so the settings page can show how fast each model is here.
+BENCHMARK_FILE = "Data/benchmarks.json"
+BENCHMARK_PROMPTS = [
+    "In one sentence, what is the capital of France?",
+    "Write a Python function that returns the n-th Fibonacci number.",
+    "Explain in a short paragraph why the sky is blue."
+]
+benchmark_lock = threading.Lock()
+benchmark_state = {"running": False, "current": None, "done": 0, "total": 0}
+
+def list_ollama_models():
+    """Names of the models installed in Ollama"""
+    response = ollama_session.get(f"{OLLAMA_URL}/api/tags", timeout=OLLAMA_STATUS_TIMEOUT)
+    response.raise_for_status()
+    return [model["name"] for model in response.json().get("models", [])]
+
+def get_model_memory(model):
+    """(size, size_vram) in bytes of a loaded model, from Ollama's /api/ps"""
+    try:
+        response = ollama_session.get(f"{OLLAMA_URL}/api/ps", timeout=OLLAMA_STATUS_TIMEOUT)
+        for loaded in response.json().get("models", []):
+            if loaded.get("name") == model or loaded.get("model") == model:
+                return loaded.get("size", 0), loaded.get("size_vram", 0)
+    except (requests.exceptions.RequestException, ValueError):
+        pass
+    return None, None
+
+def run_benchmark_prompt(model, prompt):
+    """Stream one prompt and return the wall-clock time to first token plus Ollama's final timings"""
+    payload = build_ollama_payload([{"role": "user", "content": prompt}], model)
+    started = time.perf_counter()
+    first_token = None
+    final = {}
+    with ollama_session.post(f"{OLLAMA_URL}/api/chat", json=payload, stream=True,
+                             timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_READ_TIMEOUT)) as response:
+        response.raise_for_status()
+        model_residency.record(model, payload["keep_alive"])
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            data = json.loads(line)
+            if first_token is None and parse_ollama_chunk(data):
+                first_token = time.perf_counter() - started
+            if data.get("done"):
+                final = data
+    return first_token, final
+
+def benchmark_model(model, prompts=BENCHMARK_PROMPTS):
+    """Run the prompt set through one model and summarize its speed"""
+    result = {"model": model, "timestamp": int(time.time()), "prompts": len(prompts)}
+    ticket = generation_scheduler.submit("benchmark", model)
+    try:
+        if not ticket.wait(QUEUE_TIMEOUT):
+            result["error"] = "Timed out waiting for a free generation slot"
+            return result
+        
+        ttfts, eval_count, eval_duration, load_duration = [], 0, 0, 0
+        for prompt in prompts:
+            first_token, final = run_benchmark_prompt(model, prompt)
+            if first_token is not None:
+                # Time to first token of a loaded model, the load is reported separately
+                ttfts.append(max(0.0, first_token - final.get("load_duration", 0) / 1e9))
+            eval_count += final.get("eval_count", 0)
+            eval_duration += final.get("eval_duration", 0)
+            # Only the first prompt pays for loading the model, unless it was already loaded
+            load_duration = max(load_duration, final.get("load_duration", 0))
+        
+        size, size_vram = get_model_memory(model)
+        result.update({
+            "load_seconds": round(load_duration / 1e9, 3),
+            "ttft_seconds": round(sum(ttfts) / len(ttfts), 3) if ttfts else None,
+            "tokens_per_second": round(eval_count / (eval_duration / 1e9), 2) if eval_duration else None,
+            "tokens": eval_count,
+            "memory_bytes": size,
+            "vram_bytes": size_vram
+        })
+    except (requests.exceptions.RequestException, ValueError) as e:
+        log.warning("Benchmark of %s failed: %s", model, e)
+        result["error"] = str(e)
+    finally:
+        generation_scheduler.release(ticket)
+    return result
+
+def load_benchmark_results():
+    if not os.path.exists(BENCHMARK_FILE):
+        return {}
+    with open(BENCHMARK_FILE, "r") as f:
+        return json.load(f)
+
+def save_benchmark_result(result):
+    # The server and Tools/benchmark.py may both be saving results
+    with file_lock(BENCHMARK_FILE):
+        results = load_benchmark_results()
+        results[result["model"]] = result
+        atomic_write(BENCHMARK_FILE, json.dumps(results, indent=2))
+
+def run_model_benchmarks(models=None, on_result=None):
+    """Benchmark the given (default: all installed) models one after the other and store the results.
+
+    Only one benchmark runs at a time; returns None if another one is in progress.
+    """
+    if not benchmark_lock.acquire(blocking=False):
+        return None
+    try:
+        models = models or list_ollama_models()
+        benchmark_state.update(running=True, current=None, done=0, total=len(models))
+        results = []
+        for model in models:
+            benchmark_state["current"] = model
+            result = benchmark_model(model)
+            save_benchmark_result(result)
+            results.append(result)
+            benchmark_state["done"] += 1
+            if on_result:
+                on_result(result)
+        return results
+    finally:
+        benchmark_state.update(running=False, current=None)
+        benchmark_lock.release()
+
+@app.route("/api/system/benchmark", methods=["GET", "POST"])
+def system_benchmark():
+    """GET the stored model benchmarks and progress, POST {"models": [...]} to start a run"""
+    if "username" not in session:
+        return jsonify({"success": False, "message": "Not logged in"}), 401
+    
+    if request.method == "POST":
+        if mock_mode():
+            return jsonify({"success": False, "message": "Benchmarks need Ollama, mock mode is enabled"}), 409
+        if benchmark_state["running"]:
+            return jsonify({"success": False, "message": "A benchmark is already running"}), 409
+        models = request_data().get("models")
+        threading.Thread(target=run_model_benchmarks, args=(models,), daemon=True).start()
+        return jsonify({"success": True, "message": "Benchmark started"}), 202
+    
+    return jsonify({
+        "success": True,
+        "state": dict(benchmark_state),
+        "results": load_benchmark_results()
+    })
+
 @app.route("/api/system/status", methods=["GET"])
 def system_status():
     """Get system status, including Ollama availability"""
@@ -754,41 +4268,146 @@ def system_status():
     return jsonify({
         "success": True,
         "ollama": ollama_status,
-        "mock_mode": MOCK_MODE,
+        "mock_mode": mock_mode(),
+        "queue": generation_scheduler.stats(),
+        "models": model_residency.stats(),
+        "cache": {
+            "users": user_cache.stats(),
+            "chats": chat_cache.stats(),
+            "responses": {**response_cache.stats(), "enabled": RESPONSE_CACHE}
+        },
         "version": "0.5.0"
     })
 
+def cache_lookup_values():
+    caches = {"users": user_cache, "chats": chat_cache, "responses": response_cache}
+    for name, cache in caches.items():
+        cache_stats = cache.stats()
+        yield {"cache": name, "result": "hit"}, cache_stats["hits"]
+        yield {"cache": name, "result": "miss"}, cache_stats["misses"]
+
+queue_waiting.set_callback(lambda: [({"model": model}, counts["waiting"]) for model, counts in generation_scheduler.stats().items()])
+queue_running.set_callback(lambda: [({"model": model}, counts["running"]) for model, counts in generation_scheduler.stats().items()])
+cache_lookups.set_callback(cache_lookup_values)
+models_resident.set_callback(lambda: [({"model": model}, 1) for model in model_residency.stats()])
+cache_bytes.set_callback(lambda: [({"cache": name}, cache.stats()["bytes"])
+                                  for name, cache in (("users", user_cache), ("chats", chat_cache), ("responses", response_cache))])
+
+@app.route("/api/system/metrics", methods=["GET"])
+def system_metrics():
+    """Request, generation, queue and storage metrics in the Prometheus text format"""
+    # No exception for localhost: behind a reverse proxy every request comes from there
+    if not METRICS_PUBLIC and "username" not in session:
+        return jsonify({"success": False, "message": "Not logged in"}), 401
+    
+    body = "\n".join(metric.render() for metric in metrics.values()) + "\n"
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
 @app.route("/api/system/toggle_mock", methods=["POST"])
 def toggle_mock_mode():
     """Toggle the mock mode for development without Ollama"""
     if "username" not in session:
         return jsonify({"success": False, "message": "Not logged in"}), 401
     
-    # Access MOCK_MODE at module level without using global keyword
-    print(f"[DEBUG] Toggle mock mode requested, current mode: {MOCK_MODE}")
-    globals()["MOCK_MODE"] = not globals()["MOCK_MODE"]
-    print(f"[DEBUG] Mock mode is now: {MOCK_MODE}")
+    # Shared with the other workers through the runtime flags
+    log.debug("Toggle mock mode requested, current mode: %s", mock_mode())
+    set_mock_mode(not mock_mode())
+    log.debug("Mock mode is now: %s", mock_mode())
     
     return jsonify({
         "success": True,
-        "mock_mode": globals()["MOCK_MODE"],
-        "message": f"Mock mode {'enabled' if globals()['MOCK_MODE'] else 'disabled'}"
+        "mock_mode": mock_mode(),
+        "message": f"Mock mode {'enabled' if mock_mode() else 'disabled'}"
     })
 
-if __name__ == "__main__":
-    print("\n===== Starting Chatly =====")
-    # Check if Ollama is available and enable mock mode automatically if not
-    print("Checking Ollama availability...")
+def check_ollama_on_startup():
+    """Check if Ollama is available and enable mock mode automatically if not"""
+    log.info("Checking Ollama availability...")
     ollama_status = check_ollama_status()
     
-    # Modify MOCK_MODE at module level 
     if not ollama_status["available"]:
-        globals()["MOCK_MODE"] = True
-        print(f"Ollama not available: {ollama_status['message']}")
-        print("MOCK MODE ENABLED: Using mock responses instead of Ollama API")
+        set_mock_mode(True)
+        log.warning("Ollama not available: %s", ollama_status['message'])
+        log.warning("MOCK MODE ENABLED: Using mock responses instead of Ollama API")
     else:
-        print(f"Ollama is available: version {ollama_status.get('version', 'unknown')}")
-        print("Using Ollama for AI responses")
+        log.info("Ollama is available: version %s", ollama_status.get('version', 'unknown'))
+        log.info("Using Ollama for AI responses")
+
+# Multi-process serving. With CHATLY_WORKERS above 1 the port is bound once and
+# that many worker processes are forked to accept connections on it, each with
+# its own request threads, caches and Ollama connections, so requests use all
+# cores. Workers that die are replaced. They share Data/ and Key/: the session
+# key is persisted, cached records are checked against storage before use,
+# writes are serialized with file locks and mock mode is a shared runtime flag.
+# Generation limits (CHATLY_MODEL_CONCURRENCY, ...), model residency and rate
+# limits are shared through Data/state/ (see SharedState); metrics are per worker.
+def after_fork():
+    """Give a freshly forked worker its own threads and connections"""
+    global ollama_session
+    setup_logging()
+    ollama_session = create_ollama_session()
+    storage.after_fork()
+
+def serve_workers(host, port, workers):
+    from werkzeug.serving import make_server
+    
+    listener = socket.create_server((host, port), backlog=128)
+    children = {}  # pid -> start time
+    stopping = False
+    
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            # Both stop the worker through the finally below, which writes out the queued log records
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            after_fork()
+            try:
+                server = make_server(host, port, app, threaded=True, fd=listener.fileno())
+                log.info("Worker started", extra={"pid": os.getpid()})
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                log_listener.stop()  # os._exit skips atexit
+                os._exit(0)
+        children[pid] = time.time()
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, time.time())
+        if not stopping:
+            log.warning("Worker exited, starting a new one", extra={"pid": pid, "status": status})
+            if time.time() - started < 1:
+                time.sleep(1)  # Don't spin if workers die right after starting
+            spawn()
+    listener.close()
+
+if __name__ == "__main__":
+    print("\n===== Starting Chatly =====")
+    runtime_flags.reset()
+    check_ollama_on_startup()
     
     print(f"Starting server on port 19125")
-    app.run(host="0.0.0.0", debug=False, port=19125)
\ No newline at end of file
+    if WORKERS > 1 and hasattr(os, "fork"):
+        print(f"Serving with {WORKERS} worker processes")
+        serve_workers("0.0.0.0", 19125, WORKERS)
+    else:
+        app.run(host="0.0.0.0", debug=False, port=19125)
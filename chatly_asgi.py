@@ -0,0 +1,629 @@
+"""Asyncio (ASGI) serving mode for Chatly.
+
+Exposes the same routes as chatly.py. Message generation (/api/send_message,
+/api/send_message_stream and /api/resume_generation) runs natively on the
+event loop with a non-blocking Ollama client, so an in-flight generation costs
+a task instead of a thread. Every other route is short-lived and is handed to the Flask app on a
+small thread pool, as is the file and encryption work of the generation routes.
+
+Run it with:
+    python chatly_asgi.py            (needs uvicorn: pip install uvicorn)
+    uvicorn chatly_asgi:app --port 19125
+"""
+import asyncio
+import io
+import json
+import os
+import ssl
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from flask import g, request, session
+
+import chatly
+
+log = chatly.log
+
+ASGI_THREADS = int(os.environ.get("CHATLY_ASGI_THREADS", 32))
+
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix="chatly-asgi")
+
+
+async def run_blocking(function, *args):
+    """Run file and encryption work off the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+class AsyncOllamaResponse:
+    """Streaming HTTP/1.1 response from Ollama, read line by line"""
+    def __init__(self, client, connection, status, headers):
+        self.client = client
+        self.connection = connection
+        self.status = status
+        self.headers = headers
+        self.finished = False
+
+    async def iter_lines(self):
+        reader = self.connection[0]
+        buffer = b""
+        async for chunk in self.iter_body(reader):
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line.decode("utf-8")
+        if buffer.strip():
+            yield buffer.decode("utf-8")
+
+    async def iter_body(self, reader):
+        timeout = chatly.OLLAMA_READ_TIMEOUT
+        if self.headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await asyncio.wait_for(reader.readline(), timeout)
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    # Skip trailers up to the final empty line
+                    while (await asyncio.wait_for(reader.readline(), timeout)).strip():
+                        pass
+                    break
+                chunk = await asyncio.wait_for(reader.readexactly(size + 2), timeout)
+                yield chunk[:-2]
+        elif "content-length" in self.headers:
+            remaining = int(self.headers["content-length"])
+            while remaining > 0:
+                chunk = await asyncio.wait_for(reader.read(min(remaining, 65536)), timeout)
+                if not chunk:
+                    raise ConnectionError("Ollama closed the connection mid-response")
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await asyncio.wait_for(reader.read(65536), timeout)
+                if not chunk:
+                    break
+                yield chunk
+            self.headers["connection"] = "close"
+        self.finished = True
+        await self.aclose()
+
+    async def json(self):
+        body = b""
+        async for chunk in self.iter_body(self.connection[0]):
+            body += chunk
+        return json.loads(body or b"{}")
+
+    def abort(self):
+        """Close the connection now, e.g. to cancel a generation; a pending read then ends early"""
+        if self.connection is not None:
+            self.headers["connection"] = "close"
+            self.connection[1].close()
+
+    async def aclose(self):
+        """Return the connection to the pool if the body was fully read, otherwise drop it"""
+        if self.connection is None:
+            return
+        reusable = self.finished and self.headers.get("connection", "").lower() != "close"
+        self.client.release(self.connection, reusable)
+        self.connection = None
+
+
+class AsyncOllamaClient:
+    """Minimal non-blocking HTTP client for Ollama with a keep-alive connection pool"""
+    def __init__(self, base_url, pool_size):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.pool_size = pool_size
+        self.idle = []
+
+    async def connect(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl),
+            chatly.OLLAMA_CONNECT_TIMEOUT
+        )
+
+    def release(self, connection, reusable):
+        if reusable and len(self.idle) < self.pool_size:
+            self.idle.append(connection)
+        else:
+            connection[1].close()
+
+    async def request(self, method, path, payload=None, timeout=None):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        reader, writer = await self.connect()
+        try:
+            writer.write(
+                f"{method} {path} HTTP/1.1\r\n"
+                f"Host: {self.host}:{self.port}\r\n"
+                "Connection: keep-alive\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+
+            timeout = timeout or chatly.OLLAMA_READ_TIMEOUT
+            status_line = await asyncio.wait_for(reader.readline(), timeout)
+            if not status_line:
+                raise ConnectionError("Ollama closed the connection")
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                if not line.strip():
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+        except BaseException:
+            writer.close()
+            raise
+        return AsyncOllamaResponse(self, (reader, writer), status, headers)
+
+
+ollama_client = AsyncOllamaClient(chatly.OLLAMA_URL, chatly.OLLAMA_POOL_SIZE)
+
+
+async def check_ollama_health():
+    try:
+        response = await ollama_client.request("GET", "/api/version", timeout=chatly.OLLAMA_STATUS_TIMEOUT)
+        await response.json()
+        return response.status == 200
+    except Exception:
+        return None
+
+
+async def astream_with_ollama(messages, model, stats=None, job=None):
+    """Async counterpart of chatly.stream_with_ollama, same replies on errors and cancellation"""
+    if stats is None:
+        stats = {}
+    stats["ok"] = False
+    if chatly.mock_mode():
+        last_message = messages[-1]["content"] if messages else ""
+        yield chatly.generate_mock_response(last_message, model)
+        return
+
+    payload = chatly.build_ollama_payload(messages, model)
+    log.debug("Payload prepared", extra={"model": model, "messages": len(payload["messages"])})
+
+    started = time.perf_counter()
+    try:
+        response = await ollama_client.request("POST", "/api/chat", payload)
+
+        if response.status != 200:
+            await response.aclose()
+            error_msg = f"Error communicating with AI model (HTTP {response.status}). Make sure Ollama is running and the selected model '{model}' is available."
+            log.error(error_msg)
+            yield error_msg
+            return
+
+        response_length = 0
+        if job:
+            # cancel() may be called from any thread, the connection belongs to this loop
+            loop = asyncio.get_running_loop()
+            job.attach(lambda: loop.call_soon_threadsafe(response.abort))
+        try:
+            async for line in response.iter_lines():
+                if job and job.cancelled.is_set():
+                    break
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    log.error("Could not decode line: %s", line[:100])
+                    continue
+                content = chatly.parse_ollama_chunk(data)
+                if data.get("done"):
+                    stats.update({key: value for key, value in data.items() if key.endswith(("_count", "_duration"))})
+                if content:
+                    if not response_length:
+                        stats["first_token_seconds"] = time.perf_counter() - started
+                    response_length += len(content)
+                    yield content
+        except Exception:
+            if not (job and job.cancelled.is_set()):
+                raise
+        finally:
+            if job:
+                job.attach(None)
+            await response.aclose()
+
+        if job and job.cancelled.is_set():
+            stats["cancelled"] = True
+            return
+        if not response_length:
+            log.warning("Empty response from Ollama despite status 200", extra={"model": model})
+            healthy = await check_ollama_health()
+            if healthy is None:
+                yield "Ollama appears to be offline. Please make sure Ollama is running and try again."
+            elif not healthy:
+                yield "Ollama seems to be running but not responding properly. Please check if the model is loaded correctly."
+            else:
+                yield "I couldn't generate a response. Please check server logs for details."
+        else:
+            stats["ok"] = True
+            stats["generation_seconds"] = time.perf_counter() - started
+            chatly.observe_ollama_stats(model, stats)
+    except asyncio.TimeoutError:
+        error_msg = "The request to Ollama timed out. Please check if the model is loaded with 'ollama pull " + model + "' and try again."
+        log.error(error_msg)
+        yield error_msg
+    except OSError:
+        # Connection refused/reset; ConnectionError is a subclass
+        log.error("Could not connect to Ollama. Please make sure Ollama is running at %s.", chatly.OLLAMA_URL)
+
+        # Auto-enable mock mode if connection fails, like the threaded server
+        chatly.set_mock_mode(True)
+        log.debug("Auto-enabled mock mode due to connection failure")
+        last_message = messages[-1]["content"] if messages else ""
+        yield chatly.generate_mock_response(last_message, model)
+    except Exception as e:
+        log.exception("Error connecting to Ollama")
+        last_user_message = next((msg["content"] for msg in reversed(messages) if msg["role"] == "user"), None)
+        if last_user_message:
+            yield f"FALLBACK RESPONSE (Ollama unavailable): I received your message: '{last_user_message}'. Please make sure Ollama is running with the '{model}' model loaded."
+            return
+        yield f"Error connecting to Ollama: {str(e)}. Please make sure Ollama is running."
+
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI HTTP scope"""
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        if key in environ:
+            value = environ[key] + ("; " if name == "COOKIE" else ",") + value
+        environ[key] = value
+    return environ
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_response(send, status, headers, chunks=()):
+    await send_response_start(send, {"status": status, "headers": headers})
+    for chunk in chunks:
+        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def send_json(send, data, status=200):
+    headers = [("Content-Type", "application/json")]
+    await send_response(send, status, headers, [json.dumps(data).encode()])
+
+
+async def call_wsgi(scope, body, send):
+    """Serve a request with the Flask app on the thread pool, streaming its body"""
+    environ = build_environ(scope, body)
+    response_start = {}
+
+    def start_response(status, headers, exc_info=None):
+        response_start["status"] = int(status.split(" ", 1)[0])
+        response_start["headers"] = headers
+
+    result = await run_blocking(chatly.app.wsgi_app, environ, start_response)
+    iterator = iter(result)
+    try:
+        started = False
+        while True:
+            chunk = await run_blocking(next, iterator, None)
+            if chunk is None:
+                break
+            if not started:
+                await send_response_start(send, response_start)
+                started = True
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        if not started:
+            await send_response_start(send, response_start)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(result, "close"):
+            await run_blocking(result.close)
+
+
+async def send_response_start(send, response_start):
+    await send({
+        "type": "http.response.start",
+        "status": response_start["status"],
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in response_start["headers"]],
+    })
+
+
+def read_message_request(environ):
+    """Session user and JSON body of a send_message request, the same way Flask sees them"""
+    with chatly.app.request_context(environ):
+        return session.get("username"), chatly.request_data()
+
+
+async def wait_for_generation_slot(username, model, job):
+    """Queue with chatly's scheduler without holding a thread, reporting the queue position to the job"""
+    loop = asyncio.get_running_loop()
+    granted = loop.create_future()
+
+    def on_granted():
+        loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+    ticket = chatly.generation_scheduler.submit(username, model, on_granted)
+    try:
+        waited = 0
+        while not ticket.granted.is_set() and not job.cancelled.is_set() and waited < chatly.QUEUE_TIMEOUT:
+            job.set_queue_position(chatly.generation_scheduler.position(ticket))
+            try:
+                await asyncio.wait_for(asyncio.shield(granted), 1)
+            except asyncio.TimeoutError:
+                pass
+            waited += 1
+        job.set_queue_position(0)
+    except BaseException:
+        chatly.generation_scheduler.release(ticket)
+        raise
+    return ticket
+
+
+# Generation tasks run on their own, not as part of a request; asyncio only keeps weak references
+generation_tasks = set()
+
+
+async def start_generation(username, chat_id, chat_data, model, regenerate=False):
+    """Async counterpart of chatly.start_generation: the job runs as a task on the event loop"""
+    messages = chat_data["messages"]
+    job = chatly.GenerationJob(username, chat_id, chat_data["title"], messages[-1], len(messages) - 1)
+    await run_blocking(chatly.generation_jobs.start, job)
+    task = asyncio.ensure_future(run_generation(job, chat_data, model, regenerate))
+    generation_tasks.add(task)
+    task.add_done_callback(generation_tasks.discard)
+    return job
+
+
+async def run_generation(job, chat_data, model, regenerate):
+    """Async counterpart of chatly.run_generation"""
+    username, chat_id = job.username, job.chat_id
+    log_context = {"user": username, "chat_id": chat_id, "model": model, "job_id": job.id}
+    started = time.perf_counter()
+    assistant_message = None
+    try:
+        ollama_response = None if regenerate else chatly.get_cached_response(chat_data["messages"], model)
+        if ollama_response is not None:
+            job.add_chunk(ollama_response)
+        else:
+            ticket = await wait_for_generation_slot(username, model, job)
+            try:
+                if job.cancelled.is_set():
+                    ollama_response = ""
+                elif not ticket.granted.is_set():
+                    log.error("Gave up waiting for a slot after %ss", chatly.QUEUE_TIMEOUT, extra=log_context)
+                    ollama_response = chatly.QUEUE_BUSY_MESSAGE
+                else:
+                    try:
+                        stats = {}
+                        context = await run_blocking(chatly.build_context_messages, username, chat_id, chat_data, model)
+                        async for chunk in astream_with_ollama(context, model, stats, job):
+                            job.add_chunk(chunk)
+                        ollama_response = "".join(job.chunks)
+                        if stats["ok"]:
+                            chatly.cache_response(chat_data["messages"], model, ollama_response)
+                    except Exception as e:
+                        log.exception("Error in astream_with_ollama", extra=log_context)
+                        ollama_response = f"Error processing your message: {str(e)}"
+            finally:
+                chatly.generation_scheduler.release(ticket)
+
+        assistant_message = await run_blocking(chatly.finish_chat_turn, username, chat_id, chat_data,
+                                               ollama_response, job.cancelled.is_set())
+        log.info("Reply generated (asgi)", extra={**log_context, "length": len(ollama_response),
+                                                  "latency": round(time.perf_counter() - started, 3)})
+    except Exception:
+        log.exception("Generation job failed", extra=log_context)
+    finally:
+        await run_blocking(chatly.generation_jobs.finish, job, assistant_message)
+
+
+async def follow_job(job, offset=0):
+    """Async counterpart of chatly.follow_job"""
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def listener():
+        loop.call_soon_threadsafe(changed.set)
+
+    job.follow(listener)
+    try:
+        queue_position = 0
+        while True:
+            changed.clear()
+            events, queue_position, finished = job.events_since(offset, queue_position)
+            for event in events:
+                offset += "t" in event
+                yield event
+            if finished:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), chatly.STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield {}
+    finally:
+        job.unfollow(listener)
+
+
+async def watch_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def stream_job(receive, send, job, offset=0):
+    """Send a job's events as the NDJSON stream of chatly.job_stream_response, until done or disconnected"""
+    headers = [("Content-Type", "application/x-ndjson"), ("X-Accel-Buffering", "no")]
+    await send_response_start(send, {"status": 200, "headers": headers})
+
+    async def send_events():
+        events = follow_job(job, offset)
+        try:
+            await send_line(json.dumps({"type": "start", "title": job.title, "job_id": job.id}) + "\n")
+            async for event in events:
+                if event.get("q") != 0:
+                    await send_line(chatly.job_event_line(event))
+        finally:
+            await events.aclose()
+
+    async def send_line(line):
+        await send({"type": "http.response.body", "body": line.encode(), "more_body": True})
+
+    # uvicorn drops what is sent after a disconnect without an error, so stop following when it
+    # reports one; the job keeps running and can be resumed
+    sender = asyncio.ensure_future(send_events())
+    watcher = asyncio.ensure_future(watch_disconnect(receive))
+    try:
+        await asyncio.wait({sender, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (sender, watcher):
+            task.cancel()
+    if sender.done() and not sender.cancelled():
+        sender.result()
+        await send({"type": "http.response.body", "body": b""})
+
+
+async def send_message(scope, body, receive, send, stream):
+    username, data = read_message_request(build_environ(scope, body))
+    if not username:
+        await send_json(send, {"success": False, "message": "Not logged in"}, 401)
+        return
+
+    chat_id = data.get("chat_id")
+    message = data.get("message")
+    if not chatly.filled_in(chat_id, message):
+        await send_json(send, {"success": False, "message": "Chat ID and message are required"}, 400)
+        return
+
+    chat_data = await run_blocking(chatly.start_chat_turn, username, chat_id, message)
+    current_model = await run_blocking(chatly.get_current_model, username)
+    log.debug("Processing message (asgi)", extra={"user": username, "chat_id": chat_id, "model": current_model})
+
+    job = await start_generation(username, chat_id, chat_data, current_model, data.get("regenerate"))
+    if stream:
+        await stream_job(receive, send, job)
+        return
+
+    async for event in follow_job(job):
+        pass
+    if job.result is None and job.cancelled.is_set():
+        await send_json(send, {"success": False, "message": "Generation cancelled, nothing was saved"}, 409)
+    elif job.result is None:
+        await send_json(send, {"success": False, "message": "Error processing your message"}, 500)
+    else:
+        await send_json(send, {"success": True, "message": job.result, "title": job.title})
+
+
+async def resume_generation(scope, body, receive, send):
+    """Native /api/resume_generation for jobs of this process, the Flask route handles the others"""
+    username, data = read_message_request(build_environ(scope, body))
+    job_id = data.get("job_id")
+    job = chatly.generation_jobs.get(username, job_id) if username and chatly.filled_in(job_id) else None
+    offset = data.get("offset", 0)
+    if not job or job.chat_id != data.get("chat_id") or not isinstance(offset, int) or offset < 0:
+        await call_wsgi(scope, body, send)
+        return
+    await stream_job(receive, send, job, offset)
+
+
+ASYNC_ROUTES = {
+    "/api/send_message": lambda scope, body, receive, send: send_message(scope, body, receive, send, stream=False),
+    "/api/send_message_stream": lambda scope, body, receive, send: send_message(scope, body, receive, send, stream=True),
+    "/api/resume_generation": resume_generation,
+}
+
+
+def after_request_headers(environ, started, status, headers):
+    """The headers of a native route's response once Flask's after_request hooks have run
+    on it, as on every Flask route: CORS, no-cache headers, request metrics"""
+    with chatly.app.request_context(environ):
+        g.request_started = started
+        response = chatly.app.process_response(chatly.app.response_class(status=status, headers=headers))
+        return response.headers.to_wsgi_list()
+
+
+def flask_send(scope, body, send):
+    """Wrap `send` so a native route's response goes through the Flask app's after_request hooks"""
+    started = time.perf_counter()
+
+    async def send_processed(message):
+        if message["type"] == "http.response.start":
+            headers = [(name.decode("latin-1"), value.decode("latin-1")) for name, value in message["headers"]]
+            headers = after_request_headers(build_environ(scope, body), started, message["status"], headers)
+            message = {**message, "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                              for name, value in headers]}
+        await send(message)
+    return send_processed
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await run_blocking(chatly.check_ollama_on_startup)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    body = await read_body(receive)
+    handler = ASYNC_ROUTES.get(scope["path"]) if scope["method"] == "POST" else None
+    if handler:
+        await handler(scope, body, receive, flask_send(scope, body, send))
+    else:
+        await call_wsgi(scope, body, send)
+
+
+if __name__ == "__main__":
+    try:
+        import uvicorn
+    except ImportError:
+        print("The ASGI serving mode needs an ASGI server: pip install uvicorn")
+        sys.exit(1)
+
+    print("\n===== Starting Chatly (asgi) =====")
+    print(f"Starting server on port 19125")
+    uvicorn.run(app, host="0.0.0.0", port=19125, log_level="warning")
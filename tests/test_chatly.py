@@ -0,0 +1,290 @@
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import uuid
+
+import pytest
+
+# Chatly reads its settings when it is imported and keeps its data relative to
+# the working directory, so both are set up first: a scratch directory, and a
+# fake Ollama (Tools/fake_ollama.py) on a free port, one generation at a time.
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+sys.path.insert(0, os.path.join(BASE_DIR, 'Tools'))
+
+os.chdir(tempfile.mkdtemp(prefix='chatly-tests-'))
+os.makedirs('Key')
+with socket.socket() as probe:
+    probe.bind(('127.0.0.1', 0))
+    OLLAMA_PORT = probe.getsockname()[1]
+os.environ.update({
+    'CHATLY_OLLAMA_URL': f'http://127.0.0.1:{OLLAMA_PORT}',
+    'CHATLY_MODEL_CONCURRENCY': '1',
+    'CHATLY_LOG_LEVEL': 'WARNING',
+})
+
+import chatly  # noqa: E402
+import fake_ollama  # noqa: E402
+
+MODEL = chatly.DEFAULT_MODEL
+
+
+@pytest.fixture(scope='module')
+def ollama():
+    server = fake_ollama.serve_fake_ollama(OLLAMA_PORT, models=(MODEL,))
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def fast_replies(ollama):
+    ollama.first_token_latency = 0.01
+    ollama.tokens_per_second = 500.0
+    ollama.reply_tokens = 20
+
+
+def slow_replies(ollama):
+    """Replies that take long enough (20 s) to be cancelled halfway"""
+    ollama.tokens_per_second = 20.0
+    ollama.reply_tokens = 400
+
+
+@pytest.fixture(params=['file', 'sqlite'])
+def backend(request, monkeypatch):
+    monkeypatch.setattr(chatly, 'storage', chatly.create_storage(request.param))
+    return request.param
+
+
+@pytest.fixture
+def client():
+    return chatly.app.test_client()
+
+
+def register(client):
+    username = f'user_{uuid.uuid4().hex[:8]}'
+    response = client.post('/api/register', json={'username': username, 'password': 'secret'})
+    assert response.status_code == 201
+    return username
+
+
+def new_chat(client):
+    return client.post('/api/new_chat').get_json()['chat_id']
+
+
+def stream_events(response):
+    """The events of an NDJSON reply stream, read as the server produces them"""
+    buffer = b''
+    for chunk in response.response:
+        buffer += chunk.encode() if isinstance(chunk, str) else chunk
+        while b'\n' in buffer:
+            line, buffer = buffer.split(b'\n', 1)
+            if line.strip():
+                yield json.loads(line)
+
+
+def next_event(events, event_type):
+    return next(event for event in events if event['type'] == event_type)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+def test_streamed_reply_is_saved(client, backend, ollama):
+    register(client)
+    chat_id = new_chat(client)
+
+    events = list(stream_events(client.post('/api/send_message_stream',
+                                            json={'chat_id': chat_id, 'message': 'Hello there'})))
+    assert events[0]['type'] == 'start'
+    reply = ''.join(event['content'] for event in events if event['type'] == 'token')
+    assert reply
+    assert events[-1]['type'] == 'done'
+    assert events[-1]['message']['content'] == reply
+
+    chat = client.get(f'/api/get_chat/{chat_id}').get_json()['chat']
+    assert chat['title'] == 'Hello there'
+    assert [message['role'] for message in chat['messages']] == ['user', 'assistant']
+    assert chat['messages'][1]['content'] == reply
+
+
+def test_ollama_connections_are_reused(client, ollama):
+    register(client)
+    chat_id = new_chat(client)
+    wait_for(lambda: not chatly.model_residency.loading)
+    before = dict(ollama.stats)
+
+    for number in range(5):
+        response = client.post('/api/send_message', json={'chat_id': chat_id, 'message': f'Question {number}'})
+        assert response.status_code == 200
+
+    requests_sent = ollama.stats['requests'] - before['requests']
+    assert requests_sent >= 5
+    assert ollama.stats['connections'] - before['connections'] < requests_sent
+
+
+def test_cancel_closes_the_ollama_stream(client, backend, ollama):
+    slow_replies(ollama)
+    register(client)
+    chat_id = new_chat(client)
+    aborted = ollama.stats['aborted']
+
+    events = stream_events(client.post('/api/send_message_stream', json={'chat_id': chat_id, 'message': 'Hi'}))
+    start = next_event(events, 'start')
+    next_event(events, 'token')
+    cancelled_at = time.monotonic()
+    assert client.post('/api/cancel_generation', json={'job_id': start['job_id']}).get_json()['success']
+
+    done = next_event(events, 'done')
+    assert time.monotonic() - cancelled_at < 5
+    assert done['message']['cancelled']
+    assert done['message']['content']
+    wait_for(lambda: ollama.stats['aborted'] > aborted)
+
+    saved = client.get(f'/api/get_chat/{chat_id}').get_json()['chat']['messages'][-1]
+    assert saved['cancelled']
+    assert saved['content'] == done['message']['content']
+
+
+def test_deleting_a_chat_cancels_its_generation(client, backend, ollama):
+    slow_replies(ollama)
+    username = register(client)
+    chat_id = new_chat(client)
+
+    events = stream_events(client.post('/api/send_message_stream', json={'chat_id': chat_id, 'message': 'Hi'}))
+    start = next_event(events, 'start')
+    next_event(events, 'token')
+    assert client.post('/api/delete_chat', json={'chat_id': chat_id}).status_code == 200
+
+    list(events)
+    job = chatly.generation_jobs.get(username, start['job_id'])
+    wait_for(lambda: job.finished_at)
+    # The reply being saved must not bring the chat back
+    assert client.get(f'/api/get_chat/{chat_id}').status_code == 404
+    assert chat_id not in [chat['id'] for chat in client.get('/api/get_chats').get_json()['chats']]
+
+
+def test_cancelling_a_queued_generation_drops_the_turn(client, ollama):
+    slow_replies(ollama)
+    register(client)
+    running_chat, queued_chat = new_chat(client), new_chat(client)
+
+    running = stream_events(client.post('/api/send_message_stream', json={'chat_id': running_chat, 'message': 'Hi'}))
+    next_event(running, 'token')
+    queued = stream_events(client.post('/api/send_message_stream', json={'chat_id': queued_chat, 'message': 'Hi'}))
+    next_event(queued, 'start')
+    assert next(queued)['type'] == 'queued'
+
+    assert client.post('/api/cancel_generation', json={'chat_id': queued_chat}).get_json()['success']
+    assert [event['type'] for event in queued] == ['dropped']
+    assert client.get(f'/api/get_chat/{queued_chat}').get_json()['chat']['messages'] == []
+
+    client.post('/api/cancel_generation', json={'chat_id': running_chat})
+    assert next_event(running, 'done')['message']['cancelled']
+
+
+def test_scheduler_lets_users_with_fewer_running_generations_go_first():
+    scheduler = chatly.GenerationScheduler(model_concurrency=2, max_active_models=1, switch_wait=60)
+    first, second, third = (scheduler.submit('alice', 'm1') for _ in range(3))
+    other = scheduler.submit('bob', 'm1')
+    assert first.granted.is_set() and second.granted.is_set()
+    assert scheduler.position(third) == 1 and scheduler.position(other) == 2
+
+    scheduler.release(first)
+    assert other.granted.is_set()
+    assert not third.granted.is_set()
+
+
+def test_scheduler_keeps_the_loaded_model_busy():
+    scheduler = chatly.GenerationScheduler(model_concurrency=1, max_active_models=1, switch_wait=60)
+    loaded = scheduler.submit('alice', 'm1')
+    other_model = scheduler.submit('bob', 'm2')
+    same_model = scheduler.submit('carol', 'm1')
+
+    scheduler.release(loaded)
+    assert same_model.granted.is_set()
+    assert not other_model.granted.is_set()
+    scheduler.release(same_model)
+    assert other_model.granted.is_set()
+
+
+def test_scheduler_switches_models_for_a_starving_request():
+    scheduler = chatly.GenerationScheduler(model_concurrency=1, max_active_models=1, switch_wait=0)
+    loaded = scheduler.submit('alice', 'm1')
+    other_model = scheduler.submit('bob', 'm2')
+    same_model = scheduler.submit('carol', 'm1')
+
+    scheduler.release(loaded)
+    assert other_model.granted.is_set()
+    assert not same_model.granted.is_set()
+
+
+def test_chat_pages(client, backend):
+    username = register(client)
+    chat_id = new_chat(client)
+    messages = [{'role': 'user' if number % 2 == 0 else 'assistant', 'content': f'message {number}',
+                 'timestamp': 1000 + number} for number in range(25)]
+    chatly.append_chat_messages(username, chat_id, messages)
+
+    def contents(query):
+        response = client.get(f'/api/get_chat/{chat_id}?{query}').get_json()
+        return [message['content'] for message in response['chat']['messages']], response['page']
+
+    newest, page = contents('limit=10')
+    assert newest == [f'message {number}' for number in range(15, 25)]
+    assert page == {'start': 15, 'total': 25, 'has_more': True}
+    older, page = contents('limit=10&before=15')
+    assert older == [f'message {number}' for number in range(5, 15)]
+    assert page == {'start': 5, 'total': 25, 'has_more': True}
+    since, page = contents('since=1020')
+    assert since == [f'message {number}' for number in range(20, 25)]
+
+
+def test_rewriting_a_chat_updates_its_title():
+    # The SQLite chat index reads the title column, which rewrites (as the migration tools do) must keep current
+    storage = chatly.create_storage('sqlite')
+    username = f'user_{uuid.uuid4().hex[:8]}'
+    storage.write_chat(username, 'chat', {'title': 'Old title', 'messages': []})
+    storage.write_chat(username, 'chat', {'title': 'New title', 'messages': []})
+    assert storage.load_chat_index(username)['chat']['title'] == 'New title'
+
+    storage.append_chat(username, 'chat', [], {'title': 'Renamed'})
+    assert storage.load_chat_index(username)['chat']['title'] == 'Renamed'
+
+
+def test_unreadable_messages_are_skipped_everywhere(backend):
+    storage = chatly.storage
+    username = f'user_{uuid.uuid4().hex[:8]}'
+    storage.append_chat(username, 'chat', [{'role': 'user', 'content': f'message {number}', 'timestamp': number}
+                                           for number in range(6)], {'title': 'Chat'})
+    # Corrupt the second message, as a record written with a lost key would be
+    if backend == 'file':
+        log_file = storage.chat_log_file(username, 'chat')
+        with open(log_file) as f:
+            lines = f.readlines()
+        lines[2] = 'M not-a-token\n'
+        with open(log_file, 'w') as f:
+            f.writelines(lines)
+    else:
+        with storage.transaction() as connection:
+            connection.execute("UPDATE messages SET data = 'not-a-token' WHERE username = ? AND position = 1",
+                               (username,))
+
+    readable = [f'message {number}' for number in (0, 2, 3, 4, 5)]
+    assert [message['content'] for message in storage.load_chat(username, 'chat')['messages']] == readable
+    assert storage.count_messages(username, 'chat') == 5
+    chat_data, start, total = storage.load_chat_page(username, 'chat', limit=2)
+    assert (start, total) == (3, 5)
+    assert [message['content'] for message in chat_data['messages']] == readable[3:]
+    chat_data, start, total = storage.load_chat_page(username, 'chat', since=2)
+    assert start == 1
+    assert [message['content'] for message in chat_data['messages']] == readable[1:]
+
+    storage.append_chat(username, 'chat', [{'role': 'assistant', 'content': 'message 6', 'timestamp': 6}])
+    assert storage.count_messages(username, 'chat') == 6